@@ -32,6 +32,13 @@ def get_parser():
     parser.add_argument("--max_epochs",  type=int,default=100)
     parser.add_argument("--batch_size",  type=int,default=1)
     parser.add_argument("--num_head",  type=int,default=1)
+    # multi-site model: checkpointed chunks of this many sites through the single-site module, 0 for all at once
+    parser.add_argument("--site_chunk",  type=int,default=0)
+    # multi-site model: sites attend to the sites within this many bp, or to this many nearest sites, 0 for all sites
+    parser.add_argument("--attention_window",  type=int,default=0)
+    parser.add_argument("--attention_neighbors",  type=int,default=0)
+    # also restrict the second, position-free attention layer to the neighbours
+    parser.add_argument("--sparse_attention2", action="store_true",default=False)
     parser.add_argument("--num_workers",  type=int,default=8)
     parser.add_argument("--learning_rate",  type=float,default=0.00001)
     parser.add_argument("--prune_ratio",  type=float,default=0)
@@ -43,10 +50,23 @@ def get_parser():
 
     parser.add_argument("--patch_num",  type=int,default=256)
     parser.add_argument("--CL",  type=int,default=8192)
+    # binned histone context, patch_num bins over CL bases per site, next to the base-resolution window
+    parser.add_argument("--histone_context", action="store_true",default=False)
 
     #context length
     parser.add_argument("--CL_max",  type=int,default=8192)
     parser.add_argument('--data_path', action='append', help='<Required> Set flag', required=False)
+    # npz: per-gene npz files, ragged: containers written by ragged_dataset.py,
+    # stream: samples built while training by stream_dataset.py, --data_path is not used
+    parser.add_argument('--data_format', default='npz', choices=['npz','ragged','stream'])
+    parser.add_argument("--cell_type", type=str, default="GM12878")
+    parser.add_argument("--prefetch", type=int, default=16, help="samples each stream worker extracts ahead")
+    parser.add_argument("--shared_store", type=str, default=None, help="attach to the shared memory published by shared_store.py --name")
+    parser.add_argument("--feature_cache_mb", type=int, default=0, help="stream: in-memory cache of gene features per worker, 0 for none")
+    parser.add_argument("--spill_dir", type=str, default=None, help="spill features evicted from the cache to slab files here")
+    parser.add_argument("--spill_mb", type=int, default=0)
+    parser.add_argument("--slab_mb", type=int, default=0, help="slab file size, 0 for min(256, --spill_mb)")
+    parser.add_argument("--label_sampling", action="store_true", default=False, help="ragged only: skip unlabeled samples, subsample all-zero ones with importance weights")
 
     
     # parser.add_argument("--data_path",type=str,default="/rhome/ghao004/bigdata/lstm_splicing/single_site_dataset_plus/")
@@ -61,10 +81,21 @@ def get_parser():
 
 
 
-parser = get_parser()
-args, unknown = parser.parse_known_args()
-if args.task == 'reg':
-    args.dropout = 0.0
+_args = None
 
+def get_args():
+    # argv is parsed on first use instead of at import time
+    global _args
+    if _args is None:
+        parser = get_parser()
+        _args, unknown = parser.parse_known_args()
+        if _args.task == 'reg':
+            _args.dropout = 0.0
+    return _args
 
 
+def __getattr__(name):
+    # keeps "from args import args" working
+    if name == "args":
+        return get_args()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -0,0 +1,642 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+
+
+def timeit(fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for i in range(repeat):
+        fn()
+    return (time.perf_counter()-start)/repeat
+
+
+def benchmark_tokenize(opt):
+    # parity of the lookup-table tokenizer against the HuggingFace path, then throughput of both
+    import generate_x
+
+    rng = np.random.default_rng(42)
+    length = len(generate_x.genome[opt.chromosome])
+    sites = np.sort(rng.integers(opt.genome_distance, length-opt.genome_distance, opt.num_sites))
+    for strand in ["+","-"]:
+        batch = generate_x.get_seq_batch(opt.chromosome,sites,opt.genome_distance,strand)
+        for i, site in enumerate(sites):
+            assert batch[i].tolist()==generate_x.get_seq_hf(opt.chromosome,int(site),opt.genome_distance,strand), (site, strand)
+    print("token ids identical for {} sites on both strands".format(opt.num_sites))
+
+    hf = timeit(lambda: [generate_x.get_seq_hf(opt.chromosome,int(site),opt.genome_distance,"+") for site in sites], opt.repeat)
+    fast = timeit(lambda: generate_x.get_seq_batch(opt.chromosome,sites,opt.genome_distance,"+"), opt.repeat)
+    print("HuggingFace tokenizer {:.1f} windows/s".format(opt.num_sites/hf))
+    print("lookup table batch    {:.1f} windows/s ({:.1f}x)".format(opt.num_sites/fast, hf/fast))
+
+
+def benchmark_import_time(opt):
+    # a fresh interpreter must import the module under the budget without pulling in the heavy optional
+    # dependencies itself. pytorch_lightning can't be deferred by modules whose classes subclass it, and it
+    # imports some of them (transformers when installed), those are reported but allowed
+    import ast
+    heavy = ["transformers","matplotlib","astropy","mpl_scatter_density","sklearn","torchvision"]
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), opt.module+".py")) as f:
+        tree = ast.parse(f.read())
+    top_level = set(alias.name.split(".")[0] for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))
+                    for alias in (node.names if isinstance(node, ast.Import) else [ast.alias(node.module or "")]))
+    required = [i for i in ["pytorch_lightning"] if i in top_level]
+    code = "import sys,time\nstart=time.perf_counter()\n{required}\nrequired=set(m for m in {heavy} if m in sys.modules)\nimport {module}\nprint(time.perf_counter()-start)\nprint(' '.join(sorted(required)))\nprint(' '.join(m for m in {heavy} if m in sys.modules and m not in required))".format(
+        module=opt.module, heavy=heavy, required="\n".join("import "+i for i in required))
+    output = subprocess.run([sys.executable,"-c",code],check=True,capture_output=True,text=True).stdout.split("\n")
+    seconds, allowed, loaded = float(output[0]), output[1].split(), output[2].split()
+    print("import {} took {:.2f}s (budget {:.2f}s)".format(opt.module, seconds, opt.budget))
+    if allowed:
+        print("imported by {}: {}".format(" ".join(required), " ".join(allowed)))
+    assert len(loaded)==0, "heavy modules imported at import time: "+" ".join(loaded)
+    assert seconds<=opt.budget, "import time over budget"
+
+
+def benchmark_context(opt):
+    # binned CL-base context of every mark against reading the same CL bases at base resolution
+    import generate_x
+    from args import get_args
+
+    rng = np.random.default_rng(42)
+    length = len(generate_x.genome[opt.chromosome])
+    sites = np.sort(rng.integers(get_args().CL, length-get_args().CL, opt.num_sites))
+    binned = timeit(lambda: generate_x.get_x_context(opt.cell_type,opt.chromosome,sites,"+",get_args().CL,get_args().patch_num), opt.repeat)
+    dense = timeit(lambda: [generate_x._get_x_balance(opt.cell_type,opt.chromosome,int(site),get_args().CL//2,"+",np.float32) for site in sites], opt.repeat)
+    print("base resolution {} bp  {:.1f} sites/s".format(get_args().CL, opt.num_sites/dense))
+    print("{} bins            {:.1f} sites/s ({:.1f}x)".format(get_args().patch_num, opt.num_sites/binned, dense/binned))
+
+
+class FakeBigWig:
+    # pyBigWig-shaped track of one chromosome, nan where there is no coverage
+    def __init__(self, chromosome, values):
+        self.chromosome = chromosome
+        self.track = values
+
+    def chroms(self, chromosome):
+        return len(self.track) if chromosome==self.chromosome else None
+
+    def values(self, chromosome, start, end, numpy=False):
+        return self.track[start:end]
+
+    def stats(self, chromosome, start, end, type="mean", nBins=1):
+        # exact per-bin summaries, None for the mean of a bin without coverage
+        bins = self.track[start:end].reshape(nBins, -1)
+        covered = ~np.isnan(bins)
+        if type=="coverage":
+            return list(covered.mean(axis=1))
+        summary = np.max if type=="max" else np.mean
+        return [summary(bin[mask]) if mask.any() else None for bin, mask in zip(bins, covered)]
+
+
+def benchmark_context_parity(opt):
+    # get_x_context of a dense store against bigWig-shaped tracks holding the same values: gaps without
+    # coverage, a mark shorter than the others and sites whose CL bases run off either chromosome end
+    import json
+    import tempfile
+    import generate_x
+    from args import get_args
+    from histone_store import HistoneStore, _clip
+
+    rng = np.random.default_rng(42)
+    marks = generate_x.get_histone_type_lst()
+    length, CL, patch_num = 20000, get_args().CL, get_args().patch_num
+    sites = np.concatenate([[0, CL//4, length-CL//4, length-1], rng.integers(0, length, 64)])
+    raw = {}
+    for row, mark in enumerate(marks):
+        values = rng.gamma(1.0, 2.0, length-row*100)
+        values[rng.random(len(values))<0.1] = np.nan
+        raw[mark] = values
+
+    def contexts(tracks):
+        with tempfile.TemporaryDirectory() as path:
+            os.makedirs(os.path.join(path, opt.cell_type))
+            store = np.full((len(marks), length), 4, dtype=np.float16)
+            for row, mark in enumerate(marks):
+                store[row,:len(tracks[mark])] = _clip(tracks[mark])
+            np.save(os.path.join(path, opt.cell_type, "chr1.npy"), store)
+            with open(os.path.join(path, opt.cell_type, "index.json"), "w") as f:
+                json.dump({"marks":marks,"chroms":{"chr1":length}}, f)
+
+            result = []
+            for histone_store, histone_modification in [(HistoneStore(path, opt.cell_type), None), (None, {i: FakeBigWig("chr1", tracks[i]) for i in marks})]:
+                generate_x.tempData.cell_type = opt.cell_type
+                generate_x.tempData.histone_store, generate_x.tempData.histone_modification = histone_store, histone_modification
+                result.append(np.concatenate([generate_x.get_x_context(opt.cell_type,"chr1",sites,strand,CL,patch_num) for strand in "+-"]))
+            generate_x.tempData.cell_type = None
+        return result
+
+    # the same up to the float16 rounding of the store, with or without values above 4
+    for name, tracks in [("values below 4", {mark: np.minimum(values, 3.99) for mark, values in raw.items()}),
+                         ("values up to {:.0f}".format(max(np.nanmax(i) for i in raw.values())), raw)]:
+        start = time.perf_counter()
+        store, bigwig = contexts(tracks)
+        print("{} marks, {} sites, CL {}, {} bins, {}: max abs difference {:.2e} ({:.2f} s)".format(
+            len(marks), len(sites), CL, patch_num, name, np.abs(store-bigwig).max(), time.perf_counter()-start))
+        assert np.allclose(store, bigwig, atol=4e-3), "store and bigWig contexts differ"
+
+
+def benchmark_shared_histone(opt):
+    # a SharedHistoneStore publishing chr1 only: windows of chr2 are read from the histone store on disk, or
+    # from the bigWig files when there is none, and match what the store holds
+    import json
+    import tempfile
+    from unittest import mock
+    import generate_x
+    import load_raw_data
+    import shared_store
+    from histone_store import HistoneStore, _clip
+
+    rng = np.random.default_rng(42)
+    marks = ["H3K4me3","H3K27ac","H3K36me3"]
+    values = {chromosome: rng.gamma(1.0, 2.0, (len(marks), 5000)) for chromosome in ["chr1","chr2"]}
+    bws = {mark: FakeBigWig("chr2", values["chr2"][row]) for row, mark in enumerate(marks)}
+    with tempfile.TemporaryDirectory() as path:
+        os.makedirs(os.path.join(path, opt.cell_type))
+        for chromosome, track in values.items():
+            np.save(os.path.join(path, opt.cell_type, chromosome+".npy"), _clip(track).astype(np.float16))
+        with open(os.path.join(path, opt.cell_type, "index.json"), "w") as f:
+            json.dump({"marks":marks,"chroms":{i: 5000 for i in values}}, f)
+        disk_store = HistoneStore(path, opt.cell_type)
+
+        with mock.patch.object(generate_x.bigwig_registry, "get", lambda cell_type, mark: bws[mark]):
+            for store_path in [path, os.path.join(path, "missing")]:
+                with mock.patch.object(load_raw_data, "HISTONE_STORE_PATH", store_path):
+                    store = shared_store.SharedHistoneStore(marks, {"chr1":disk_store.track("chr1")}, opt.cell_type)
+                for chromosome in ["chr1","chr2"]:
+                    for start, end in [(100, 4000), (4500, 6000)]:
+                        fetched = store.fetch(chromosome, start, end, marks[1:])
+                        assert np.array_equal(fetched, disk_store.fetch(chromosome, start, end, marks[1:])), chromosome+" differs"
+                print("{}: unpublished chr2 read window by window from {}, tracks kept in memory: {}".format(
+                    "histone store" if store.disk_store is not None else "no histone store",
+                    "the histone store" if store.disk_store is not None else "the bigWig files", sorted(store.tracks)))
+
+
+def benchmark_feature_cache(opt):
+    # Stream_site_dataset over synthetic genes with two persistent workers, each with its own feature cache:
+    # the workers keep their shard, so from the second epoch every gene span is a cache hit, in a new order
+    import copy
+    import json
+    import tempfile
+    from unittest import mock
+    import pandas as pd
+    import generate_x
+    import generate_y
+    import stream_dataset
+    from histone_store import _clip
+
+    rng = np.random.default_rng(42)
+    marks = generate_x.get_histone_type_lst()
+    length, num_workers = 50000, 2
+    chromosomes = ["chr1","chr2","chr3","chr4"]
+    genome = {i: "".join(rng.choice(list("ACGTN"), length)) for i in chromosomes}
+    genes = [(chromosome, "g{}".format(i*len(chromosomes)+j)) for j, chromosome in enumerate(chromosomes) for i in range(opt.num_genes//len(chromosomes))]
+    sites = [np.sort(rng.choice(np.arange(1000, length-1000), int(rng.integers(1, 16)), replace=False)) for i in genes]
+    sse = pd.DataFrame({"chromosome":np.repeat([i[0] for i in genes], [len(i) for i in sites]),"strand":"+",
+                        "site":np.concatenate(sites),"y":0.5,"Gene":np.repeat([i[1] for i in genes], [len(i) for i in sites])})
+    sse["row"] = np.arange(sse.shape[0])
+
+    with tempfile.TemporaryDirectory() as path:
+        os.makedirs(os.path.join(path, opt.cell_type))
+        for chromosome in chromosomes:
+            np.save(os.path.join(path, opt.cell_type, chromosome+".npy"), _clip(rng.gamma(1.0, 2.0, (len(marks), length))).astype(np.float16))
+        with open(os.path.join(path, opt.cell_type, "index.json"), "w") as f:
+            json.dump({"marks":marks,"chroms":{i: length for i in chromosomes}}, f)
+        generate_y.tempData.attach(opt.cell_type, generate_y.GeneIndex(sse), {}, {})
+        generate_x.tempData = generate_x.TempData()
+        dataset = stream_dataset.Stream_site_dataset(opt.cell_type, chromosomes, "multi", genome_distance=opt.window, shuffle=True, prefetch_size=0)
+        workers = [(copy.copy(dataset), generate_x.FeatureCache(1 << 30)) for i in range(num_workers)]
+        orders = []
+        with mock.patch.object(generate_x, "_genome", genome), mock.patch.object(generate_x, "HISTONE_STORE_PATH", path):
+            # reuse and the new order need a second epoch
+            for epoch in range(max(opt.repeat, 2)):
+                lookups = [(cache.hits, cache.misses) for worker, cache in workers]
+                order = []
+                for shard, (worker, cache) in enumerate(workers):
+                    with mock.patch.object(stream_dataset, "get_shard", lambda: (shard, num_workers)), mock.patch.object(generate_x, "feature_cache", cache):
+                        for sample in worker:
+                            assert sample["x"]["histone_mark"].numpy().flags.writeable
+                            order.append(sample["x"]["position"].shape[0])
+                hits = sum(cache.hits-i[0] for (worker, cache), i in zip(workers, lookups))
+                misses = sum(cache.misses-i[1] for (worker, cache), i in zip(workers, lookups))
+                print("epoch {}: {} genes, hit rate {:.2f}".format(epoch, len(order), hits/(hits+misses)))
+                if epoch > 0:
+                    assert misses==0, "the workers extracted gene spans again"
+                orders.append(order)
+    generate_y.tempData = generate_y.TempData()
+    generate_x.tempData = generate_x.TempData()
+    assert any(i!=orders[0] for i in orders[1:]), "every epoch has the same order"
+
+
+def benchmark_restricted_labels(opt):
+    # a label store of three chromosomes read after restrict_chromosomes: only the partitions of the selected
+    # chromosome are opened and the gene index holds only its genes
+    import tempfile
+    from unittest import mock
+    import pandas as pd
+    import generate_y
+    from label_store import _write_table, sse_columns
+
+    sse = pd.DataFrame({"Region":np.repeat(["chr1","chr2","chr3"], 4),"Strand":"+","Site":np.arange(12)*100,
+                        "SSE":0.5,"read_count":30,"Gene":np.repeat(["g1","g2","g3"], 4)})
+    with tempfile.TemporaryDirectory() as path:
+        _write_table(sse, os.path.join(path, opt.cell_type, "sse"), "Region", "Strand", sse_columns)
+        opened, load = [], np.load
+        def recording_load(file, *args, **kwargs):
+            opened.append(os.path.relpath(file, path))
+            return load(file, *args, **kwargs)
+        with mock.patch.object(generate_y, "LABEL_STORE_PATH", path), mock.patch.object(np, "load", recording_load):
+            generate_y.restrict_chromosomes(["chr2"])
+            gene_index = generate_y.get_gene_index(opt.cell_type)
+        # the next get_gene_index reads the real store again
+        generate_y.restrict_chromosomes(None)
+    print("opened", sorted(opened))
+    assert opened and all(i.split(os.sep)[2]=="chr2" for i in opened), "partitions of other chromosomes were opened"
+    assert list(gene_index.gene_ids)==["g2"], "genes of other chromosomes were indexed"
+
+
+def benchmark_shared_memory(opt):
+    # RSS of fresh processes that load the labels and the genome themselves, then of processes attached to
+    # the store `python shared_store.py --name NAME` is publishing
+    private = "import generate_x, generate_y, shared_store\ngenerate_y.get_gene_index({!r})\ngenerate_x.get_genome()\nshared_store.report_rss('private copy')".format(opt.cell_type)
+    attached = "import shared_store\nshared_store.attach({!r})".format(opt.shared_name)
+    for code in [private, attached]:
+        processes = [subprocess.Popen([sys.executable,"-c",code],stdout=subprocess.PIPE,text=True) for i in range(opt.processes)]
+        for process in processes:
+            output = process.communicate()[0]
+            print("\n".join(line for line in output.split("\n") if line.startswith("pid")))
+
+
+def container_bytes(data_dir):
+    import ragged_dataset
+    return sum(os.path.getsize(os.path.join(data_dir, i+".npy")) for i in ragged_dataset.arrays)
+
+
+def benchmark_compact_parity(opt):
+    # the compact container expanded by expand_features against the dense one: features, predictions of a
+    # randomly initialised single-site GRU model, on-disk size and per-sample read time
+    import torch
+    import ragged_dataset
+    from lstm_splicing_model import Single_site_model
+
+    dense = ragged_dataset.Ragged_site_dataset(opt.dense_dir)
+    compact = ragged_dataset.Ragged_site_dataset(opt.compact_dir)
+    assert len(dense)==len(compact), "containers hold different samples"
+    samples = range(min(opt.num_sites, len(dense)))
+
+    histone_error = 0
+    for i in samples:
+        a, b = dense[i]["x"], ragged_dataset.expand_features(compact[i]["x"])
+        assert torch.equal(a["DNA_seq"], b["DNA_seq"]), i
+        histone_error = max(histone_error, (a["histone_mark"]-b["histone_mark"]).abs().max().item())
+    print("{} samples, DNA identical, histone max abs error {:.5f} ({} encoding)".format(len(samples), histone_error, compact.encoding))
+
+    def model_input(dataset, i):
+        # single-site samples get a batch axis, the sites of a multi-site sample are the batch
+        x = dataset[i]["x"]
+        return {k: v[None] for k, v in x.items()} if dataset.model=="single" else x
+
+    x = model_input(dense, 0)
+    torch.manual_seed(42)
+    model = Single_site_model(x["DNA_seq"].shape[-1],x["DNA_seq"].shape[-2]+x["histone_mark"].shape[-2],opt.hidden_size,dropout=0).eval()
+    with torch.no_grad():
+        # the compact batches go to the model unexpanded, forward_single_site_model expands them
+        y_dense = torch.cat([model(model_input(dense, i)) for i in samples])
+        y_compact = torch.cat([model(model_input(compact, i)) for i in samples])
+    print("prediction max abs difference {:.6f}".format((y_dense-y_compact).abs().max().item()))
+
+    dense_bytes, compact_bytes = container_bytes(opt.dense_dir), container_bytes(opt.compact_dir)
+    print("dense {:.1f} MB, compact {:.1f} MB ({:.1f}x smaller)".format(dense_bytes/2**20, compact_bytes/2**20, dense_bytes/compact_bytes))
+    for name, dataset in [("dense",dense),("compact",compact)]:
+        seconds = timeit(lambda: [dataset[i] for i in samples], opt.repeat)
+        print("{:8s} read {:.1f} samples/s".format(name, len(samples)/seconds))
+
+
+def peak_memory(fn):
+    # peak MB allocated by fn: the CUDA allocator high-water mark, or on CPU the rise of VmHWM after resetting it
+    import torch
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        fn()
+        torch.cuda.synchronize()
+        return (torch.cuda.max_memory_allocated()-base)/2**20
+    # free heap pages are returned and blocks from 64 kB up are mmapped and unmapped on free,
+    # so VmHWM follows the live tensors
+    import ctypes
+    libc = ctypes.CDLL("libc.so.6")
+    libc.mallopt(-3, 65536)
+    libc.malloc_trim(0)
+    def status(key):
+        with open("/proc/self/status") as f:
+            return next(int(line.split()[1]) for line in f if line.startswith(key+":"))/1024
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    base = status("VmRSS")
+    fn()
+    return max(status("VmHWM")-base, 0.0)
+
+
+def relative_attention_reference(attention, x, position):
+    # Self_attention with relative_position as it was before the factorised terms, materialising the
+    # (1, num_head, sites, sites, head_dims) relative key and value tensors
+    import torch
+    N, length, h, d = 1, x.shape[0], attention.num_heads, attention.head_dim
+    V = attention.V_linear(x).reshape(N, length, h, d)
+    K = attention.K_linear(x).reshape(N, length, h, d)
+    Q = attention.Q_linear(x).reshape(N, length, h, d)
+    position = position[0]
+    energy = torch.einsum("nqhd,nkhd->nhqk",[Q,K])
+    relative_position = torch.clamp(torch.abs(position.reshape(N,length,1)-position.reshape(N,1,length)), min=0, max=5000)/5000
+    relative_position = relative_position.reshape(N, length, length, 1)
+    relative_position_V = attention.V_relative_linear(relative_position).reshape(N, length, length, h, d).permute(0,3,1,2,4)
+    relative_position_K = attention.K_relative_linear(relative_position).reshape(N, length, length, h, d).permute(0,3,1,2,4)
+    energy = energy+torch.einsum("nqhd,nhqjd->nhqj",[Q,relative_position_K])
+    weights = torch.softmax(energy / (attention.embed_dim**(1/2)), dim=3)
+    out = torch.einsum("nhql,nlhd->nqhd",[weights, V])
+    out = out+(weights.reshape(N, h, length, length, 1)*relative_position_V).sum(dim=3).permute(0,2,1,3)
+    return torch.squeeze(attention.fc_out(out.reshape(N, length, attention.embed_dim)))
+
+
+def benchmark_relative_attention(opt):
+    # peak memory and forward+backward latency of the factorised relative-position attention of Self_attention
+    # and of the 5-D reference over gene sizes, tests/test_attention.py checks that the two agree
+    import torch
+    from lstm_splicing_model import Self_attention
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    torch.manual_seed(42)
+    attention = Self_attention(opt.embed_dim, opt.heads, False, True).to(device)
+
+    def inputs(sites):
+        x = torch.randn(sites, opt.embed_dim, device=device, requires_grad=True)
+        position = torch.sort(torch.randint(0, 20*sites, (1, sites), device=device).float(), dim=1)[0]
+        return x, position
+
+    def run(fn, x, position):
+        attention.zero_grad()
+        x.grad = None
+        fn(x, position).sum().backward()
+
+    fast = lambda x, position: attention(x, x, x, position)[0]
+    reference = lambda x, position: relative_attention_reference(attention, x, position)
+
+    print("{} sites, embed_dim {}, {} heads, forward+backward on {}".format("/".join(map(str, opt.site_counts)), opt.embed_dim, opt.heads, device))
+    for sites in opt.site_counts:
+        x, position = inputs(sites)
+        for name, fn in [("5-D reference",reference),("factorised",fast)]:
+            memory = peak_memory(lambda: run(fn, x, position))
+            seconds = timeit(lambda: run(fn, x, position), opt.repeat)
+            print("{:5d} sites {:14s} peak {:8.1f} MB {:8.2f} ms".format(sites, name, memory, seconds*1000))
+
+
+def benchmark_batched_multi(opt):
+    # training throughput (forward, masked loss, backward, step) of Multi_site_model on pad_collate batches of
+    # random genes per batch size, tests/test_multi_site.py checks that padding leaves the predictions alone
+    import torch
+    from lstm_splicing_model import Multi_site_model, Lightning_module
+    from ragged_dataset import pad_collate
+
+    torch.manual_seed(42)
+    rng = np.random.default_rng(42)
+    marks = opt.input_channel-4
+    window = 2*opt.window
+
+    def gene():
+        sites = int(rng.integers(1, opt.max_sites+1))
+        x = {"DNA_seq":torch.from_numpy(rng.integers(0, 5, (sites, window)).astype(np.uint8)),
+             "histone_mark":torch.from_numpy(rng.random((sites, marks, window), dtype=np.float32)),
+             "raw_seq":torch.zeros((sites, 1), dtype=torch.int64),
+             "position":torch.from_numpy(np.sort(rng.integers(0, 50*sites, sites)).astype(np.float32))}
+        return {"x":x,"y":torch.from_numpy(rng.random(sites, dtype=np.float32))}
+
+    genes = [gene() for i in range(opt.num_genes)]
+    model = Multi_site_model(window, opt.input_channel, opt.hidden_size, dropout=0, outer_hidden_size=opt.embed_dim,
+                             do_attention=True, do_norm=True, relative_position=True)
+    real_sites = Lightning_module.real_sites
+
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    loss_func = torch.nn.BCELoss(reduction="sum")
+
+    def epoch(batch_size):
+        for start in range(0, len(genes), batch_size):
+            batch = pad_collate(genes[start:start+batch_size])
+            y_hat, y = real_sites(None, batch["x"], model(batch["x"]), batch["y"])
+            loss = loss_func(y_hat, y)/y.shape[0]
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+    print("{} genes of 1-{} sites, window {}, outer hidden size {}".format(opt.num_genes, opt.max_sites, window, opt.embed_dim))
+    for batch_size in opt.batch_sizes:
+        seconds = timeit(lambda: epoch(batch_size), opt.repeat)
+        print("batch size {:3d} {:8.1f} genes/s".format(batch_size, opt.num_genes/seconds))
+
+
+def benchmark_site_chunk(opt):
+    # peak memory and forward+backward time of one gene of num_sites sites through Multi_site_model per chunk
+    # size of the checkpointed single-site module, tests/test_multi_site.py checks the gradients
+    import torch
+    from lstm_splicing_model import Multi_site_model
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    rng = np.random.default_rng(42)
+    window = 2*opt.window
+    x = {"DNA_seq":torch.from_numpy(rng.integers(0, 5, (1, opt.num_sites, window)).astype(np.uint8)).to(device),
+         "histone_mark":torch.from_numpy(rng.random((1, opt.num_sites, opt.input_channel-4, window), dtype=np.float32)).to(device),
+         "raw_seq":torch.zeros((1, opt.num_sites, 1), dtype=torch.int64, device=device),
+         "position":torch.from_numpy(np.sort(rng.integers(0, 50*opt.num_sites, (1, opt.num_sites))).astype(np.float32)).to(device)}
+    torch.manual_seed(42)
+    model = Multi_site_model(window, opt.input_channel, opt.hidden_size, dropout=0, outer_hidden_size=opt.embed_dim,
+                             do_attention=True, do_norm=True).to(device)
+
+    def run(site_chunk):
+        model.site_chunk = site_chunk
+        model.zero_grad()
+        model(x).sum().backward()
+
+    print("gene of {} sites, window {}, hidden size {}, on {}".format(opt.num_sites, window, opt.hidden_size, device))
+    for site_chunk in opt.chunk_sizes:
+        memory = peak_memory(lambda: run(site_chunk))
+        seconds = timeit(lambda: run(site_chunk), opt.repeat)
+        print("chunk {:5s} peak {:8.1f} MB {:8.1f} ms".format(str(site_chunk) if site_chunk>0 else "off", memory, seconds*1000))
+
+
+def benchmark_sparse_attention(opt):
+    # Self_attention with relative positions limited to sites within attention_window bp or to the
+    # attention_neighbors nearest sites, against dense attention: how far the output of a randomly
+    # initialised layer deviates from dense, then peak memory and forward+backward time over gene sizes.
+    # The deviation is not an accuracy, sparse_accuracy compares trained models. tests/test_attention.py checks
+    # that sparse attention over every site is the dense one
+    import torch
+    from lstm_splicing_model import Self_attention
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    torch.manual_seed(42)
+    attention = Self_attention(opt.embed_dim, opt.heads, False, True).to(device)
+    modes = [("dense",0,0),("{} bp".format(opt.attention_window),opt.attention_window,0),
+             ("{} nearest".format(opt.attention_neighbors),0,opt.attention_neighbors)]
+
+    def run(x, position):
+        attention.zero_grad()
+        output = attention(x, x, x, position)[0]
+        output.sum().backward()
+        return output.detach()
+
+    print("embed_dim {}, {} heads, {} bp mean site spacing, forward+backward on {}".format(opt.embed_dim, opt.heads, opt.site_spacing, device))
+    print("deviation: mean |sparse-dense| / mean |dense| of the randomly initialised layer's output")
+    for sites in opt.site_counts:
+        x = torch.randn(sites, opt.embed_dim, device=device, requires_grad=True)
+        position = torch.cumsum(torch.empty(1, sites, device=device).exponential_(1/opt.site_spacing), dim=1)
+        dense = None
+        for name, window, neighbors in modes:
+            attention.attention_window, attention.attention_neighbors = window, neighbors
+            try:
+                output = run(x, position)
+                memory = peak_memory(lambda: run(x, position))
+                seconds = timeit(lambda: run(x, position), opt.repeat)
+            except RuntimeError as error:
+                print("{:5d} sites {:12s} {}".format(sites, name, str(error).split("\n")[0]))
+                continue
+            if window==0 and neighbors==0:
+                dense = output
+            error = "" if dense is None or dense is output else "  deviation from dense (random init) {:.2e}".format(
+                ((output-dense).abs().mean()/dense.abs().mean()).item())
+            print("{:5d} sites {:12s} peak {:8.1f} MB {:9.2f} ms{}".format(sites, name, memory, seconds*1000, error))
+
+
+def benchmark_sparse_accuracy(opt):
+    # Multi_site_model trained on synthetic genes whose labels depend on the signal of the sites around each
+    # site (a kernel of --signal_range bp), with dense and with sparse outer attention. Held-out loss and
+    # Pearson r of the dense model, of the dense model run with sparse attention, and of models trained sparse
+    import torch
+    from lstm_splicing_model import Multi_site_model, Lightning_module
+    from ragged_dataset import pad_collate
+
+    rng = np.random.default_rng(42)
+    marks, window = opt.input_channel-4, 2*opt.window
+
+    def gene():
+        sites = int(rng.integers(opt.max_sites//2, opt.max_sites+1))
+        position = np.cumsum(rng.exponential(opt.site_spacing, sites))
+        signal = rng.standard_normal(sites)
+        kernel = np.exp(-np.abs(position[:,None]-position[None])/opt.signal_range)
+        y = 1/(1+np.exp(-2*(kernel@signal)/np.sqrt(kernel.sum(axis=1))))
+        histone_mark = rng.random((sites, marks, window), dtype=np.float32)
+        histone_mark[:,0] = (signal[:,None]+3)/1.5
+        x = {"DNA_seq":torch.from_numpy(rng.integers(0, 5, (sites, window)).astype(np.uint8)),
+             "histone_mark":torch.from_numpy(histone_mark),
+             "raw_seq":torch.zeros((sites, 1), dtype=torch.int64),
+             "position":torch.from_numpy((position-position[0]).astype(np.float32))}
+        return {"x":x,"y":torch.from_numpy(y.astype(np.float32))}
+
+    train, test = [gene() for i in range(opt.num_genes)], [gene() for i in range(max(opt.num_genes//4, 8))]
+    real_sites = Lightning_module.real_sites
+    loss_func = torch.nn.BCELoss(reduction="sum")
+    modes = {"dense":(0,0),"{} bp".format(opt.attention_window):(opt.attention_window,0),
+             "{} nearest".format(opt.attention_neighbors):(0,opt.attention_neighbors)}
+
+    def set_mode(model, mode):
+        model.attention.attention_window, model.attention.attention_neighbors = modes[mode]
+
+    def fit(mode):
+        torch.manual_seed(42)
+        model = Multi_site_model(window, opt.input_channel, opt.hidden_size, dropout=0, outer_hidden_size=opt.embed_dim,
+                                 do_attention=True, do_norm=True, relative_position=True)
+        set_mode(model, mode)
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+        model.train()
+        for step in range(opt.train_steps):
+            start = step*opt.batch_sizes[0] % len(train)
+            batch = pad_collate(train[start:start+opt.batch_sizes[0]])
+            y_hat, y = real_sites(None, batch["x"], model(batch["x"]), batch["y"])
+            loss = loss_func(y_hat, y)/y.shape[0]
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        return model.eval()
+
+    def evaluate(model, mode):
+        set_mode(model, mode)
+        with torch.no_grad():
+            y_hat, y = [torch.cat(i) for i in zip(*[real_sites(None, i["x"], model(i["x"]), i["y"]) for i in [pad_collate([j]) for j in test]])]
+        return (loss_func(y_hat, y)/y.shape[0]).item(), np.corrcoef(y_hat[:,0].numpy(), y[:,0].numpy())[0,1], y_hat
+
+    print("{} training genes, {} held out, {}-{} sites {} bp apart, labels over a {} bp kernel, {} steps".format(
+        len(train), len(test), opt.max_sites//2, opt.max_sites, opt.site_spacing, opt.signal_range, opt.train_steps))
+    dense = fit("dense")
+    loss, r, y_dense = evaluate(dense, "dense")
+    print("{:34s} loss {:.4f} pearson {:.3f}".format("trained dense, run dense", loss, r))
+    for mode in list(modes)[1:]:
+        loss, r, y_hat = evaluate(dense, mode)
+        print("{:34s} loss {:.4f} pearson {:.3f} max |output-dense| {:.2e}".format("trained dense, run "+mode, loss, r, (y_hat-y_dense).abs().max().item()))
+        loss, r, y_hat = evaluate(fit(mode), mode)
+        print("{:34s} loss {:.4f} pearson {:.3f}".format("trained and run "+mode, loss, r))
+
+
+def benchmark_fused_attention(opt):
+    # CPU latency of Self_attention without positional terms through scaled_dot_product_attention and through
+    # its einsum path, tests/test_attention.py checks that the two agree
+    import torch
+    from lstm_splicing_model import Self_attention
+
+    def einsum_attention(attention, x, position, mask):
+        N, length = x.shape[:2]
+        V, K, Q = [linear(x).reshape(N, length, attention.num_heads, attention.head_dim)
+                   for linear in [attention.V_linear, attention.K_linear, attention.Q_linear]]
+        out = attention.dense_attention(V, K, Q, position, mask)
+        return attention.fc_out(out.reshape(N, length, attention.embed_dim))
+
+    torch.manual_seed(42)
+    attention = Self_attention(opt.embed_dim, opt.heads, False, False)
+    print("embed_dim {}, {} heads, on cpu with {} threads".format(opt.embed_dim, opt.heads, torch.get_num_threads()))
+    for sites in opt.site_counts:
+        x = torch.randn(1, sites, opt.embed_dim)
+        position = torch.sort(torch.rand(1, sites)*10000, dim=1)[0]
+        with torch.no_grad():
+            fused = timeit(lambda: attention(x, x, x, position), opt.repeat)
+            einsum = timeit(lambda: einsum_attention(attention, x, position, None), opt.repeat)
+        print("{:5d} sites einsum {:8.2f} ms fused {:8.2f} ms ({:.1f}x)".format(sites, einsum*1000, fused*1000, einsum/fused))
+
+
+benchmarks = {"tokenize":benchmark_tokenize,"import_time":benchmark_import_time,"compact_parity":benchmark_compact_parity,
+              "context":benchmark_context,"context_parity":benchmark_context_parity,"feature_cache":benchmark_feature_cache,"restricted_labels":benchmark_restricted_labels,"shared_memory":benchmark_shared_memory,"shared_histone":benchmark_shared_histone,"relative_attention":benchmark_relative_attention,
+              "batched_multi":benchmark_batched_multi,"site_chunk":benchmark_site_chunk,
+              "sparse_attention":benchmark_sparse_attention,"sparse_accuracy":benchmark_sparse_accuracy,"fused_attention":benchmark_fused_attention}
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="Parity checks and benchmarks of the data and model fast paths",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("benchmark", choices=list(benchmarks))
+    parser.add_argument("--chromosome", type=str, default="chr7")
+    parser.add_argument("--cell_type", type=str, default="GM12878")
+    parser.add_argument("--genome_distance", type=int, default=256)
+    parser.add_argument("--num_sites", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--module", type=str, default="lstm_splicing_model")
+    parser.add_argument("--budget", type=float, default=10.0)
+    parser.add_argument("--dense_dir", type=str, help="split directory of a dense ragged container")
+    parser.add_argument("--compact_dir", type=str, help="the same split converted with --encoding uint8 or float16")
+    parser.add_argument("--hidden_size", type=int, default=8)
+    parser.add_argument("--shared_name", type=str, default="lstm_splicing", help="--name of the running shared_store.py")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--embed_dim", type=int, default=64)
+    parser.add_argument("--heads", type=int, default=1)
+    parser.add_argument("--site_counts", type=int, nargs="+", default=[128,256,512,1024])
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1,4,8,16])
+    parser.add_argument("--num_genes", type=int, default=64)
+    parser.add_argument("--chunk_sizes", type=int, nargs="+", default=[0,16,64,256], help="0 runs all sites at once")
+    parser.add_argument("--max_sites", type=int, default=64)
+    parser.add_argument("--window", type=int, default=32, help="genome_distance of the synthetic genes")
+    parser.add_argument("--input_channel", type=int, default=19)
+    parser.add_argument("--attention_window", type=int, default=5000)
+    parser.add_argument("--attention_neighbors", type=int, default=64)
+    parser.add_argument("--site_spacing", type=float, default=200, help="mean bp between the synthetic sites")
+    parser.add_argument("--signal_range", type=float, default=1000, help="sparse_accuracy: bp scale of the label kernel")
+    parser.add_argument("--train_steps", type=int, default=300)
+    opt, unknown = parser.parse_known_args()
+    benchmarks[opt.benchmark](opt)
@@ -0,0 +1,75 @@
+import os
+from collections import OrderedDict
+from load_raw_data import bigwig_url
+
+
+class BigWigRegistry:
+    # pyBigWig handles keyed by (cell type, mark), opened on first use in the process that reads them.
+    # Handles inherited through a fork are dropped, not shared, and at most max_open stay open with the
+    # least recently used one closed first.
+    def __init__(self, max_open=32):
+        self.max_open = max_open
+        self.pid = os.getpid()
+        self.handles = OrderedDict()
+        self.opened = set()
+        self.forks = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.opens = 0
+        self.reopens = 0
+        self.closes = 0
+
+    def stats(self):
+        return {"pid":self.pid,"hits":self.hits,"opens":self.opens,"reopens":self.reopens,"closes":self.closes,
+                "forks":self.forks,"open_handles":len(self.handles),"max_open":self.max_open}
+
+    def _check_fork(self):
+        if os.getpid() != self.pid:
+            # the parent's handles share file offsets with it, the child starts over without closing them
+            self.pid = os.getpid()
+            self.handles = OrderedDict()
+            self.opened = set()
+            self.forks += 1
+            self.reset_stats()
+
+    def get(self, cell_type, histone):
+        self._check_fork()
+        key = (cell_type, histone)
+        if key in self.handles:
+            self.handles.move_to_end(key)
+            self.hits += 1
+            return self.handles[key]
+
+        import pyBigWig
+        self.handles[key] = pyBigWig.open(bigwig_url(cell_type, histone))
+        if key in self.opened:
+            self.reopens += 1
+        self.opened.add(key)
+        self.opens += 1
+        while len(self.handles) > self.max_open:
+            _, handle = self.handles.popitem(last=False)
+            handle.close()
+            self.closes += 1
+        return self.handles[key]
+
+    def tracks(self, cell_type):
+        return CellTracks(self, cell_type)
+
+    def close(self):
+        self._check_fork()
+        for handle in self.handles.values():
+            handle.close()
+            self.closes += 1
+        self.handles = OrderedDict()
+
+
+class CellTracks:
+    # the bws[mark] mapping load_histone_modification returns, backed by the registry
+    def __init__(self, registry, cell_type):
+        self.registry = registry
+        self.cell_type = cell_type
+
+    def __getitem__(self, histone):
+        return self.registry.get(self.cell_type, histone)
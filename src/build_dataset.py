@@ -0,0 +1,236 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import multiprocessing
+import numpy as np
+from train_val_partition import Train_Chromes, Valid_Chromes, Test_Chromes
+from load_raw_data import epi_dct_pvalue
+import generate_x
+import generate_y
+from args import get_args
+
+split_chromes = {"train":Train_Chromes,"valid":Valid_Chromes,"test":Test_Chromes}
+
+# Output layout, the one Single_site_module/Multi_site_module read:
+#   {out_dir}/{split}/{chrom}/{gene}.npz X (sites, marks+4, 2*genome_distance), Y, position, splicing_site_num, seq
+#                                        single-site shards are {gene}_{i}.npz, the gene's i-th site without the leading axis
+#   with --histone_context every shard also holds context (sites, marks, patch_num), binned marks over CL bases
+#   with --layout span, multi-site shards hold the merged union of the gene's windows once instead of X:
+#                                        span_dna (span,) uint8 int_dct codes, span_histone (marks, span) float16,
+#                                        window_start (sites,) in transcript orientation, Y, position, splicing_site_num, seq
+#   {out_dir}/{split}/manifest.jsonl     one line per finished gene with the content hashes of its inputs, the last
+#                                        line of a gene wins. A rebuild skips genes whose hashes match, rewrites only Y
+#                                        when just the labels changed, and rebuilds the rest
+
+
+def save_npz_atomic(url, **arrays):
+    # write next to the target and rename, a shard either exists complete or not at all
+    tmp_url = url[:-len(".npz")]+".tmp.npz"
+    np.savez(tmp_url, **arrays)
+    os.replace(tmp_url, url)
+
+
+def get_gene_context(opt, gene):
+    # {} or {"context": (sites, marks, patch_num)}
+    if not get_args().histone_context:
+        return {}
+    return {"context":generate_x.get_x_context(opt.cell_type,gene["chromosome"],gene["sites"],gene["strand"],get_args().CL,get_args().patch_num)}
+
+
+def get_gene_sample(opt, gene):
+    histone_mark, DNA_seq = generate_x.get_x_batch(opt.cell_type,gene["chromosome"],gene["sites"],opt.genome_distance,gene["strand"],np.uint8)
+    X = np.concatenate((histone_mark, DNA_seq), axis=1).astype(np.single)
+    Y = generate_y.get_y_batch(opt.cell_type,gene["chromosome"],gene["sites"],gene["strand"],get_args().task)
+    seq = generate_x.get_seq_batch(gene["chromosome"],gene["sites"],opt.genome_distance,gene["strand"])
+    return X, Y, seq
+
+
+def get_gene_span(opt, gene):
+    codes, histone_mark, window_start = generate_x.get_span(opt.cell_type,gene["chromosome"],gene["sites"],opt.genome_distance,gene["strand"])
+    Y = generate_y.get_y_batch(opt.cell_type,gene["chromosome"],gene["sites"],gene["strand"],get_args().task)
+    seq = generate_x.get_seq_batch(gene["chromosome"],gene["sites"],opt.genome_distance,gene["strand"])
+    # marks are clipped at 4, float16 keeps them to 2**-9
+    return codes, histone_mark.astype(np.float16), window_start, Y, seq
+
+
+def hash_inputs(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else json.dumps(part).encode())
+    return h.hexdigest()
+
+
+def feature_hash(opt, gene):
+    # everything X and seq are computed from: the bases under the windows, the bigWig files of the histone set,
+    # whether they were read through the dense store, and the window
+    sites = gene["sites"]
+    region = np.concatenate([np.frombuffer(generate_x.get_window(gene["chromosome"],int(i),int(j)), dtype=np.uint8)
+                             for i, j in zip(*generate_x.span_segments(sites,opt.genome_distance))])
+    histone_type_lst = generate_x.get_histone_type_lst()
+    bigwigs = [epi_dct_pvalue[opt.cell_type][i] for i in histone_type_lst]
+    parts = [region.tobytes(),histone_type_lst,bigwigs,generate_x.get_histone_backend(opt.cell_type),opt.genome_distance,opt.layout,
+             get_args().model,gene["chromosome"],gene["strand"],sites.tolist()]
+    if get_args().histone_context:
+        parts.append(["context",get_args().CL,get_args().patch_num])
+    return hash_inputs(*parts)
+
+
+def label_hash(opt, gene):
+    Y = generate_y.get_y_batch(opt.cell_type,gene["chromosome"],gene["sites"],gene["strand"],get_args().task)
+    return hash_inputs(np.ascontiguousarray(Y).tobytes(),get_args().task)
+
+
+def gene_shards(gene):
+    # named by the gene id, adding or removing a gene leaves the shards of the others where they are
+    if get_args().model=="multi":
+        return [os.path.join(gene["chromosome"], gene["gene"]+".npz")]
+    return [os.path.join(gene["chromosome"], "{}_{}.npz".format(gene["gene"], i)) for i in range(len(gene["sites"]))]
+
+
+def update_labels(opt, split, gene, shards):
+    # the feature channels are unchanged, only Y is rewritten
+    Y = generate_y.get_y_batch(opt.cell_type,gene["chromosome"],gene["sites"],gene["strand"],get_args().task)
+    for i, shard in enumerate(shards):
+        url = os.path.join(opt.out_dir, split, shard)
+        with np.load(url) as npzfile:
+            sample = {k: npzfile[k] for k in npzfile.files}
+        sample["Y"] = Y if get_args().model=="multi" else Y[i]
+        save_npz_atomic(url, **sample)
+
+
+def build_gene(task):
+    opt, split, gene_id, labels_only = task
+    gene = generate_y.get_gene_index(opt.cell_type).get(gene_id)
+    chrom_dir = os.path.join(opt.out_dir, split, gene["chromosome"])
+    os.makedirs(chrom_dir, exist_ok=True)
+
+    shards = gene_shards(gene)
+    if labels_only:
+        update_labels(opt, split, gene, shards)
+    elif opt.layout=="span":
+        codes, histone_mark, window_start, Y, seq = get_gene_span(opt, gene)
+        save_npz_atomic(os.path.join(opt.out_dir, split, shards[0]),span_dna=codes,span_histone=histone_mark,window_start=window_start,
+                        Y=Y,position=gene["sites"],splicing_site_num=len(gene["sites"]),seq=seq,**get_gene_context(opt, gene))
+    elif get_args().model=="multi":
+        X, Y, seq = get_gene_sample(opt, gene)
+        save_npz_atomic(os.path.join(opt.out_dir, split, shards[0]),X=X,Y=Y,position=gene["sites"],splicing_site_num=len(gene["sites"]),seq=seq,
+                        **get_gene_context(opt, gene))
+    else:
+        X, Y, seq = get_gene_sample(opt, gene)
+        context = get_gene_context(opt, gene)
+        for i, shard in enumerate(shards):
+            save_npz_atomic(os.path.join(opt.out_dir, split, shard),X=X[i],Y=Y[i],position=gene["sites"][i],splicing_site_num=1,seq=seq[i],
+                            **{k: v[i] for k, v in context.items()})
+    return split, gene_id, shards, len(gene["sites"])
+
+
+def read_manifest(url):
+    # gene -> its last record
+    records = {}
+    if os.path.exists(url):
+        with open(url) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    records[record["gene"]] = record
+    return records
+
+
+def get_tasks(opt, split, records):
+    # returns the tasks and the manifest records of every gene of the split, up to date ones are kept as they are
+    gene_index = generate_y.get_gene_index(opt.cell_type)
+    split_dir = os.path.join(opt.out_dir, split)
+    tasks = []
+    current = {}
+    skipped = 0
+    counts = {"unchanged":0,"labels":0,"full":0}
+    for chromosome in split_chromes[split]:
+        for gene_id in gene_index.genes(chromosomes=[chromosome]):
+            gene = gene_index.get(gene_id)
+            site_num = len(gene["sites"])
+            if get_args().model=="multi" and site_num>opt.max_sites:
+                skipped += 1
+                continue
+            shards = gene_shards(gene)
+            record = {"gene":gene_id,"shards":shards,"sites":site_num,"features":feature_hash(opt, gene),"labels":label_hash(opt, gene)}
+            old = records.get(gene_id)
+            built = old is not None and old["shards"]==shards and old.get("features")==record["features"] \
+                and all(os.path.exists(os.path.join(split_dir, i)) for i in shards)
+            if built and old.get("labels")==record["labels"]:
+                counts["unchanged"] += 1
+            elif built:
+                counts["labels"] += 1
+                tasks.append((opt, split, gene_id, True))
+            else:
+                counts["full"] += 1
+                tasks.append((opt, split, gene_id, False))
+            current[gene_id] = record
+    print("{}: {} genes unchanged, {} with new labels, {} to build, {} skipped with more than {} sites".format(
+        split, counts["unchanged"], counts["labels"], counts["full"], skipped, opt.max_sites))
+    return tasks, current
+
+
+def remove_stale_shards(opt, split, records, current):
+    # shards of genes that are gone or moved, and not reused by any current gene
+    keep = set(i for record in current.values() for i in record["shards"])
+    for record in records.values():
+        for shard in record["shards"]:
+            url = os.path.join(opt.out_dir, split, shard)
+            if shard not in keep and os.path.exists(url):
+                os.remove(url)
+
+
+def build(opt):
+    # labels, the gene index and the genome (hashed in the parent) are loaded once and shared with the
+    # forked workers, the histone tracks are opened lazily inside each worker
+    # only the label tables of the chromosomes of the selected splits are read
+    generate_y.restrict_chromosomes([i for split in opt.split for i in split_chromes[split]])
+    generate_y.get_gene_index(opt.cell_type)
+
+    for split in opt.split:
+        os.makedirs(os.path.join(opt.out_dir, split), exist_ok=True)
+        manifest_url = os.path.join(opt.out_dir, split, "manifest.jsonl")
+        records = read_manifest(manifest_url)
+        tasks, current = get_tasks(opt, split, records)
+        remove_stale_shards(opt, split, records, current)
+
+        # the manifest is rewritten with the genes that are up to date and the old records of genes that only need
+        # new labels, so an interrupted run resumes with the same decisions. Finished genes are appended
+        pending = {task[2]: task[3] for task in tasks}
+        done = [records[gene_id] if pending.get(gene_id) else current[gene_id] for gene_id in current if pending.get(gene_id) is not False]
+        with open(manifest_url+".tmp", "w") as manifest:
+            manifest.writelines(json.dumps(record)+"\n" for record in done)
+        os.replace(manifest_url+".tmp", manifest_url)
+
+        start = time.time()
+        site_total = 0
+        with open(manifest_url, "a") as manifest, multiprocessing.get_context("fork").Pool(opt.processes) as pool:
+            for i, (_, gene_id, shards, site_num) in enumerate(pool.imap_unordered(build_gene, tasks, chunksize=8)):
+                manifest.write(json.dumps(current[gene_id])+"\n")
+                manifest.flush()
+                site_total += site_num
+                if (i+1) % opt.report_every==0 or i+1==len(tasks):
+                    elapsed = time.time()-start
+                    print("{} {}/{} genes, {} sites, {:.1f} sites/s".format(split, i+1, len(tasks), site_total, site_total/max(elapsed, 1e-9)))
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="Build the per-gene npz training data in parallel, incremental and resumable from the manifest",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--out_dir", type=str, required=True)
+    parser.add_argument("--split", action="append", choices=list(split_chromes), help="split to build, repeat for several (default all)")
+    parser.add_argument("--cell_type", type=str, default="GM12878")
+    parser.add_argument("--genome_distance", type=int, default=256)
+    parser.add_argument("--max_sites", type=int, default=512)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--report_every", type=int, default=100)
+    parser.add_argument("--layout", choices=["window","span"], default="window", help="span: store the merged windows of each multi-site gene once, read through ragged_dataset.py")
+    # --task, --model and --histone are read from args.py
+    opt, unknown = parser.parse_known_args()
+    if opt.split is None:
+        opt.split = list(split_chromes)
+    assert get_args().task is not None and get_args().model is not None, "--task and --model are required"
+    assert opt.layout=="window" or get_args().model=="multi", "--layout span is for multi-site samples"
+    build(opt)
@@ -0,0 +1,116 @@
+import os
+import tempfile
+from collections import OrderedDict
+import numpy as np
+
+
+class FeatureCache:
+    # LRU cache of feature arrays with a byte budget. Entries evicted from memory can spill to
+    # memory-mapped slab files on disk, the spill tier drops its oldest slab when it runs out of room.
+    def __init__(self, max_bytes, spill_dir=None, spill_bytes=0, slab_bytes=None):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = OrderedDict()
+
+        # slabs of 256 MB by default, a smaller spill budget is a single slab of that size
+        if slab_bytes is None:
+            slab_bytes = min(1 << 28, spill_bytes) if spill_bytes > 0 else 1 << 28
+        if spill_dir is not None and 0 < spill_bytes < slab_bytes:
+            raise ValueError("spill_bytes {} is smaller than one slab of {} bytes".format(spill_bytes, slab_bytes))
+        self.spill_dir = spill_dir
+        self.slab_bytes = slab_bytes
+        self.num_slabs = spill_bytes // slab_bytes if spill_dir is not None else 0
+        self.slab_files = []
+        self.slabs = []
+        self.slab_keys = []
+        self.current_slab = 0
+        self.slab_used = 0
+        self.spilled = {}
+
+        self.hits = 0
+        self.spill_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.spills = 0
+
+    def stats(self):
+        return {"hits":self.hits,"spill_hits":self.spill_hits,"misses":self.misses,"evictions":self.evictions,
+                "spills":self.spills,"entries":len(self.entries),"bytes":self.nbytes,"spilled_entries":len(self.spilled),"hit_rate":self.hit_rate()}
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return tuple(np.array(i) for i in self.entries[key])
+        if key in self.spilled:
+            slab_id, arrays = self.spilled.pop(key)
+            self.slab_keys[slab_id].remove(key)
+            self.spill_hits += 1
+            # copied out before put can spill other entries over the slab
+            arrays = tuple(np.array(i) for i in arrays)
+            self.put(key, arrays)
+            return arrays
+        self.misses += 1
+        return None
+
+    def hit_rate(self):
+        lookups = self.hits+self.spill_hits+self.misses
+        return (self.hits+self.spill_hits)/lookups if lookups > 0 else 0.0
+
+    def put(self, key, arrays):
+        # arrays is a tuple of np.ndarray. The cache keeps a read-only copy and returns arrays as they are,
+        # get hands out a writable copy, so no caller can change what is cached
+        cached = tuple(np.array(i) for i in arrays)
+        for i in cached:
+            i.setflags(write=False)
+        size = sum(i.nbytes for i in cached)
+        if size > self.max_bytes:
+            return arrays
+        if key in self.entries:
+            self.nbytes -= sum(i.nbytes for i in self.entries.pop(key))
+        if key in self.spilled:
+            self.slab_keys[self.spilled.pop(key)[0]].remove(key)
+        self.entries[key] = cached
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            old_key, old_arrays = self.entries.popitem(last=False)
+            self.nbytes -= sum(i.nbytes for i in old_arrays)
+            self.evictions += 1
+            self._spill(old_key, old_arrays)
+        return arrays
+
+    def _spill(self, key, arrays):
+        size = sum(i.nbytes for i in arrays)
+        if self.num_slabs == 0 or size + 8*len(arrays) > self.slab_bytes:
+            return
+        if len(self.slabs) == 0 or self.slab_used + size + 8*len(arrays) > self.slab_bytes:
+            self._next_slab()
+        slab_id = self.current_slab
+        views = []
+        for i in arrays:
+            # keep every array 8-byte aligned inside the slab
+            self.slab_used = (self.slab_used+7)//8*8
+            view = np.ndarray(i.shape, dtype=i.dtype, buffer=self.slabs[slab_id], offset=self.slab_used)
+            view[...] = i
+            view.setflags(write=False)
+            views.append(view)
+            self.slab_used += i.nbytes
+        self.spilled[key] = (slab_id, tuple(views))
+        self.slab_keys[slab_id].add(key)
+        self.spills += 1
+
+    def _next_slab(self):
+        if len(self.slabs) < self.num_slabs:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            f = tempfile.NamedTemporaryFile(dir=self.spill_dir, suffix=".slab")
+            self.slab_files.append(f)
+            self.slabs.append(np.memmap(f, dtype=np.uint8, mode="w+", shape=(self.slab_bytes,)))
+            self.slab_keys.append(set())
+            self.current_slab = len(self.slabs)-1
+        else:
+            # reuse the oldest slab, everything spilled to it is dropped
+            self.current_slab = (self.current_slab+1) % self.num_slabs
+            for key in self.slab_keys[self.current_slab]:
+                del self.spilled[key]
+            self.slab_keys[self.current_slab] = set()
+        self.slab_used = 0
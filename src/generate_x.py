@@ -1,52 +1,138 @@
 import numpy as np
-from load_raw_data import load_histone_modification, load_genome,SPLICEBERT_PATH
-import numba as nb
-from transformers import AutoTokenizer, AutoModel, AutoModelForMaskedLM, AutoModelForTokenClassification
-from args import args
+from load_raw_data import load_genome,SPLICEBERT_PATH,HISTONE_STORE_PATH,histone_type_dct
+from histone_store import HistoneStore, is_histone_store, _clip
+from feature_cache import FeatureCache
+from bigwig_registry import BigWigRegistry
+from args import get_args
 
 
+# the genome and the tokenizer are loaded on first use, importing this module costs nothing
+_genome = None
+_tokenizer = None
 
-if args.histone == 'core':
-    histone_type_lst = ["H3K27me3","H3K36me3","H3K4me3","H3K4me1","H3K9me3"]
-elif args.histone == 'all':
-    histone_type_lst = ["H3K27me3","H3K36me3","H3K4me3","H3K4me1","H3K9me3","H3K27ac","H3K9ac","H3K79me2","H3K4me2","H4K20me1","H2A.Z","DNase","ATAC-seq","CTCF","POLR2A"]
-elif args.histone == 'none':
-    histone_type_lst = []
+def get_genome():
+    global _genome
+    if _genome is None:
+        _genome = load_genome()
+    return _genome
 
 
-genome = load_genome()
-tokenizer = AutoTokenizer.from_pretrained(SPLICEBERT_PATH)
+def get_tokenizer():
+    global _tokenizer
+    if _tokenizer is None:
+        from transformers import AutoTokenizer
+        _tokenizer = AutoTokenizer.from_pretrained(SPLICEBERT_PATH)
+    return _tokenizer
+
+
+def get_histone_type_lst():
+    return histone_type_dct[get_args().histone]
+
+
+def get_histone_backend(cell_type):
+    # "store" (float16 values of histone_store.py) or "bigwig", the two round the marks differently
+    if tempData.cell_type != cell_type:
+        tempData.set(cell_type)
+    return "store" if tempData.histone_store is not None else "bigwig"
+
+
+def __getattr__(name):
+    # keeps generate_x.genome, generate_x.tokenizer and generate_x.histone_type_lst working
+    if name == "genome":
+        return get_genome()
+    if name == "tokenizer":
+        return get_tokenizer()
+    if name == "histone_type_lst":
+        return get_histone_type_lst()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+# bigWig handles of every cell type, opened lazily per process, see bigwig_registry.py
+bigwig_registry = BigWigRegistry()
+
 class TempData:
+    # switching cell types is cheap: histone stores are kept per cell type and bigWig handles live in the registry
     def __init__(self):
         self.cell_type = None
         self.histone_modification = None
+        self.histone_store = None
+        self.histone_stores = {}
 
     def set(self, cell_type):
         self.cell_type = cell_type
-        self.histone_modification = load_histone_modification(cell_type)
+        if cell_type not in self.histone_stores:
+            self.histone_stores[cell_type] = HistoneStore(HISTONE_STORE_PATH, cell_type) if is_histone_store(HISTONE_STORE_PATH, cell_type) else None
+        self.histone_store = self.histone_stores[cell_type]
+        self.histone_modification = bigwig_registry.tracks(cell_type) if self.histone_store is None else None
 
 tempData = TempData()
 
-# @nb.jit
-def one_hot_encode_X(Xd):
-    # One-hot encoding of the inputs: 0 is for padding, and 1, 2, 3, 4 correspond # to A, C, G, T respectively.
-    IN_MAP = np.asarray([[0, 0, 0, 0],
+# opt-in cache in front of get_x_balance and get_seq, see enable_feature_cache
+feature_cache = None
+
+def enable_feature_cache(max_bytes,spill_dir=None,spill_bytes=0,slab_bytes=None):
+    global feature_cache
+    feature_cache = FeatureCache(max_bytes,spill_dir=spill_dir,spill_bytes=spill_bytes,slab_bytes=slab_bytes)
+    return feature_cache
+
+def enable_feature_cache_from_args():
+    # --feature_cache_mb, --spill_dir, --spill_mb and --slab_mb of args.py, nothing without --feature_cache_mb
+    args = get_args()
+    if args.feature_cache_mb<=0:
+        return None
+    return enable_feature_cache(args.feature_cache_mb<<20,spill_dir=args.spill_dir,spill_bytes=args.spill_mb<<20,
+                                slab_bytes=args.slab_mb<<20 if args.slab_mb>0 else None)
+
+#warning
+int_dct = {"N":0,"A":1,"C":2,"G":3,"T":4}
+# int_dct = {"N":0,"A":1,"T":2,"C":3,"G":4}
+
+# byte -> int_dct code, lowercase and U are accepted, N and the other IUPAC codes are 0 (padding)
+CODE_LUT = np.zeros(256, dtype=np.uint8)
+for base in "ACGT":
+    CODE_LUT[ord(base)] = int_dct[base]
+    CODE_LUT[ord(base.lower())] = int_dct[base]
+CODE_LUT[ord("U")] = CODE_LUT[ord("u")] = int_dct["T"]
+
+COMPLEMENT = bytes.maketrans(b"ACGTUNRYSWKMBDHVacgtunryswkmbdhv", b"TGCAANYRSWMKVHDBtgcaanyrswmkvhdb")
+STR_COMPLEMENT = str.maketrans("ACGTUNRYSWKMBDHVacgtunryswkmbdhv", "TGCAANYRSWMKVHDBtgcaanyrswmkvhdb")
+# byte -> byte of its complement, and -> int_dct code of its complement
+COMPLEMENT_LUT = np.frombuffer(bytes(range(256)).translate(COMPLEMENT), dtype=np.uint8)
+COMPLEMENT_CODE_LUT = CODE_LUT.take(COMPLEMENT_LUT)
+
+# One-hot encoding of the inputs: 0 is for padding, and 1, 2, 3, 4 correspond # to A, C, G, T respectively.
+IN_MAP = np.asarray([[0, 0, 0, 0],
                      [1, 0, 0, 0],
                      [0, 1, 0, 0],
                      [0, 0, 1, 0],
                      [0, 0, 0, 1]])
-    return IN_MAP[Xd.astype('int8')]
 
 
+def get_window(chromosome,start,end):
+    # raw bases of a window, a uint8 array from the genome store or a shared store, bytes from the FASTA dict
+    genome = get_genome()
+    if hasattr(genome, "fetch"):
+        return genome.fetch(chromosome,start,end)
+    return genome[chromosome][start:end].encode("ascii")
+
+
+def encode_bases(seq,strand="+"):
+    # str/bytes/uint8 array -> uint8 int_dct codes, the minus strand is a flipped view of the complement
+    if isinstance(seq, str):
+        seq = seq.encode("ascii")
+    seq = np.frombuffer(seq, dtype=np.uint8)
+    if strand=="+":
+        return CODE_LUT.take(seq)
+    return COMPLEMENT_CODE_LUT.take(seq)[::-1]
+
+
+def one_hot_encode_X(Xd,dtype=np.int64):
+    return IN_MAP.astype(dtype, copy=False).take(Xd, axis=0)
+
 
-# @nb.jit
 def reverse_sequence_lst(seq):
-    reverse_dct = {"A":"T","T":"A","G":"C","C":"G","N":"N"}
-    seq = seq[::-1]   
-    sequence_lst = list(seq)
-    for i in range(len(sequence_lst)):
-        sequence_lst[i] = reverse_dct[sequence_lst[i]]
-    return sequence_lst
+    if not isinstance(seq, str):
+        seq = bytes(seq).decode("ascii")
+    return list(seq.translate(STR_COMPLEMENT)[::-1])
 
 
 def reverse_histone_mark_lst(histone_mark_lst):
@@ -55,42 +141,47 @@ def reverse_histone_mark_lst(histone_mark_lst):
     return histone_mark_lst
 
 
-# @nb.jit
-def encode_sequence(sequence_lst):
+def encode_sequence(sequence_lst,dtype=np.int64):
+    # list of bases, str, bytes or uint8 codes -> (4, length) one-hot matrix (a transposed view)
+    if isinstance(sequence_lst, list):
+        sequence_lst = "".join(sequence_lst)
+    if isinstance(sequence_lst, (str, bytes)):
+        sequence_lst = encode_bases(sequence_lst)
+    return one_hot_encode_X(sequence_lst,dtype).T
 
-    #warning
-    int_dct = {"N":0,"A":1,"C":2,"G":3,"T":4}
-    # int_dct = {"N":0,"A":1,"T":2,"C":3,"G":4}
-    for i in range(len(sequence_lst)):
-        sequence_lst[i] = int_dct[sequence_lst[i]]
-        
-    seq = np.asarray(sequence_lst)
-    seq = one_hot_encode_X(seq)
-    seq = np.transpose(seq)
-    return seq
+def get_x_balance(cell_type,chromosome,site,genome_distance,strand,a,dtype=np.int64):
+    if feature_cache is None:
+        return _get_x_balance(cell_type,chromosome,site,genome_distance,strand,dtype)
+    key = ("x",cell_type,chromosome,site,strand,genome_distance,get_args().histone,np.dtype(dtype).str)
+    result = feature_cache.get(key)
+    if result is None:
+        result = _get_x_balance(cell_type,chromosome,site,genome_distance,strand,dtype)
+        if result is None:
+            return None
+        result = feature_cache.put(key,result)
+    return result
 
-def get_x_balance(cell_type,chromosome,site,genome_distance,strand,a):
+
+def _get_x_balance(cell_type,chromosome,site,genome_distance,strand,dtype):
     if tempData.cell_type != cell_type:
         tempData.set(cell_type)
     histone_modification = tempData.histone_modification
+    histone_type_lst = get_histone_type_lst()
     
-    seq = genome[chromosome][site-genome_distance:site+genome_distance]
-
-    if strand=="+":
-        
-        sequence_lst = list(seq)
-        # print("+")
-        # print(len(sequence_lst))
-        # print(sequence_lst[255-2:257+2])
-    elif strand=="-":
-        sequence_lst = reverse_sequence_lst(seq)
-        # print(sequence_lst[255-2:257+2])
-    else:
+    if strand not in ("+","-"):
         print("error strand")
         return None
-    DNA_seq = encode_sequence(sequence_lst)
+    seq = get_window(chromosome,site-genome_distance,site+genome_distance)
+    DNA_seq = encode_sequence(encode_bases(seq,strand),dtype)
     
 
+    if tempData.histone_store is not None:
+        # pre-clipped float16 block, a view of the memmap
+        histone_mark = tempData.histone_store.fetch(chromosome,site-genome_distance, site+genome_distance,histone_type_lst)
+        if strand=="-":
+            histone_mark = histone_mark[:,::-1]
+        return histone_mark,DNA_seq
+
     histone_mark_lst = []
     for i in histone_type_lst:
         one_histone = histone_modification[i].values(chromosome,site-genome_distance, site+genome_distance)
@@ -107,25 +198,232 @@ def get_x_balance(cell_type,chromosome,site,genome_distance,strand,a):
 
     return histone_mark,DNA_seq
 
+
+
+def get_span(cell_type,chromosome,sites,genome_distance,strand):
+    # per gene, cached when the feature cache is enabled
+    if feature_cache is None:
+        return _get_span(cell_type,chromosome,sites,genome_distance,strand)
+    sites = np.asarray(sites, dtype=np.int64)
+    key = ("span",cell_type,chromosome,strand,genome_distance,get_args().histone,sites.tobytes())
+    result = feature_cache.get(key)
+    if result is None:
+        result = _get_span(cell_type,chromosome,sites,genome_distance,strand)
+        if result is None:
+            return None
+        result = feature_cache.put(key,result)
+    return result
+
+
+def span_segments(sites,genome_distance):
+    # genomic [start, end) of the merged union of the sites' 2*genome_distance windows, in genome order
+    bounds = np.unique(np.asarray(sites, dtype=np.int64))
+    first = np.concatenate(([True], bounds[1:]-bounds[:-1] > 2*genome_distance))
+    last = np.concatenate((first[1:], [True]))
+    return bounds[first]-genome_distance, bounds[last]+genome_distance
+
+
+def _get_span(cell_type,chromosome,sites,genome_distance,strand):
+    # one gene's windows in transcript orientation, every track is read once over the union of the windows:
+    # base codes (span,), histone marks (marks, span) and the start of each site's 2*genome_distance window
+    # in the span. Overlapping windows are merged into segments placed one after the other, the introns
+    # between them are never read. On the - strand the span is reversed, so every window is still a
+    # contiguous slice of it
+    if tempData.cell_type != cell_type:
+        tempData.set(cell_type)
+    if strand not in ("+","-"):
+        print("error strand")
+        return None
+    histone_type_lst = get_histone_type_lst()
+
+    sites = np.asarray(sites, dtype=np.int64)
+    segment_starts, segment_ends = span_segments(sites,genome_distance)
+    offsets = np.concatenate(([0], np.cumsum(segment_ends-segment_starts)))
+    segment = np.searchsorted(segment_starts, sites-genome_distance, side="right")-1
+    starts = offsets[segment]+sites-genome_distance-segment_starts[segment]
+    length = int(offsets[-1])
+
+    seq = [np.frombuffer(get_window(chromosome,int(i),int(j)), dtype=np.uint8) for i, j in zip(segment_starts, segment_ends)]
+    lut = CODE_LUT if strand=="+" else COMPLEMENT_CODE_LUT
+    codes = lut.take(seq[0] if len(seq)==1 else np.concatenate(seq))
+
+    if tempData.histone_store is not None:
+        histone_mark = [tempData.histone_store.fetch(chromosome,int(i),int(j),histone_type_lst) for i, j in zip(segment_starts, segment_ends)]
+    else:
+        histone_mark = [np.asarray([tempData.histone_modification[k].values(chromosome,int(i),int(j),numpy=True) for k in histone_type_lst]).reshape(len(histone_type_lst),j-i)
+                        for i, j in zip(segment_starts, segment_ends)]
+        histone_mark = [_clip(i) for i in histone_mark]
+    # a single segment stays a view of the store
+    histone_mark = histone_mark[0] if len(histone_mark)==1 else np.concatenate(histone_mark, axis=1)
+
+    if strand=="-":
+        codes = codes[::-1]
+        histone_mark = histone_mark[:,::-1]
+        starts = length-2*genome_distance-starts
+    return codes,histone_mark,starts
+
+
+def get_x_batch(cell_type,chromosome,sites,genome_distance,strand,dtype=np.int64):
+    # all sites of one gene in a single pass: the (sites, channels, 2*genome_distance) windows are
+    # gathered from a sliding window view of the gene's span
+    span = get_span(cell_type,chromosome,sites,genome_distance,strand)
+    if span is None:
+        return None
+    codes, histone_mark, starts = span
+    window = 2*genome_distance
+
+    codes = np.lib.stride_tricks.sliding_window_view(codes, window)[starts]
+    # (sites, window, 4) -> (sites, 4, window)
+    DNA_seq = one_hot_encode_X(codes,dtype).transpose(0,2,1)
+    # (marks, sites, window) -> (sites, marks, window)
+    histone_mark = np.lib.stride_tricks.sliding_window_view(histone_mark, window, axis=1)[:,starts].transpose(1,0,2)
+
+    return histone_mark,DNA_seq
     
+def _bin_means(values,patch_num):
+    # (marks, CL) -> (marks, patch_num) means of equal bins
+    return values.reshape(values.shape[0],patch_num,-1).mean(axis=2,dtype=np.float32)
+
+
+def _bigwig_bins(bw,chromosome,start,end,nBins):
+    # nBins means of [start, end) with every base clipped at 4 first, as in the dense store. Uncovered and
+    # off-chromosome bases count as 4. A bin whose max is at most 4 needs no clipping and comes from the zoom
+    # levels, cov*mean+4*(1-cov) for a fraction cov of covered bases. The bases of the other bins are read with
+    # bw.values and clipped one by one; zoom-level maxima are never below the exact one, so none is missed
+    def stats(bin_start,bin_end,n):
+        mean = np.array(bw.stats(chromosome,bin_start,bin_end,type="mean",nBins=n), dtype=np.float64)
+        coverage = np.array(bw.stats(chromosome,bin_start,bin_end,type="coverage",nBins=n), dtype=np.float64)
+        peak = np.array(bw.stats(chromosome,bin_start,bin_end,type="max",nBins=n), dtype=np.float64)
+        coverage = np.nan_to_num(coverage)
+        means = coverage*np.nan_to_num(mean)+4*(1-coverage)
+        high = np.flatnonzero(peak > 4)
+        if len(high) > 0:
+            # one read of the whole range, bin_end-bin_start is a multiple of n
+            values = _clip(bw.values(chromosome,bin_start,bin_end,numpy=True)).reshape(n,-1)
+            means[high] = values[high].mean(axis=1)
+        return means
+
+    size = (end-start)//nBins
+    bins = np.full(nBins, 4, dtype=np.float64)
+    length = bw.chroms(chromosome) or 0
+    low, high = max(start,0), min(end,length)
+    if low >= high:
+        return bins
+    # bins entirely on the chromosome in one call, the at most two bins cut by a chromosome end on their own
+    first, last = -(-(low-start)//size), (high-start)//size
+    if first < last:
+        bins[first:last] = stats(start+first*size,start+last*size,last-first)
+    for i in {(low-start)//size, (high-start-1)//size}:
+        if first <= i < last:
+            continue
+        bin_start, bin_end = max(start+i*size,low), min(start+(i+1)*size,high)
+        fraction = (bin_end-bin_start)/size
+        bins[i] = fraction*stats(bin_start,bin_end,1)[0]+4*(1-fraction)
+    return bins
+
+
+def get_x_context(cell_type,chromosome,sites,strand,CL,patch_num):
+    # long-range context of every mark, (sites, marks, patch_num) means of CL/patch_num-base bins over the
+    # CL bases centred on each site, positions without coverage or off the chromosome count as 4. Both
+    # backends clip every base at 4 and then average: the dense store holds clipped bases, bigWig files are
+    # summarised through bw.stats and only read base by base in bins holding values above 4. The two agree
+    # up to the float16 rounding of the store and the zoom level summaries
+    if tempData.cell_type != cell_type:
+        tempData.set(cell_type)
+    if strand not in ("+","-"):
+        print("error strand")
+        return None
+    assert CL % patch_num == 0, "CL must be a multiple of patch_num"
+    histone_type_lst = get_histone_type_lst()
+    context = np.empty((len(sites),len(histone_type_lst),patch_num), dtype=np.float32)
+
+    for n, site in enumerate(np.asarray(sites, dtype=np.int64)):
+        start = int(site)-CL//2
+        end = start+CL
+        if tempData.histone_store is not None:
+            # the fetched block stops at the end of the chromosome
+            block = tempData.histone_store.fetch(chromosome,max(start,0),end,histone_type_lst)
+            values = np.full((len(histone_type_lst),CL), 4, dtype=np.float32)
+            values[:,max(0,-start):max(0,-start)+block.shape[1]] = block
+            context[n] = _bin_means(values,patch_num)
+        else:
+            for row, i in enumerate(histone_type_lst):
+                context[n,row] = _bigwig_bins(tempData.histone_modification[i],chromosome,start,end,patch_num)
+    if strand=="-":
+        context = context[:,:,::-1]
+    return context
+
+
 def get_original_seq(chromosome,site,genome_distance,strand):
 
-    seq = genome[chromosome][site-genome_distance:site+genome_distance]
+    seq = get_genome()[chromosome][site-genome_distance:site+genome_distance]
 
     if strand=="+":
         return seq
     elif strand=="-":
-        sequence_lst = reverse_sequence_lst(seq)
-        return "".join(sequence_lst)
+        return seq.translate(STR_COMPLEMENT)[::-1]
     else:
         print("error strand")
         return None
-def get_seq(chromosome,site,genome_distance,strand):
+def get_seq_hf(chromosome,site,genome_distance,strand):
+    # reference path through the HuggingFace tokenizer, get_seq must return the same ids
     seq = get_original_seq(chromosome,site,genome_distance,strand)
     seq = ' '.join(list(seq.upper().replace("U", "T"))) # U -> T and add whitespace
-    input_ids = tokenizer.encode(seq) # warning: a [CLS] and a [SEP] token will be added to the start and the end of seq
+    input_ids = get_tokenizer().encode(seq) # warning: a [CLS] and a [SEP] token will be added to the start and the end of seq
     return input_ids
 
 
-    
+token_lut = None
+
+def get_token_lut():
+    # byte -> SpliceBERT token id, every character is sent once through the same upper/U->T/tokenizer path as get_seq_hf
+    global token_lut
+    if token_lut is None:
+        tokenizer = get_tokenizer()
+        token_lut = np.full(256, tokenizer.unk_token_id, dtype=np.int64)
+        for byte in range(128):
+            char = chr(byte).upper().replace("U", "T")
+            if not char.strip():
+                continue
+            ids = tokenizer.encode(char, add_special_tokens=False)
+            if len(ids)==1:
+                token_lut[byte] = ids[0]
+    return token_lut
+
 
+def encode_token_batch(windows,strand="+"):
+    # (windows, length) uint8 ascii bases -> (windows, length+2) int64 ids with [CLS] and [SEP] added
+    lut = get_token_lut()
+    if strand=="-":
+        lut = lut.take(COMPLEMENT_LUT)
+        windows = windows[:,::-1]
+    input_ids = np.empty((windows.shape[0], windows.shape[1]+2), dtype=np.int64)
+    input_ids[:,0] = get_tokenizer().cls_token_id
+    input_ids[:,-1] = get_tokenizer().sep_token_id
+    input_ids[:,1:-1] = lut.take(windows)
+    return input_ids
+
+
+def get_seq_batch(chromosome,sites,genome_distance,strand):
+    if strand not in ("+","-"):
+        print("error strand")
+        return None
+    sites = np.asarray(sites, dtype=np.int64)
+    start = int(sites.min())-genome_distance
+    end = int(sites.max())+genome_distance
+    seq = np.frombuffer(get_window(chromosome,start,end), dtype=np.uint8)
+    windows = np.lib.stride_tricks.sliding_window_view(seq, 2*genome_distance)[sites-genome_distance-start]
+    return encode_token_batch(windows,strand)
+
+
+def get_seq(chromosome,site,genome_distance,strand):
+    key = ("seq",chromosome,site,strand,genome_distance)
+    result = feature_cache.get(key) if feature_cache is not None else None
+    if result is None:
+        input_ids = get_seq_batch(chromosome,[site],genome_distance,strand)
+        if input_ids is None:
+            return None
+        result = (input_ids[0],)
+        if feature_cache is not None:
+            result = feature_cache.put(key,result)
+    return result[0].tolist()
@@ -3,25 +3,38 @@ import pandas as pd
 import numba as nb
 
 from train_val_partition import Train_Chromes, Valid_Chromes, Test_Chromes, strands
+from load_raw_data import LABEL_STORE_PATH
+from label_store import is_label_store, load_table
 
 min_read = 10
 class TempData:
     def __init__(self):
         self.cell_type = None
         self.sse_file = None
+        # None loads every chromosome, see restrict_chromosomes
+        self.chromosomes = None
 
     def set(self, cell_type):
         self.cell_type = cell_type
+        if is_label_store(LABEL_STORE_PATH, cell_type):
+            # columnar cache, only the partitions of self.chromosomes are read
+            self.sse_file = load_table(LABEL_STORE_PATH,cell_type,"sse","Region","Strand",self.chromosomes)
+            self.fpkm_file = load_table(LABEL_STORE_PATH,cell_type,"fpkm","chromosome","strand",self.chromosomes)
+            print("load sse from label store ",self.sse_file.shape)
+            self.build_index()
+            return
+
         if cell_type == "GM12878":
             
             sse_file_url= '/rhome/ghao004/bigdata/lstm_splicing/process_data/bams/GM12878.filtered.SpliSER.tsv'
             fpkm_file_url= '/rhome/ghao004/bigdata/esprnn/detailed_fpkm.csv'
             self.fpkm_file = pd.read_csv(fpkm_file_url,sep=',')
             self.sse_file = pd.read_csv(sse_file_url,sep='\t')
-            self.sse_file = self.sse_file.loc[(self.sse_file['Region'].isin(Train_Chromes+Valid_Chromes+Test_Chromes)) & (self.sse_file['Strand'].isin(strands))]
+            self.sse_file = self.sse_file.loc[(self.sse_file['Region'].isin(self.chromosomes or Train_Chromes+Valid_Chromes+Test_Chromes)) & (self.sse_file['Strand'].isin(strands))]
             print("before filtering sse ",self.sse_file.shape)
             self.sse_file = self.sse_file.dropna(subset=['Gene'])
             print("after filtering sse ",self.sse_file.shape)
+            self.build_index()
 
 
         if cell_type=="HepG2":
@@ -29,55 +42,181 @@ class TempData:
 
 
 
+    def build_index(self):
+        # reg: (chromosome, site, strand) -> SSE, nan when read_count < 20, None when the site matches several rows
+        # cls: (chromosome, site, strand) -> max fpkm over rows whose site_start or site_end is the site
+        # both are also kept per (chromosome, strand) as sorted site arrays for get_y_batch
+        # sse_file is a DataFrame or a label_store.LabelTable, whose columns are read one at a time
+        sse_file = self.sse_file
+        if "read_count" in sse_file:
+            read_count = sse_file["read_count"]
+        else:
+            read_count = sse_file["alpha_count"]+sse_file["beta1_count"]+sse_file["beta2Simple_count"]
+        sse = pd.DataFrame({"chromosome":np.asarray(sse_file["Region"]),"strand":np.asarray(sse_file["Strand"]),"site":np.asarray(sse_file["Site"]),
+                            "y":np.where(np.asarray(read_count)>=20,sse_file["SSE"],np.nan),"Gene":np.asarray(sse_file["Gene"]),"row":np.arange(sse_file.shape[0])})
+        match_num = sse.groupby(["chromosome","site","strand"])["y"].transform("size").values
+        sse.loc[match_num>1,"y"] = np.inf
+        self.gene_index = GeneIndex(sse)
+        sse = sse.drop_duplicates(subset=["chromosome","site","strand"])
+        self.sse_index = dict(zip(zip(sse["chromosome"],sse["site"],sse["strand"]),[None if i==np.inf else i for i in sse["y"]]))
+        self.sse_sorted = self._sorted_index(sse)
+
+        fpkm_file = self.fpkm_file
+        if fpkm_file is None:
+            self.fpkm_index = {}
+            self.fpkm_sorted = {}
+            return
+        fpkm = pd.DataFrame({i: np.asarray(fpkm_file[i]) for i in ["chromosome","strand","site_start","site_end","fpkm"]})
+        fpkm = pd.concat([fpkm[["chromosome","strand","site_start","fpkm"]].rename(columns={"site_start":"site"}),
+                          fpkm[["chromosome","strand","site_end","fpkm"]].rename(columns={"site_end":"site"})])
+        fpkm = fpkm.groupby(["chromosome","site","strand"])["fpkm"].max().reset_index().rename(columns={"fpkm":"y"})
+        self.fpkm_index = dict(zip(zip(fpkm["chromosome"],fpkm["site"],fpkm["strand"]),fpkm["y"]))
+        self.fpkm_sorted = self._sorted_index(fpkm)
+
+    def attach(self, cell_type, gene_index, sse_sorted, fpkm_sorted):
+        # labels published by shared_store.py: no tables and no per-site dicts, get_y goes through the sorted arrays
+        self.cell_type = cell_type
+        self.sse_file = None
+        self.fpkm_file = None
+        self.gene_index = gene_index
+        self.sse_index = None
+        self.fpkm_index = None
+        self.sse_sorted = sse_sorted
+        self.fpkm_sorted = fpkm_sorted
+
+    def _sorted_index(self, table):
+        index = {}
+        for (chromosome, strand), rows in table.groupby(["chromosome","strand"]):
+            rows = rows.sort_values("site")
+            index[(chromosome,strand)] = (rows["site"].values.astype(np.int64), rows["y"].values.astype(np.float64))
+        return index
+
+
+class GeneIndex:
+    # gene -> contiguous block of its sites sorted by position, built once per cell type from the sse table
+    def __init__(self, sse):
+        sse = sse.sort_values(["Gene","site"], kind="stable")
+        self.gene_ids, starts = np.unique(sse["Gene"].values.astype(str), return_index=True)
+        self.offsets = np.append(starts, sse.shape[0])
+        self.chromosomes = sse["chromosome"].values[starts]
+        self.strands = sse["strand"].values[starts]
+        self.sites = sse["site"].values.astype(np.int64)
+        # reg label of each site, inf marks a site that matches several rows
+        self.y = sse["y"].values.astype(np.float64)
+        self.rows = sse["row"].values
+        self.gene_position = {gene_id:i for i, gene_id in enumerate(self.gene_ids)}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        # arrays as published by shared_store.py, used as they are without a copy
+        index = cls.__new__(cls)
+        for i in ["gene_ids","offsets","chromosomes","strands","sites","y","rows"]:
+            setattr(index, i, arrays[i])
+        index.gene_position = {gene_id:i for i, gene_id in enumerate(index.gene_ids.tolist())}
+        return index
+
+    def __len__(self):
+        return self.gene_ids.shape[0]
+
+    def block(self, gene_id):
+        i = self.gene_position[gene_id]
+        return slice(self.offsets[i], self.offsets[i+1])
+
+    def get(self, gene_id):
+        i = self.gene_position[gene_id]
+        block = slice(self.offsets[i], self.offsets[i+1])
+        sites = self.sites[block]
+        # same normalisation of position as the multi-site samples
+        position = np.absolute(sites-sites[0]).astype(np.single)
+        return {"gene":gene_id,"chromosome":self.chromosomes[i],"strand":self.strands[i],"sites":sites,"position":position,"y":self.y[block]}
+
+    def genes(self, chromosomes=None, shuffle=False, seed=42, rank=0, world_size=1):
+        # gene ids in index order or shuffled with a fixed seed, optionally only some chromosomes,
+        # then sharded round-robin so worker `rank` of `world_size` gets every world_size-th gene
+        selected = np.arange(len(self))
+        if chromosomes is not None:
+            selected = selected[np.isin(self.chromosomes, chromosomes)]
+        if shuffle:
+            selected = np.random.default_rng(seed).permutation(selected)
+        return self.gene_ids[selected[rank::world_size]]
+
+
 tempData = TempData()
+
+def restrict_chromosomes(chromosomes):
+    # e.g. restrict_chromosomes(Valid_Chromes) in a validation worker, the label tables of the other chromosomes are never read
+    tempData.chromosomes = chromosomes
+    tempData.cell_type = None
+
 def get_sse_by_gene_id(cell_type,gene_id):
     if tempData.cell_type != cell_type:
         tempData.set(cell_type)
     sse_file = tempData.sse_file
-    sse_row = sse_file.loc[(sse_file['Gene']==gene_id)]
+    if sse_file is None:
+        # shared_store.py publishes the gene index and the sorted labels, not the SpliSER table
+        raise RuntimeError("get_sse_by_gene_id needs the SpliSER table, which is not available when attached to a shared store")
+    # take reads only the gene's rows when sse_file is a LabelTable. The gene index holds them sorted by
+    # site, they are returned in file order like the rows of the table filtered by gene
+    if gene_id not in tempData.gene_index.gene_position:
+        return sse_file.take([])
+    sse_row = sse_file.take(np.sort(tempData.gene_index.rows[tempData.gene_index.block(gene_id)]))
     return sse_row
 
+
+def get_gene_index(cell_type):
+    if tempData.cell_type != cell_type:
+        tempData.set(cell_type)
+    return tempData.gene_index
+
 def get_y(cell_type,chromosome,site,strand,task):
     if tempData.cell_type != cell_type:
         tempData.set(cell_type)
+    if tempData.sse_index is None:
+        # attached to a shared store
+        return get_y_batch(cell_type,chromosome,[site],strand,task)[0]
 
 
     if task=="reg":
-        sse_file = tempData.sse_file
-        sse_row = sse_file.loc[(sse_file['Region']==chromosome)& (sse_file['Site']==site)& (sse_file['Strand']==strand)]
-
-        if (sse_row.shape)[0]==0:
+        if (chromosome,site,strand) not in tempData.sse_index:
             # print("region",chromosome,"site",site,"strand",strand,"not found in sse file")
-
-
             Y = 0
-        elif (sse_row.shape)[0]>1:
-            print("multiple match, error")
-            print(1/0)
-            return 
         else:
-            read_count = sse_row.iloc[0,:].loc["alpha_count"]+sse_row.iloc[0,:].loc["beta1_count"]+sse_row.iloc[0,:].loc["beta2Simple_count"]
-            # print("region",chromosome,"site",site,"strand",strand,"found")
-
-            if read_count>=20:
-                Y = sse_row.iloc[0,:].loc["SSE"]
-            else:
-                # print("region",chromosome,"site",site,"strand",strand,"has less than 20 reads")
-                # when read not enough, set sse to nan value
-                Y = np.NAN
+            Y = tempData.sse_index[(chromosome,site,strand)]
+            if Y is None:
+                print("multiple match, error")
+                print(1/0)
+                return
+            # when read not enough (< 20), sse is already a nan value in the index
 
     elif task=="cls":
-        fpkm_filtered1 = tempData.fpkm_file.loc[(tempData.fpkm_file['site_start']==site)|(tempData.fpkm_file['site_end']==site)]
-        fpkm_row = fpkm_filtered1.loc[(fpkm_filtered1['chromosome']==chromosome)& (fpkm_filtered1['strand']==strand)]
-
-
-        if fpkm_row.shape[0]==0:
-            Y = 0
+        fpkm_max = tempData.fpkm_index.get((chromosome,site,strand))
+        if fpkm_max is not None and fpkm_max>1:
+            Y = 1
         else:
-            fpkm_max = fpkm_row["fpkm"].max()
-            if fpkm_max>1:
-                Y = 1
-            else:
-                Y = 0
+            Y = 0
     return Y
 
+
+def get_y_batch(cell_type,chromosome,sites,strand,task):
+    # labels for an array of sites of one chromosome and strand, same semantics as get_y
+    if tempData.cell_type != cell_type:
+        tempData.set(cell_type)
+    sites = np.asarray(sites, dtype=np.int64)
+    index = tempData.sse_sorted if task=="reg" else tempData.fpkm_sorted
+    index_sites, index_y = index.get((chromosome,strand), (np.zeros(0,dtype=np.int64), np.zeros(0)))
+
+
+    y = np.zeros(sites.shape[0])
+    if index_sites.shape[0]>0:
+        position = np.minimum(np.searchsorted(index_sites, sites), index_sites.shape[0]-1)
+        found = index_sites[position]==sites
+        y[found] = index_y[position[found]]
+
+    if task=="reg":
+        if np.isinf(y).any():
+            print("multiple match, error")
+            print(1/0)
+            return
+        return y
+    # fpkm max > 1
+    return (y>1).astype(np.float64)
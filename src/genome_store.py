@@ -0,0 +1,159 @@
+import os
+import json
+import argparse
+import numpy as np
+
+# On-disk layout of a packed genome store (one directory):
+#   bases.bin   2-bit packed bases, 4 bases per byte, A=0 C=1 G=2 T=3, every chromosome
+#               starts on a byte boundary
+#   runs/       per chromosome side tables, memory-mapped like bases.bin:
+#                 {chrom}.other.npy  (k,3) int32 [start, end, ascii] runs of non-ACGT characters (N, IUPAC)
+#                 {chrom}.mask.npy   (k,2) int32 [start, end] soft-masked (lowercase) runs
+#   index.json  {chrom: {"offset": byte offset in bases.bin, "length": number of bases}}
+
+BASES = b"ACGT"
+
+_PACK_LUT = np.zeros(256, dtype=np.uint8)
+for _i, _b in enumerate(BASES):
+    _PACK_LUT[_b] = _i
+    _PACK_LUT[_b | 0x20] = _i
+
+# byte -> the 4 ascii bases it holds, first base in the two high bits
+_UNPACK_LUT = np.asarray(
+    [[BASES[(byte >> shift) & 3] for shift in (6, 4, 2, 0)] for byte in range(256)],
+    dtype=np.uint8)
+
+_IS_ACGT = np.zeros(256, dtype=bool)
+_IS_ACGT[np.frombuffer(b"ACGTacgt", dtype=np.uint8)] = True
+
+
+def _runs(flag):
+    # [start, end) of every run of True in a boolean array
+    edges = np.diff(np.concatenate(([0], flag.view(np.int8), [0])))
+    return np.stack((np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)), axis=1).astype(np.int64)
+
+
+def pack_sequence(sequence):
+    seq = np.frombuffer(sequence.encode("ascii") if isinstance(sequence, str) else sequence, dtype=np.uint8)
+    length = seq.shape[0]
+
+    codes = np.zeros((length + 3) // 4 * 4, dtype=np.uint8)
+    codes[:length] = _PACK_LUT[seq]
+    codes = codes.reshape(-1, 4)
+    packed = (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3]
+
+    # runs of non-ACGT characters, split wherever the character changes
+    idx = np.flatnonzero(~_IS_ACGT[seq])
+    breaks = np.flatnonzero((np.diff(idx) != 1) | (np.diff(seq[idx]) != 0)) + 1
+    starts = idx[np.concatenate(([0], breaks))] if idx.shape[0] > 0 else idx
+    ends = idx[np.concatenate((breaks - 1, [idx.shape[0] - 1]))] + 1 if idx.shape[0] > 0 else idx
+    other = np.stack((starts, ends, seq[starts]), axis=1)
+
+    mask = _runs((seq >= ord("a")) & (seq <= ord("z")))
+    return packed.astype(np.uint8), other.astype(np.int64), mask
+
+
+def convert_fasta(fasta_path, out_dir):
+    from Bio import SeqIO
+
+    os.makedirs(out_dir, exist_ok=True)
+    index = {}
+    os.makedirs(os.path.join(out_dir, "runs"), exist_ok=True)
+    offset = 0
+    with open(os.path.join(out_dir, "bases.bin.tmp"), "wb") as f:
+        for fasta in SeqIO.parse(open(fasta_path), "fasta"):
+            packed, other, mask = pack_sequence(str(fasta.seq))
+            f.write(packed.tobytes())
+            index[fasta.id] = {"offset": offset, "length": len(fasta.seq)}
+            np.save(os.path.join(out_dir, "runs", fasta.id + ".other.npy"), other.astype(np.int32))
+            np.save(os.path.join(out_dir, "runs", fasta.id + ".mask.npy"), mask.astype(np.int32))
+            offset += packed.shape[0]
+            print("packed " + fasta.id)
+
+    with open(os.path.join(out_dir, "index.json"), "w") as f:
+        json.dump(index, f)
+    # the base file is renamed last, so an existing bases.bin always belongs to a complete store
+    os.replace(os.path.join(out_dir, "bases.bin.tmp"), os.path.join(out_dir, "bases.bin"))
+    print("finish converting genome to " + out_dir)
+
+
+def is_genome_store(path):
+    return os.path.exists(os.path.join(path, "bases.bin")) and os.path.exists(os.path.join(path, "index.json"))
+
+
+class Chromosome:
+    # behaves like the str that load_genome() used to return for genome[chromosome]
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self.length = store.index[name]["length"]
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError("genome store only supports contiguous slices")
+        start, end, _ = key.indices(self.length)
+        return self.store.fetch(self.name, start, end).tobytes().decode("ascii")
+
+
+class GenomeStore:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "index.json")) as f:
+            self.index = json.load(f)
+        # read-only memmap, every process that opens the store shares the same page cache
+        self.bases = np.memmap(os.path.join(path, "bases.bin"), dtype=np.uint8, mode="r")
+        self.other = {}
+        self.mask = {}
+
+    def runs(self, table, chromosome):
+        # the side tables are memmapped on first use, so they are shared through the page cache as well
+        tables = self.other if table == "other" else self.mask
+        if chromosome not in tables:
+            tables[chromosome] = np.load(os.path.join(self.path, "runs", chromosome + "." + table + ".npy"), mmap_mode="r")
+        return tables[chromosome]
+
+    def keys(self):
+        return self.index.keys()
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, name):
+        return Chromosome(self, name)
+
+    def packed(self, chromosome, start, end):
+        # zero copy view of the packed bytes covering [start, end), plus the base offset in the first byte
+        offset = self.index[chromosome]["offset"]
+        return self.bases[offset + start // 4: offset + (end + 3) // 4], start % 4
+
+    def fetch(self, chromosome, start, end):
+        # ascii bases of [start, end) as a uint8 array, with N/IUPAC runs and soft-masking restored
+        length = self.index[chromosome]["length"]
+        start, end = max(start, 0), min(end, length)
+        if end <= start:
+            return np.zeros(0, dtype=np.uint8)
+        packed, shift = self.packed(chromosome, start, end)
+        seq = _UNPACK_LUT[packed].reshape(-1)[shift: shift + end - start]
+
+        other = self.runs("other", chromosome)
+        first, last = np.searchsorted(other[:, 1], start, side="right"), np.searchsorted(other[:, 0], end)
+        for run_start, run_end, char in other[first:last]:
+            seq[max(run_start, start) - start: min(run_end, end) - start] = char
+
+        mask = self.runs("mask", chromosome)
+        first, last = np.searchsorted(mask[:, 1], start, side="right"), np.searchsorted(mask[:, 0], end)
+        for run_start, run_end in mask[first:last]:
+            seq[max(run_start, start) - start: min(run_end, end) - start] |= 0x20
+        return seq
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a FASTA genome to a memory-mapped 2-bit packed store",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--fasta", type=str, default="/rhome/ghao004/bigdata/lstm_splicing/genome/GRCh38.primary_assembly.genome.fa")
+    parser.add_argument("--out", type=str, default="/rhome/ghao004/bigdata/lstm_splicing/genome/GRCh38.primary_assembly.genome.store")
+    args = parser.parse_args()
+    convert_fasta(args.fasta, args.out)
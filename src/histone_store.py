@@ -0,0 +1,112 @@
+import os
+import json
+import argparse
+import numpy as np
+
+# On-disk layout of a dense histone-track cache (one directory per cell type):
+#   {chrom}.npy   float16 (marks, chrom_length), already clipped with np.where(x < 4, x, 4)
+#   index.json    {"marks": [...], "chroms": {chrom: length}}
+# Marks are stored in histone_type_dct["all"] order, so the "core" set is a leading slice.
+
+CHUNK_SIZE = 1 << 24
+
+
+def _clip(values):
+    # same as get_x_balance, nan (no coverage) becomes 4
+    return np.where(values < 4, values, 4)
+
+
+def read_values(bw, chromosome, start, end):
+    # clipped values of [start, end) of one bigWig, bases past its end count as no coverage
+    bw_length = bw.chroms(chromosome) or 0
+    values = np.full(max(end - start, 0), np.nan)
+    if start < min(end, bw_length):
+        values[:min(end, bw_length) - start] = bw.values(chromosome, start, min(end, bw_length), numpy=True)
+    return _clip(values)
+
+
+def track_length(bws, marks, chromosome):
+    # the longest of the marks, None when no bigWig has the chromosome
+    lengths = [bws[i].chroms(chromosome) for i in marks]
+    lengths = [i for i in lengths if i is not None]
+    return max(lengths) if len(lengths) > 0 else None
+
+
+def decode_track(bws, marks, chromosome, track):
+    # fills a float16 (marks, length) array, on disk or in memory, CHUNK_SIZE bases at a time
+    for row, mark in enumerate(marks):
+        for start in range(0, track.shape[1], CHUNK_SIZE):
+            end = min(start + CHUNK_SIZE, track.shape[1])
+            track[row, start:end] = read_values(bws[mark], chromosome, start, end)
+
+
+def build_histone_store(cell_type, out_dir, chromosomes):
+    from load_raw_data import load_histone_modification, histone_type_dct
+
+    bws = load_histone_modification(cell_type)
+    marks = [i for i in histone_type_dct["all"] if i in bws]
+    cell_dir = os.path.join(out_dir, cell_type)
+    os.makedirs(cell_dir, exist_ok=True)
+
+    chroms = {}
+    for chromosome in chromosomes:
+        length = track_length(bws, marks, chromosome)
+        if length is None:
+            continue
+
+        tmp_url = os.path.join(cell_dir, chromosome + ".tmp.npy")
+        track = np.lib.format.open_memmap(tmp_url, mode="w+", dtype=np.float16, shape=(len(marks), length))
+        decode_track(bws, marks, chromosome, track)
+        track.flush()
+        del track
+        os.replace(tmp_url, os.path.join(cell_dir, chromosome + ".npy"))
+        chroms[chromosome] = length
+        print("cached histone marks of " + cell_type + " " + chromosome)
+
+    with open(os.path.join(cell_dir, "index.json"), "w") as f:
+        json.dump({"marks": marks, "chroms": chroms}, f)
+    print("finish caching histone marks to " + cell_dir)
+
+
+def is_histone_store(path, cell_type):
+    return os.path.exists(os.path.join(path, cell_type, "index.json"))
+
+
+class HistoneStore:
+    def __init__(self, path, cell_type):
+        self.cell_dir = os.path.join(path, cell_type)
+        with open(os.path.join(self.cell_dir, "index.json")) as f:
+            index = json.load(f)
+        self.marks = index["marks"]
+        self.chroms = index["chroms"]
+        self.tracks = {}
+
+    def rows(self, marks):
+        # slice when the requested marks are stored next to each other, so the lookup stays a view
+        rows = [self.marks.index(i) for i in marks]
+        if len(rows) == 0:
+            return slice(0, 0)
+        if rows == list(range(rows[0], rows[0] + len(rows))):
+            return slice(rows[0], rows[0] + len(rows))
+        return rows
+
+    def track(self, chromosome):
+        if chromosome not in self.tracks:
+            self.tracks[chromosome] = np.load(os.path.join(self.cell_dir, chromosome + ".npy"), mmap_mode="r")
+        return self.tracks[chromosome]
+
+    def fetch(self, chromosome, start, end, marks):
+        # (marks, end-start) float16 block, a strided view of the memmap for contiguous mark sets
+        return self.track(chromosome)[self.rows(marks), start:end]
+
+
+if __name__ == "__main__":
+    from load_raw_data import HISTONE_STORE_PATH
+    from train_val_partition import Train_Chromes, Valid_Chromes, Test_Chromes
+
+    parser = argparse.ArgumentParser(description="Decode bigWig histone tracks once into memory-mapped float16 arrays",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--cell_type", type=str, default="GM12878")
+    parser.add_argument("--out", type=str, default=HISTONE_STORE_PATH)
+    args = parser.parse_args()
+    build_histone_store(args.cell_type, args.out, Train_Chromes + Valid_Chromes + Test_Chromes)
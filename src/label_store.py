@@ -0,0 +1,134 @@
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+# On-disk layout of the label cache (one directory per cell type and table):
+#   {table}/{chrom}/{plus|minus}/{column}.npy   one array per kept column, tight dtypes
+#   {table}/index.json                          {"columns": {...}, "partitions": [[chrom, strand], ...]}
+# Only the columns get_y/get_sse_by_gene_id need are kept, and a reader that is restricted to some
+# chromosomes never opens the partitions of the others.
+
+strand_dirs = {"+":"plus","-":"minus"}
+
+sse_columns = {"Site":np.int32,"SSE":np.float32,"read_count":np.int32,"Gene":"S"}
+fpkm_columns = {"site_start":np.int32,"site_end":np.int32,"fpkm":np.float32}
+
+
+def _write_table(table, out_dir, chrom_column, strand_column, columns):
+    os.makedirs(out_dir, exist_ok=True)
+    partitions = []
+    for (chromosome, strand), rows in table.groupby([chrom_column,strand_column]):
+        if strand not in strand_dirs:
+            continue
+        partition_dir = os.path.join(out_dir, chromosome, strand_dirs[strand])
+        os.makedirs(partition_dir, exist_ok=True)
+        for column, dtype in columns.items():
+            values = rows[column].values
+            values = values.astype(str).astype("S") if dtype=="S" else values.astype(dtype)
+            np.save(os.path.join(partition_dir, column+".npy"), values)
+        partitions.append([chromosome,strand])
+    with open(os.path.join(out_dir, "index.json"), "w") as f:
+        json.dump({"columns":list(columns),"partitions":partitions}, f)
+
+
+def convert_label_tables(cell_type, sse_file_url, fpkm_file_url, out_dir):
+    from train_val_partition import Train_Chromes, Valid_Chromes, Test_Chromes, strands
+
+    sse_file = pd.read_csv(sse_file_url,sep='\t',usecols=["Region","Site","Strand","Gene","SSE","alpha_count","beta1_count","beta2Simple_count"])
+    sse_file = sse_file.loc[(sse_file['Region'].isin(Train_Chromes+Valid_Chromes+Test_Chromes)) & (sse_file['Strand'].isin(strands))]
+    sse_file = sse_file.dropna(subset=['Gene'])
+    sse_file["read_count"] = sse_file["alpha_count"]+sse_file["beta1_count"]+sse_file["beta2Simple_count"]
+    _write_table(sse_file, os.path.join(out_dir, cell_type, "sse"), "Region", "Strand", sse_columns)
+    print("cached sse table ", sse_file.shape)
+
+    if fpkm_file_url is not None:
+        fpkm_file = pd.read_csv(fpkm_file_url,sep=',',usecols=["chromosome","strand","site_start","site_end","fpkm"])
+        _write_table(fpkm_file, os.path.join(out_dir, cell_type, "fpkm"), "chromosome", "strand", fpkm_columns)
+        print("cached fpkm table ", fpkm_file.shape)
+
+
+def is_label_store(path, cell_type):
+    return os.path.exists(os.path.join(path, cell_type, "sse", "index.json"))
+
+
+class LabelTable:
+    # the memory-mapped columns of a table's partitions, nothing is copied until a caller asks for it:
+    # table[column] concatenates one column, table.take(rows) builds a DataFrame of those rows only
+    def __init__(self, chrom_column, strand_column, columns, partitions):
+        self.chrom_column = chrom_column
+        self.strand_column = strand_column
+        self.columns = [chrom_column, strand_column]+columns
+        # [(chromosome, strand, {column: memmap})]
+        self.partitions = partitions
+        self.offsets = np.cumsum([0]+[len(i[2][columns[0]]) for i in partitions])
+
+    @property
+    def shape(self):
+        return (int(self.offsets[-1]), len(self.columns))
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __contains__(self, column):
+        return column in self.columns
+
+    def _part(self, i, column, rows=None):
+        # one column of partition i, all of it or the given rows of the partition
+        chromosome, strand, columns = self.partitions[i]
+        if column in (self.chrom_column, self.strand_column):
+            length = self.offsets[i+1]-self.offsets[i] if rows is None else len(rows)
+            return np.full(length, chromosome if column==self.chrom_column else strand, dtype=object)
+        values = columns[column] if rows is None else columns[column][rows]
+        return values.astype(str).astype(object) if values.dtype.kind=="S" else np.array(values)
+
+    def __getitem__(self, column):
+        if column not in self.columns:
+            raise KeyError(column)
+        if len(self.partitions)==0:
+            return np.zeros(0, dtype=object)
+        return np.concatenate([self._part(i, column) for i in range(len(self.partitions))])
+
+    def take(self, rows):
+        # DataFrame of the given row numbers in the given order, read from the partitions that hold them
+        rows = np.asarray(rows, dtype=np.int64)
+        partition = np.searchsorted(self.offsets, rows, side="right")-1
+        frame = {}
+        for column in self.columns:
+            parts = [(partition==i, self._part(i, column, rows[partition==i]-self.offsets[i])) for i in np.unique(partition)]
+            values = np.empty(len(rows), dtype=parts[0][1].dtype if parts else object)
+            for selected, part in parts:
+                values[selected] = part
+            frame[column] = values
+        return pd.DataFrame(frame, index=rows)
+
+
+def load_table(path, cell_type, table, chrom_column, strand_column, chromosomes=None):
+    # LabelTable of the requested chromosomes only, its columns stay memory-mapped .npy files
+    table_dir = os.path.join(path, cell_type, table)
+    if not os.path.exists(os.path.join(table_dir, "index.json")):
+        return None
+    with open(os.path.join(table_dir, "index.json")) as f:
+        index = json.load(f)
+
+    partitions = []
+    for chromosome, strand in index["partitions"]:
+        if chromosomes is not None and chromosome not in chromosomes:
+            continue
+        partition_dir = os.path.join(table_dir, chromosome, strand_dirs[strand])
+        partitions.append((chromosome, strand, {i: np.load(os.path.join(partition_dir, i+".npy"), mmap_mode="r") for i in index["columns"]}))
+    return LabelTable(chrom_column, strand_column, index["columns"], partitions)
+
+
+if __name__ == "__main__":
+    from load_raw_data import LABEL_STORE_PATH
+
+    parser = argparse.ArgumentParser(description="Convert the SpliSER and FPKM tables to a chromosome-partitioned columnar cache",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--cell_type", type=str, default="GM12878")
+    parser.add_argument("--sse_file", type=str, default="/rhome/ghao004/bigdata/lstm_splicing/process_data/bams/GM12878.filtered.SpliSER.tsv")
+    parser.add_argument("--fpkm_file", type=str, default="/rhome/ghao004/bigdata/esprnn/detailed_fpkm.csv")
+    parser.add_argument("--out", type=str, default=LABEL_STORE_PATH)
+    args = parser.parse_args()
+    convert_label_tables(args.cell_type, args.sse_file, args.fpkm_file, args.out)
@@ -1,26 +1,36 @@
-import pyBigWig
-from Bio import SeqIO
 import numpy as np
-import random
-import pandas as pd
-import math
-import json
+from genome_store import GenomeStore, is_genome_store
 from train_val_partition import Train_Chromes, Valid_Chromes, Test_Chromes, strands
 epi_dct_pvalue = {"GM12878":{"H3K27me3":"ENCFF211VQW","H3K36me3":"ENCFF397UEP","H3K4me3":"ENCFF480KNX","H3K4me1":"ENCFF836XOQ","H3K9me3":"ENCFF952PCS","H3K9ac":"ENCFF688HLG","H3K27ac":"ENCFF798KYP","H3K4me2":"ENCFF213GVI","H3K79me2":"ENCFF667UBI","H4K20me1":"ENCFF073DJT","H2A.Z":"ENCFF992GSC","DNase":"ENCFF960FMM","ATAC-seq":"ENCFF667MDI","CTCF":"ENCFF637RGD","POLR2A":"ENCFF942TZX"},
 "HepG2":{"H3K27me3":"ENCFF942QHN","H3K36me3":"ENCFF094ZKB","H3K4me3":"ENCFF645ZUY","H3K4me1":"ENCFF554XSR","H3K9me3":"ENCFF125NHB"}}
 
+histone_type_dct = {"core":["H3K27me3","H3K36me3","H3K4me3","H3K4me1","H3K9me3"],
+"all":["H3K27me3","H3K36me3","H3K4me3","H3K4me1","H3K9me3","H3K27ac","H3K9ac","H3K79me2","H3K4me2","H4K20me1","H2A.Z","DNase","ATAC-seq","CTCF","POLR2A"],
+"none":[]}
+
 # "H3K27ac","H3K9ac","H3K79me2","H3K4me2","H4K20me1","H2A.Z"
 # epi_dct_pvalue_other = {"GM12878":{"H3K9ac":"ENCFF688HLG","H3K27ac":"ENCFF798KYP","H3K4me2":"ENCFF213GVI","H3K79me2":"ENCFF667UBI","H4K20me1":"ENCFF073DJT","H2A.Z":"ENCFF992GSC"}}
 
 
 SPLICEBERT_PATH = "/rhome/ghao004/bigdata/SpliceBERT/models/SpliceBERT-human.510nt"
+GENOME_PATH = "/rhome/ghao004/bigdata/lstm_splicing/genome/GRCh38.primary_assembly.genome.fa"
+# built once with: python genome_store.py --fasta GENOME_PATH --out GENOME_STORE_PATH
+GENOME_STORE_PATH = "/rhome/ghao004/bigdata/lstm_splicing/genome/GRCh38.primary_assembly.genome.store"
+# built once per cell type with: python histone_store.py --cell_type GM12878
+HISTONE_STORE_PATH = "/rhome/ghao004/bigdata/lstm_splicing/histone_store"
+# built once per cell type with: python label_store.py --cell_type GM12878
+LABEL_STORE_PATH = "/rhome/ghao004/bigdata/lstm_splicing/label_store"
+
+def bigwig_url(cell_name, histone, file_dct=epi_dct_pvalue):
+    return "/rhome/ghao004/bigdata/lstm_splicing/{cell_name}/{name_prefix}.bigWig".format(cell_name=cell_name,name_prefix=file_dct[cell_name][histone])
 
 def _load_histone_modification(cell_name, file_dct):
+    import pyBigWig
     # print(file_dct)
     
     histone_modification_dct = {}
     for histone in file_dct[cell_name]:
-        url = "/rhome/ghao004/bigdata/lstm_splicing/{cell_name}/{name_prefix}.bigWig".format(cell_name=cell_name,name_prefix=file_dct[cell_name][histone])
+        url = bigwig_url(cell_name, histone, file_dct)
         print("load data "+url)
         histone_modification_dct[histone] = pyBigWig.open(url)
     return histone_modification_dct
@@ -34,8 +44,15 @@ def load_histone_modification(cell_name):
     return bws
 
 def load_genome():
+    if is_genome_store(GENOME_STORE_PATH):
+        # memory-mapped packed store, genome[chromosome][start:end] still returns a str
+        genome = GenomeStore(GENOME_STORE_PATH)
+        print("finish loading genome store")
+        return genome
+
     #load everything
-    fasta_sequences = SeqIO.parse(open("/rhome/ghao004/bigdata/lstm_splicing/genome/GRCh38.primary_assembly.genome.fa"),'fasta')
+    from Bio import SeqIO
+    fasta_sequences = SeqIO.parse(open(GENOME_PATH),'fasta')
     genome = {}
     for fasta in fasta_sequences:
         name, sequence = fasta.id, str(fasta.seq)
@@ -1,26 +1,16 @@
-import os
 import torch
 from torch import nn
 import numpy as np
 import torch.nn.functional as F
-from torchvision import transforms
-from torch.utils.data import DataLoader, random_split
-from load_raw_data import SPLICEBERT_PATH
+from load_raw_data import SPLICEBERT_PATH, histone_type_dct
 import pytorch_lightning as pl
-from args import args
+from args import get_args
+from ragged_dataset import expand_features, expand_histone
 from torch.nn import init
-from scipy.stats import spearmanr, pearsonr
-from sklearn.metrics import average_precision_score
-import scipy.sparse as ss
-from torchmetrics.classification import BinaryAUROC,BinaryF1Score
-from torcheval.metrics.functional import binary_auprc
-from transformers import AutoTokenizer, AutoModel, AutoModelForMaskedLM, AutoModelForTokenClassification
-import mpl_scatter_density
-import matplotlib.pyplot as plt
-from astropy.visualization import LogStretch
-from astropy.visualization.mpl_normalize import ImageNormalize
-norm = ImageNormalize(vmin=0., vmax=200, stretch=LogStretch())
+from torch.utils.checkpoint import checkpoint
 import torch.nn.utils.prune as prune
+# transformers, scipy, torchmetrics, torcheval, matplotlib, mpl_scatter_density and astropy are imported
+# on the code paths that use them, so importing this module (every DataLoader worker, validate.py) stays cheap
 
 class ResidualBlock(pl.LightningModule):
     def __init__(self,in_channel,out_channel,kernel_size = 11,dilation = 1):
@@ -47,50 +37,94 @@ class ResidualBlock(pl.LightningModule):
         return x
   
     
+def context_size():
+    # width of the flattened binned histone context, 0 without --histone_context
+    if not get_args().histone_context:
+        return 0
+    return len(histone_type_dct[get_args().histone])*get_args().patch_num
+
+
+def add_context(output,histone_context):
+    # the binned context of every site is concatenated to its flattened window features
+    if not get_args().histone_context:
+        return output
+    histone_context = expand_histone(histone_context)
+    return torch.cat((output,torch.flatten(histone_context,start_dim=1)),dim=1)
+
+
 class Single_site_model(pl.LightningModule):
     def __init__(self,input_length,input_size,hidden_size,num_layers=3, dropout=None,model_type = "GRU",prune_ratio = 0):
         super().__init__() 
-        if args.single_site_type=="RNN":
+        if get_args().single_site_type=="RNN":
             if model_type=="GRU":
                 self.single_site_module = GRU_module(input_size,hidden_size,num_layers)
             if model_type=="LSTM":
                 self.single_site_module = LSTM_module(input_size,hidden_size,num_layers)
 
-        if args.single_site_type=="SpliceBERT":
+        if get_args().single_site_type=="SpliceBERT":
             self.single_site_module = SpliceBert_module(prune_ratio = prune_ratio)
 
-        self.linear1 = nn.Linear(hidden_size*input_length,1)
+        self.linear1 = nn.Linear(hidden_size*input_length+context_size(),1)
         init.kaiming_normal_(self.linear1.weight, mode='fan_in')
 
         self.sigmoid = nn.Sigmoid()
         self.dropout = nn.Dropout(p=dropout)
 
     def forward_single_site_model(self,x):
-
+        # compact ragged containers ship uint8 codes, they are expanded here on the model's device
+        x = expand_features(x)
         DNA_seq = x["DNA_seq"]
         histone_mark = x["histone_mark"]
         raw_seq = x["raw_seq"]
-        if args.single_site_type=="RNN":
+        if get_args().single_site_type=="RNN":
             rnn_input = torch.concatenate((histone_mark, DNA_seq), axis = 1)
             rnn_input = torch.transpose(rnn_input, 1, 2)
             return self.single_site_module(rnn_input)
-        if args.single_site_type=="SpliceBERT":
+        if get_args().single_site_type=="SpliceBERT":
             return self.single_site_module(raw_seq,histone_mark)
         return None
         
     def forward(self,x):
         output = self.forward_single_site_model(x)
         output = torch.flatten(output,start_dim=1)
+        output = add_context(output,x.get("histone_context"))
         output = self.dropout(output)
         output = self.linear1(output)
         output = self.sigmoid(output)
         return output
     
 
+def neighbor_range(position,mask,attention_window=0,attention_neighbors=0):
+    # the sites every site attends to in sparse attention as (N, Q_len) [start, end) ranges. position is sorted
+    # along the gene, so the sites within attention_window bp and the attention_neighbors nearest sites (and
+    # the site itself) are both a contiguous run of sites
+    N, length = position.shape
+    lengths = mask.sum(dim=1) if mask is not None else torch.full((N,),length,device=position.device)
+    site = torch.arange(length,device=position.device)
+    if attention_window>0:
+        position = position.contiguous()
+        start = torch.searchsorted(position,position-attention_window)
+        end = torch.searchsorted(position,position+attention_window,right=True)
+    else:
+        # of the runs of width sites that contain the site, the one with the smallest span holds its nearest sites
+        width = min(attention_neighbors+1,length)
+        start = (site[None,:,None]-torch.arange(width,device=position.device)).clamp(min=0)
+        start = torch.minimum(start,(lengths-width).clamp(min=0)[:,None,None])
+        end = (start+width-1).clamp(max=length-1)
+        span = torch.maximum(position[:,:,None]-position.gather(1,start.reshape(N,-1)).reshape(start.shape),
+                             position.gather(1,end.reshape(N,-1)).reshape(end.shape)-position[:,:,None])
+        start = start.gather(2,span.argmin(dim=2,keepdim=True))[...,0]
+        end = start+width
+    return start, torch.minimum(end,lengths[:,None])
+
+
 class Self_attention(nn.Module):
     
-    def __init__(self,embed_dim, num_heads,absolute_position,relative_position):
+    def __init__(self,embed_dim, num_heads,absolute_position,relative_position,attention_window=0,attention_neighbors=0):
         super(Self_attention, self).__init__()
+        # attention_window (bp) or attention_neighbors (sites) > 0: every site attends to its neighbours only
+        self.attention_window = attention_window
+        self.attention_neighbors = attention_neighbors
         self.num_heads = num_heads
         self.embed_dim = embed_dim
         self.head_dim = embed_dim // num_heads
@@ -118,13 +152,109 @@ class Self_attention(nn.Module):
         self.relative_position = relative_position
 
 
-    def forward(self,V,K,Q,position = None):
+    def dense_attention(self,V,K,Q,position,mask):
+        N, K_len, Q_len = K.shape[0], K.shape[1], Q.shape[1]
+        energy = torch.einsum("nqhd,nkhd->nhqk",[Q,K])    
+        if self.relative_position:
+            # shape: (N, 1, Q_len, K_len)
+            relative_position = torch.abs(position.reshape(N,1,Q_len,1)-position.reshape(N,1,1,K_len))
+            
+
+            # relative_position = torch.log(relative_position+1)
+            relative_position = torch.clamp(relative_position, min=0, max=5000)/5000
+
+
+            # K_relative_linear/V_relative_linear map the scalar distance r[q,k] to r[q,k]*w, so the relative
+            # terms factor into r*(Q.w_K) and (sum_k attention*r)*w_V without (N, num_head, Q_len, K_len, head_dims) tensors
+            relative_weight_K = self.K_relative_linear.weight.reshape(self.num_heads, self.head_dim)
+            relative_weight_V = self.V_relative_linear.weight.reshape(self.num_heads, self.head_dim)
+            # shape: (N, num_head, Q_len, K_len)
+            attention_relation = relative_position*torch.einsum("nqhd,hd->nhq",[Q,relative_weight_K])[...,None]
+            energy = energy+attention_relation
+
+        if mask is not None:
+            # padded sites are never attended to
+            energy = energy.masked_fill(~mask.reshape(N,1,1,K_len), float("-inf"))
+            
+
+        #query shape:(N, Q_len, num_head, head_dims)
+        #key shape:(N, K_len, num_head, head_dims)
+        #energy shape:(N, num_heads, Q_len, K_len)
+        attention = torch.softmax(energy / (self.embed_dim**(1/2)), dim=3)
         
-        # v.shape batch_size,length,dimention 
+        #out shape:(N, Q_len, num_head, head_dims)
+        out = torch.einsum("nhql,nlhd->nqhd",[attention, V])
         
-        N = 1  #how many example in one batch
+        if self.relative_position:
+            relative_attention = (attention*relative_position).sum(dim=3)
+            out = out+torch.einsum("nhq,hd->nqhd",[relative_attention,relative_weight_V])
+        return out
+
+    def fused_attention(self,V,K,Q,mask):
+        # without positional terms the attention is torch's fused kernel. It divides by head_dim**0.5, Q is
+        # rescaled so the energies are divided by embed_dim**0.5 like the einsum path (scale= needs torch 2.1)
+        if mask is not None:
+            mask = mask[:,None,None,:]
+        Q = Q*(self.embed_dim**(-1/2)*Q.shape[-1]**(1/2))
+        out = F.scaled_dot_product_attention(Q.transpose(1,2),K.transpose(1,2),V.transpose(1,2),attn_mask=mask)
+        return out.transpose(1,2)
+
+    def sparse_attention(self,V,K,Q,position,mask):
+        # block-sparse attention: blocks of consecutive query sites attend to the run of key sites that covers
+        # the neighbour ranges of all of them, and inside it only to their own range. Memory is
+        # O(Q_len*(width+block)) for neighbour ranges up to width sites instead of O(Q_len*K_len)
+        N, K_len, Q_len = K.shape[0], K.shape[1], Q.shape[1]
+        start, end = neighbor_range(position,mask,self.attention_window,self.attention_neighbors)
+        block = max(int((end-start).max()),16)
+        block_num = -(-Q_len//block)
+        padding = block_num*block-Q_len
+        # padded query sites repeat the last one and are cut off at the end
+        start, end = F.pad(start,(0,padding),mode="replicate"), F.pad(end,(0,padding),mode="replicate")
+        Q = F.pad(Q,(0,0,0,0,0,padding))
+        query_position = F.pad(position[:,None],(0,padding),mode="replicate")[:,0]
+        start, end = start.reshape(N,block_num,block), end.reshape(N,block_num,block)
+        Q = Q.reshape(N,block_num,block,self.num_heads,self.head_dim)
+        query_position = query_position.reshape(N,block_num,block)
+
+        #key index shape:(N, block_num, block_width)
+        block_start = start.min(dim=2).values
+        index = block_start[...,None]+torch.arange(int((end.max(dim=2).values-block_start).max()),device=Q.device)
+        valid = (index[:,:,None]>=start[...,None]) & (index[:,:,None]<end[...,None])
+        index = index.clamp(max=K_len-1)
+        batch = torch.arange(N,device=Q.device)[:,None,None]
+        if mask is not None:
+            valid = valid & mask[batch,index][:,:,None]
+        #key and value shape:(N, block_num, block_width, num_head, head_dims)
+        K, V = K[batch,index], V[batch,index]
+
+        #energy shape:(N, num_heads, block_num, block, block_width)
+        energy = torch.einsum("nbqhd,nbkhd->nhbqk",[Q,K])
+        if self.relative_position:
+            relative_position = torch.abs(query_position[...,None]-position[batch,index][:,:,None])[:,None]
+            relative_position = torch.clamp(relative_position, min=0, max=5000)/5000
+            relative_weight_K = self.K_relative_linear.weight.reshape(self.num_heads, self.head_dim)
+            relative_weight_V = self.V_relative_linear.weight.reshape(self.num_heads, self.head_dim)
+            energy = energy+relative_position*torch.einsum("nbqhd,hd->nhbq",[Q,relative_weight_K])[...,None]
+        energy = energy.masked_fill(~valid[:,None], float("-inf"))
+
+        attention = torch.softmax(energy / (self.embed_dim**(1/2)), dim=4)
+        out = torch.einsum("nhbqk,nbkhd->nbqhd",[attention, V])
+        if self.relative_position:
+            relative_attention = (attention*relative_position).sum(dim=4)
+            out = out+torch.einsum("nhbq,hd->nbqhd",[relative_attention,relative_weight_V])
+        return out.reshape(N,block_num*block,self.num_heads,self.head_dim)[:,:Q_len]
+
+    def forward(self,V,K,Q,position = None,mask = None):
+        
+        # v.shape batch_size,length,dimention or length,dimention for a single gene
+        # position shape (N, length), mask (N, length) True for the real sites of padded genes
         
-        V_len, K_len, Q_len = V.shape[0], K.shape[0], Q.shape[0]
+        unbatched = V.dim()==2
+        if unbatched:
+            V, K, Q = V[None], K[None], Q[None]
+        N = V.shape[0]  #how many example in one batch
+        
+        V_len, K_len, Q_len = V.shape[1], K.shape[1], Q.shape[1]
         
 
         V = self.V_linear(V)
@@ -134,15 +264,7 @@ class Self_attention(nn.Module):
         K = K.reshape(N, K_len,self.num_heads, self.head_dim)
         Q = Q.reshape(N, Q_len,self.num_heads, self.head_dim)
 
-        position = position[0]
-        max_distance = position[-1]-position[0]
-        # print("position shape")
-        # print(position.shape)
-        # print(max_distance.shape)
-        # print(position.dim())
-        # print(max_distance.dim())
-
-        assert position.dim()==1
+        position = position.reshape(N, K_len)
 
 
         if self.absolute_position:
@@ -158,41 +280,12 @@ class Self_attention(nn.Module):
             V = V + absolute_position_V
             K = K + absolute_position_K
            
-        energy = torch.einsum("nqhd,nkhd->nhqk",[Q,K])    
-        if self.relative_position:
-            temp1 = position.reshape(N,Q_len,1)
-            temp2 = position.reshape(N,1,K_len)
-            relative_position = torch.abs(temp1-temp2)
-            
-
-            # relative_position = torch.log(relative_position+1)
-            relative_position = torch.clamp(relative_position, min=0, max=5000)/5000
-
-
-            relative_position = relative_position.reshape(N, Q_len, K_len,1)
-            relative_position_V = self.V_relative_linear(relative_position)
-            relative_position_V = relative_position_V.reshape(N, Q_len, K_len,self.num_heads, self.head_dim)
-            relative_position_V = relative_position_V.permute(0,3,1,2,4)
-            relative_position_K = self.K_relative_linear(relative_position)
-            relative_position_K = relative_position_K.reshape(N, Q_len, K_len,self.num_heads, self.head_dim)
-            relative_position_K = relative_position_K.permute(0,3,1,2,4)
-            # shape: (N, num_head, Q_len, K_len, head_dims)
-            attention_relation = torch.einsum("nqhd,nhqjd->nhqj",[Q,relative_position_K])
-            energy = energy+attention_relation
-            
-
-        #query shape:(N, Q_len, num_head, head_dims)
-        #key shape:(N, K_len, num_head, head_dims)
-        #energy shape:(N, num_heads, Q_len, K_len)
-        attention = torch.softmax(energy / (self.embed_dim**(1/2)), dim=3)
-        
-        #out shape:(N, Q_len, num_head, head_dims)
-        out = torch.einsum("nhql,nlhd->nqhd",[attention, V])
-        
-        if self.relative_position:
-            attention = attention.reshape(N,self.num_heads, Q_len, K_len,1)
-            add_relative_V = attention*relative_position_V
-            out = out+(add_relative_V).sum(dim=3).permute(0,2,1,3)
+        if self.attention_window>0 or self.attention_neighbors>0:
+            out = self.sparse_attention(V,K,Q,position,mask)
+        elif self.relative_position or self.absolute_position:
+            out = self.dense_attention(V,K,Q,position,mask)
+        else:
+            out = self.fused_attention(V,K,Q,mask)
 
 
         #attention shape:(N,num_heads, Q_len, K_len)
@@ -201,8 +294,8 @@ class Self_attention(nn.Module):
         out = out.reshape(N,Q_len,self.embed_dim)
      
         out = self.fc_out(out)
-        out = torch.squeeze(out)
-        # print(torch.einsum("nqhd,nhqjd->nhqj",[Q,relative_position_K]).shape)
+        if unbatched:
+            out = out[0]
         return out,None
 
 
@@ -222,9 +315,14 @@ class RNN_module(pl.LightningModule):
         super().__init__() 
         self.rnn = nn.GRU(input_size,hidden_size,num_layers,batch_first=True)
         
-    def forward(self,x):
-
-        output, hn = self.rnn(x)
+    def forward(self,x,lengths=None):
+        # lengths: sites of every padded gene, the GRU runs over the packed genes and stops at their last site
+        if lengths is None or bool((lengths==x.shape[1]).all()):
+            output, hn = self.rnn(x)
+            return output
+        packed = nn.utils.rnn.pack_padded_sequence(x,lengths.cpu(),batch_first=True,enforce_sorted=False)
+        output, hn = self.rnn(packed)
+        output, _ = nn.utils.rnn.pad_packed_sequence(output,batch_first=True,total_length=x.shape[1])
         return output
 
 class LSTM_module(pl.LightningModule):
@@ -241,6 +339,7 @@ class LSTM_module(pl.LightningModule):
 class SpliceBert_module(pl.LightningModule):
     def __init__(self,prune_ratio = 0):
         super().__init__() 
+        from transformers import AutoModel
         self.model = AutoModel.from_pretrained(SPLICEBERT_PATH) 
         self.pruning_ratio = prune_ratio
         self.prune()
@@ -274,7 +373,7 @@ class SpliceBert_module(pl.LightningModule):
         # input (batch_size, 512)
         last_hidden_state = self.model(raw_seq).last_hidden_state # get hidden states from last layer
         #output (batch size, 512, 512)
-        if args.histone=="all":
+        if get_args().histone=="all":
             last_hidden_state = torch.cat((last_hidden_state,torch.transpose(histone_mark, 1, 2)),dim=2)
 
         
@@ -284,15 +383,17 @@ class SpliceBert_module(pl.LightningModule):
 
     
 class Multi_site_model(pl.LightningModule):
-    def __init__(self,input_length,input_size,hidden_size,num_layers=3,dropout=0,do_outer = "GRU",relative_position=False,absolute_position=False,outer_hidden_size = 4096,prune_ratio = 0,do_attention = False,do_norm = False):
+    def __init__(self,input_length,input_size,hidden_size,num_layers=3,dropout=0,do_outer = "GRU",relative_position=False,absolute_position=False,outer_hidden_size = 4096,prune_ratio = 0,do_attention = False,do_norm = False,site_chunk = 0,attention_window = 0,attention_neighbors = 0,sparse_attention2 = False,num_heads = 1):
         super().__init__()
         self.do_attention = do_attention
         self.do_norm = do_norm
         self.do_outer = do_outer
+        # >0: sites go through the single-site module and linear1 in checkpointed chunks of this many sites
+        self.site_chunk = site_chunk
         self.save_hyperparameters()
-        if args.single_site_type=="RNN":
+        if get_args().single_site_type=="RNN":
             self.single_site_module = GRU_module(input_size,hidden_size,num_layers)
-        if args.single_site_type=="SpliceBERT":
+        if get_args().single_site_type=="SpliceBERT":
             self.single_site_module = SpliceBert_module(prune_ratio = 0.2)
         
         self.dropout = nn.Dropout(p=dropout)
@@ -301,51 +402,73 @@ class Multi_site_model(pl.LightningModule):
         self.outer_rnn_module = RNN_module(outer_rnn_input_size,outer_rnn_hidden_size,num_layers=2)
         self.sigmoid = nn.Sigmoid()
         
-        self.linear1 = nn.Linear(hidden_size*input_length,outer_rnn_input_size)
+        self.linear1 = nn.Linear(hidden_size*input_length+context_size(),outer_rnn_input_size)
         self.linear = nn.Linear(outer_rnn_hidden_size,1)
         init.kaiming_normal_(self.linear1.weight, mode='fan_in')
         init.kaiming_normal_(self.linear.weight, mode='fan_in')
 
-        self.attention = Self_attention(embed_dim = outer_rnn_hidden_size, num_heads = 1,absolute_position = absolute_position,relative_position = relative_position)
-        self.attention2 = Self_attention(embed_dim = outer_rnn_hidden_size, num_heads = 1,absolute_position = False,relative_position = False)
+        self.attention = Self_attention(embed_dim = outer_rnn_hidden_size, num_heads = num_heads,absolute_position = absolute_position,relative_position = relative_position,
+                                        attention_window = attention_window,attention_neighbors = attention_neighbors)
+        # the neighbour restriction is for the position-aware layer, the position-free one stays dense unless sparse_attention2
+        self.attention2 = Self_attention(embed_dim = outer_rnn_hidden_size, num_heads = num_heads,absolute_position = False,relative_position = False,
+                                         attention_window = attention_window if sparse_attention2 else 0,
+                                         attention_neighbors = attention_neighbors if sparse_attention2 else 0)
 
         self.layer_norm = nn.LayerNorm(outer_rnn_hidden_size)
-    def forward_single_site_model(self,x):
-        DNA_seq = torch.squeeze(x["DNA_seq"],0)
-        histone_mark = torch.squeeze(x["histone_mark"],0)
-        raw_seq = torch.squeeze(x["raw_seq"],0)
-        # raw_seq = x["raw_seq"].squeeze()
-
-        # print(DNA_seq.shape)
-        # print(histone_mark.shape)
-        if args.single_site_type=="RNN":
+    def encode_sites(self,DNA_seq,histone_mark,raw_seq,histone_context=None):
+        # (sites, ...) -> (sites, outer_hidden_size)
+        if get_args().single_site_type=="RNN":
             rnn_input = torch.concatenate((histone_mark, DNA_seq), axis = 1)
             rnn_input = torch.transpose(rnn_input, 1, 2)
-            return self.single_site_module(rnn_input)
-        elif args.single_site_type=="SpliceBERT":
-            return self.single_site_module(raw_seq,histone_mark)
-        print(args.single_site_type)
-        return 1/0
+            output = self.single_site_module(rnn_input)
+        elif get_args().single_site_type=="SpliceBERT":
+            output = self.single_site_module(raw_seq,histone_mark)
+        output = torch.flatten(output,start_dim=1)
+        output = add_context(output,histone_context)
+        return self.linear1(output)
+
+    def forward_single_site_model(self,x,mask):
+        # the real sites of all genes of the batch as one (sites, ...) batch
+        x = expand_features(x)
+        inputs = [x["DNA_seq"][mask],x["histone_mark"][mask],x["raw_seq"][mask]]
+        if get_args().histone_context:
+            inputs.append(x["histone_context"][mask])
+        site_num = inputs[0].shape[0]
+        if self.site_chunk<=0 or site_num<=self.site_chunk:
+            return self.encode_sites(*inputs)
+
+        # the window activations of one chunk at a time are kept, checkpoint recomputes them in backward
+        chunks = []
+        for start in range(0,site_num,self.site_chunk):
+            chunk = [i[start:start+self.site_chunk] for i in inputs]
+            if torch.is_grad_enabled():
+                chunks.append(checkpoint(self.encode_sites,*chunk,use_reentrant=False))
+            else:
+                chunks.append(self.encode_sites(*chunk))
+        return torch.cat(chunks)
 
 
 
     def forward(self,x):
+        # x holds (genes, sites, ...) features and (genes, sites) positions, genes of different lengths are
+        # padded by pad_collate which adds the (genes, sites) x["mask"] of the real sites. Returns (genes, sites, 1)
 
         position = x["position"]
+        mask = x.get("mask")
+        site_mask = mask if mask is not None else torch.ones(position.shape,dtype=torch.bool,device=position.device)
+        lengths = mask.sum(dim=1) if mask is not None else None
 
-        x = self.forward_single_site_model(x)
-        
-        x = torch.flatten(x,start_dim=1)
-
-        x = self.linear1(x)
+        sites = self.forward_single_site_model(x,site_mask)
+        x = sites.new_zeros(site_mask.shape+sites.shape[1:])
+        x[site_mask] = sites
         
         if self.do_outer=="GRU":
-            x = self.outer_rnn_module(x)
+            x = self.outer_rnn_module(x,lengths)
         if self.do_attention:
-            attention,weights = self.attention(V = x, K = x,Q = x, position = position)      
+            attention,weights = self.attention(V = x, K = x,Q = x, position = position, mask = mask)      
             x = x+attention
             x = self.layer_norm(x)  
-            attention,weights = self.attention2(V = x, K = x,Q = x, position = position)
+            attention,weights = self.attention2(V = x, K = x,Q = x, position = position, mask = mask)
             x = x+attention   
             
         if self.do_norm:
@@ -428,7 +551,7 @@ class CNN_module2(pl.LightningModule):
         # super(CNN_module,self).__init__()
         super().__init__()
 
-        self.conv1 = nn.Conv1d(args.input_channel,conv_channel,1,padding = 'same')
+        self.conv1 = nn.Conv1d(get_args().input_channel,conv_channel,1,padding = 'same')
         self.residual_blocks = [ResidualBlock(in_channel, out_channel, a, b).cuda() for in_channel, out_channel,a, b in zip(in_channels, out_channels, W, AR)]
         
         
@@ -436,7 +559,7 @@ class CNN_module2(pl.LightningModule):
         self.convs = [nn.Conv1d(conv_channel,conv_channel,1,padding = 'same').cuda() for i in range(len(W)) if (((i+1) % 4 == 0) or ((i+1) == len(W)))]
         
         
-        if args.device=='cuda':
+        if get_args().device=='cuda':
             for i in self.residual_blocks:
                 i.cuda()
             for j in self.convs:
@@ -449,6 +572,7 @@ class CNN_module2(pl.LightningModule):
         self.sigmoid = nn.Sigmoid()
         
     def forward(self, x):
+        x = expand_features(x)
         DNA_seq = x["DNA_seq"]
         histone_mark = x["histone_mark"]
         x = torch.concatenate((histone_mark, DNA_seq), axis = 1)
@@ -497,7 +621,7 @@ class Lightning_module(pl.LightningModule):
     
     def on_train_start(self):
         print("-----------log hparams-------------")
-        self.logger.log_hyperparams(vars(args))
+        self.logger.log_hyperparams(vars(get_args()))
         # self.draw_graph()
     
     #log the computational graph at the beginning of the training
@@ -512,6 +636,7 @@ class Lightning_module(pl.LightningModule):
     #         return None
 
     def get_correlation(self,y_true, y_pred,epsilon = 0.000001):
+        from scipy.stats import spearmanr, pearsonr
         y_true= np.copy(y_true)
         y_pred_np = np.copy(y_pred)
         y_true = y_true.flatten()
@@ -600,6 +725,8 @@ class Lightning_module(pl.LightningModule):
         return count/len(result)
     
     def evaluate_site_cls(self,step_outputs, step_y):
+        from torchmetrics.classification import BinaryAUROC,BinaryF1Score
+        from torcheval.metrics.functional import binary_auprc
         print("Accuracy {:.6}".format(self._accuracy(step_outputs,step_y)))
         binaryAUROC = BinaryAUROC(thresholds=None)
         binaryF1 = BinaryF1Score()
@@ -625,6 +752,11 @@ class Lightning_module(pl.LightningModule):
 
         return {"spearman":rho[0], "pearson":pearson[0],"F1":0,"AUROC":0,"AUPRC":0,"y":y,"output":outputs}
     def scatter(self,output,target,filename):
+        import mpl_scatter_density
+        import matplotlib.pyplot as plt
+        from astropy.visualization import LogStretch
+        from astropy.visualization.mpl_normalize import ImageNormalize
+        norm = ImageNormalize(vmin=0., vmax=200, stretch=LogStretch())
         fig = plt.figure()
         ax = fig.add_subplot(1, 1, 1, projection='scatter_density')
         density= ax.scatter_density(target, output, norm=norm, cmap = plt.cm.viridis)
@@ -724,13 +856,20 @@ class Lightning_module(pl.LightningModule):
     def test_epoch_end(self,step_outputs):
         return self.validation_epoch_end(step_outputs)
 
+    def real_sites(self, x, *values):
+        # (genes, sites, ...) outputs, labels and weights of a multi-site batch -> (real sites, 1), padded
+        # sites of pad_collate batches are dropped so they add nothing to the loss
+        mask = x["mask"] if "mask" in x else torch.ones(x["position"].shape, dtype=torch.bool, device=x["position"].device)
+        values = [i[mask].reshape(-1, 1) for i in values]
+        return values if len(values)>1 else values[0]
+
     def training_step(self, batch, batch_idx):
 
         x, y= batch['x'],batch['y']
         y_hat = self(x)
         if self.multi_model:
             # print("multi-model")
-            y = torch.transpose(y, 0, 1)
+            y_hat, y = self.real_sites(x, y_hat, y)
         else:
             y = y[:, None]
 
@@ -738,7 +877,14 @@ class Lightning_module(pl.LightningModule):
         y_hat = torch.where(torch.isnan(y), torch.zeros_like(y), y_hat)
         y = torch.where(torch.isnan(y), torch.zeros_like(y), y)
 
-        loss = self.loss_func(y_hat, y)
+        if "weight" in batch:
+            # importance weights of the samples Label_aware_sampler subsampled
+            weight = batch["weight"][:, None]
+            if self.multi_model:
+                weight = self.real_sites(x, weight.expand(x["position"].shape))
+            loss = F.binary_cross_entropy(y_hat, y, weight=weight, reduction=self.loss_func.reduction)
+        else:
+            loss = self.loss_func(y_hat, y)
         self.log("train_loss_step", loss,on_step=True, on_epoch=False, prog_bar=True)
         self.log("train_loss", loss,on_step=False, on_epoch=True, prog_bar=True)
         
@@ -751,7 +897,7 @@ class Lightning_module(pl.LightningModule):
         x, y= batch['x'],batch['y']
         y_hat = self(x)
         if self.multi_model:
-            y = torch.transpose(y, 0, 1)
+            y_hat, y = self.real_sites(x, y_hat, y)
         else:
             y = y[:, None]
 
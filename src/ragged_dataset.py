@@ -0,0 +1,402 @@
+import os
+import re
+import json
+import glob
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Dataset, ConcatDataset, DataLoader, Sampler, default_collate
+import pytorch_lightning as pl
+
+# One container per split, every array is concatenated over all sites of all samples:
+#   dna.npy        (sites, 4, L) one-hot, or (sites, L) uint8 int_dct codes in the compact encodings
+#   histone.npy    (sites, marks, L), uint8 quantized or float16 in the compact encodings
+#   seq.npy        (sites, L+2) SpliceBERT token ids (int16 in the compact encodings), (sites, 1) zeros when the source had none
+#   y.npy          (sites,)
+#   position.npy   (sites,) genomic site
+#   context.npy    (sites, marks, patch_num) binned histone context, only for shards built with --histone_context
+#   offsets.npy    (samples+1,) sample i holds sites offsets[i]:offsets[i+1]
+#   meta.json      {"model": "single"|"multi", "encoding": "dense"|"uint8"|"float16", "layout": "window"|"span", "shards": [...]}
+#   label_index.npz  per sample: valid (non-NaN labels), zeros, hist (label histogram over [0, 1]),
+#                    weight (importance weight, 1/keep probability for all-zero samples), see label_index
+# The span layout (multi-site shards built with --layout span) stores the merged union of every gene's
+# windows once instead of one window per site, the (sites, channels, window) inputs are sliding window views
+# of it. Bases stay compact in every encoding, the dense one expands them when a sample is read:
+#   dna.npy           (bases,) uint8 codes, position-major
+#   histone.npy       (bases, marks), float16 or uint8 quantized
+#   span_offsets.npy  (samples+1,) sample i spans bases span_offsets[i]:span_offsets[i+1]
+#   window_start.npy  (sites,) start of the site's window inside its sample's span
+
+DNA_CHANNELS = 4
+arrays = ["dna","histone","seq","y","position"]
+# histone marks are clipped to [0, 4] in get_x_balance, uint8 stores them in steps of 4/255
+HISTONE_SCALE = 4/255
+encodings = ["dense","uint8","float16"]
+# share of the samples whose valid labels are all 0 that Label_aware_sampler keeps per epoch
+ZERO_KEEP = 0.1
+LABEL_BINS = 10
+
+
+def encode_dna(DNA_seq):
+    # (sites, 4, L) one-hot -> (sites, L) uint8 codes, 0 for padding/N
+    return np.einsum("scl,c->sl", DNA_seq, np.arange(1, DNA_CHANNELS+1)).astype(np.uint8)
+
+
+def encode_histone(histone_mark, encoding):
+    if encoding=="uint8":
+        # in float32, float16 marks (span shards) would round before the quantization
+        return np.rint(np.clip(np.asarray(histone_mark, dtype=np.single), 0, 4)/HISTONE_SCALE).astype(np.uint8)
+    return histone_mark.astype(np.float16)
+
+
+def expand_histone(histone_mark):
+    if histone_mark.dtype==torch.uint8:
+        return histone_mark.float()*HISTONE_SCALE
+    if histone_mark.dtype==torch.float16:
+        return histone_mark.float()
+    return histone_mark
+
+
+def expand_features(x):
+    # compact features back to what the models consume, works on CPU in collate or on the GPU in forward:
+    # uint8 DNA codes (..., L) -> float one-hot (..., 4, L), uint8/float16 histone marks and context -> float32,
+    # int16 token ids -> int64
+    x = dict(x)
+    DNA_seq = x["DNA_seq"]
+    if not DNA_seq.is_floating_point():
+        x["DNA_seq"] = F.one_hot(DNA_seq.long(), DNA_CHANNELS+1)[...,1:].transpose(-1,-2).float()
+    for i in ["histone_mark","histone_context"]:
+        if i in x:
+            x[i] = expand_histone(x[i])
+    if x["raw_seq"].dtype==torch.int16:
+        x["raw_seq"] = x["raw_seq"].long()
+    return x
+
+
+def expand_collate(batch):
+    batch = default_collate(batch)
+    batch["x"] = expand_features(batch["x"])
+    return batch
+
+
+def pad_sites(values, length, value=None):
+    # (sites, ...) -> (length, ...), filled with value or with copies of the last site when value is None
+    fill = (length-values.shape[0],)+tuple(values.shape[1:])
+    pad = values[-1:].expand(fill) if value is None else values.new_full(fill, value)
+    return torch.cat((values, pad))
+
+
+def pad_collate(batch):
+    # multi-site samples of genes with different site counts, padded to the longest gene of the batch: features
+    # with 0 (code 0 expands to an all-zero base), position with the gene's last position so it stays sorted,
+    # y with NaN. x["mask"] (genes, sites) marks the real sites for the attention, the outer GRU and the loss
+    length = max(sample["y"].shape[0] for sample in batch)
+    padded = []
+    for sample in batch:
+        x = {k: pad_sites(v, length, None if k=="position" else 0) for k, v in sample["x"].items()}
+        x["mask"] = torch.arange(length)<sample["y"].shape[0]
+        padded.append(dict(sample, x=x, y=pad_sites(sample["y"], length, float("nan"))))
+    return default_collate(padded)
+
+
+def shard_key(url):
+    # (chromosome, name) with the runs of digits compared as numbers: {gene}_{i}.npz in site order, and
+    # the numbered {n}.npz of older builds in shard order
+    name = re.split(r"(\d+)", os.path.basename(url)[:-len(".npz")])
+    return os.path.basename(os.path.dirname(url)), [int(i) if i.isdigit() else i for i in name]
+
+
+def npz_shards(split_dir):
+    # {chrom}/{gene}.npz or {chrom}/{gene}_{i}.npz sorted by chromosome and by name
+    shards = glob.glob(os.path.join(split_dir, "*", "*.npz"))
+    shards = [i for i in shards if not i.endswith(".tmp.npz")]
+    return sorted(shards, key=shard_key)
+
+
+def label_index(y, offsets, zero_keep=ZERO_KEEP):
+    # per-sample label counts: NaN labels (reads < 20) add no gradient, samples whose valid labels are all 0
+    # (site not in the SpliSER output, or cls negatives) dominate and are subsampled with weight 1/zero_keep
+    starts = offsets[:-1]
+    valid = np.add.reduceat(~np.isnan(y), starts).astype(np.int32)
+    zeros = np.add.reduceat(y==0, starts).astype(np.int32)
+    bins = np.clip((np.nan_to_num(y, nan=0)*LABEL_BINS).astype(np.int64), 0, LABEL_BINS-1)
+    sample = np.repeat(np.arange(len(starts)), np.diff(offsets))
+    hist = np.zeros((len(starts), LABEL_BINS), dtype=np.int32)
+    np.add.at(hist, (sample[~np.isnan(y)], bins[~np.isnan(y)]), 1)
+    weight = np.where((valid>0) & (zeros==valid), 1/zero_keep, 1).astype(np.float32)
+    return {"valid":valid,"zeros":zeros,"hist":hist,"weight":weight}
+
+
+def write_container(out_dir, out, offsets, meta):
+    for i in out:
+        out[i].flush()
+        os.replace(os.path.join(out_dir, i+".tmp.npy"), os.path.join(out_dir, i+".npy"))
+    np.save(os.path.join(out_dir, "offsets.npy"), offsets)
+    np.savez(os.path.join(out_dir, "label_index.npz"), **label_index(np.asarray(out["y"]), offsets, meta["zero_keep"]))
+    with open(os.path.join(out_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+
+def convert_span_npz(split_dir, out_dir, shards, encoding, zero_keep=ZERO_KEEP):
+    site_nums, span_lengths = [], []
+    for url in shards:
+        with np.load(url) as npzfile:
+            site_nums.append(npzfile["Y"].shape[0])
+            span_lengths.append(npzfile["span_dna"].shape[0])
+    offsets = np.concatenate(([0], np.cumsum(site_nums))).astype(np.int64)
+    span_offsets = np.concatenate(([0], np.cumsum(span_lengths))).astype(np.int64)
+
+    with np.load(shards[0]) as npzfile:
+        marks = npzfile["span_histone"].shape[0]
+        seq_length = npzfile["seq"].shape[1] if "seq" in npzfile else 1
+        context_shape = npzfile["context"].shape[1:] if "context" in npzfile else None
+        # the span ends with the last window
+        window = int(npzfile["span_dna"].shape[0]-npzfile["window_start"].max())
+    shapes = {"dna":(),"histone":(marks,),"seq":(seq_length,),"y":(),"position":(),"window_start":()}
+    dtypes = {"dna":np.uint8,"histone":np.float16,"seq":np.int64,"y":np.single,"position":np.int64,"window_start":np.int64}
+    if encoding!="dense":
+        dtypes.update({"histone":np.uint8 if encoding=="uint8" else np.float16,"seq":np.int16})
+    if context_shape is not None:
+        shapes["context"] = context_shape
+        dtypes["context"] = dtypes["histone"]
+    lengths = {i: int(offsets[-1]) for i in shapes}
+    lengths["dna"] = lengths["histone"] = int(span_offsets[-1])
+
+    os.makedirs(out_dir, exist_ok=True)
+    out = {i: np.lib.format.open_memmap(os.path.join(out_dir, i+".tmp.npy"), mode="w+", dtype=dtypes[i], shape=(lengths[i],)+shapes[i]) for i in shapes}
+    for n, url in enumerate(shards):
+        with np.load(url) as npzfile:
+            sample = {i: npzfile[i] for i in npzfile.files}
+        block, span = slice(offsets[n], offsets[n+1]), slice(span_offsets[n], span_offsets[n+1])
+        out["dna"][span] = sample["span_dna"]
+        out["histone"][span] = encode_histone(sample["span_histone"].T, "uint8" if encoding=="uint8" else "float16")
+        out["seq"][block] = sample["seq"] if "seq" in sample else 0
+        out["y"][block] = sample["Y"]
+        out["position"][block] = sample["position"]
+        out["window_start"][block] = sample["window_start"]
+        if "context" in out:
+            out["context"][block] = sample["context"] if encoding=="dense" else encode_histone(sample["context"], encoding)
+
+    np.save(os.path.join(out_dir, "span_offsets.npy"), span_offsets)
+    write_container(out_dir, out, offsets, {"model":"multi","encoding":encoding,"layout":"span","window":window,"context":"context" in out,"zero_keep":zero_keep,
+                                            "shards":[os.path.relpath(i, split_dir) for i in shards]})
+    print("converted {} samples, {} sites, {} bases to {}".format(len(shards), offsets[-1], span_offsets[-1], out_dir))
+
+
+def convert_npz(split_dir, out_dir, model, encoding="dense", zero_keep=ZERO_KEEP):
+    # two passes over the npz files: sizes first, then every array is copied into a preallocated memmap
+    shards = npz_shards(split_dir)
+    with np.load(shards[0]) as npzfile:
+        if "window_start" in npzfile.files:
+            assert model=="multi", "span shards hold multi-site samples"
+            return convert_span_npz(split_dir, out_dir, shards, encoding, zero_keep)
+    site_nums = []
+    for url in shards:
+        with np.load(url) as npzfile:
+            site_nums.append(1 if model=="single" else npzfile["Y"].shape[0])
+    offsets = np.concatenate(([0], np.cumsum(site_nums))).astype(np.int64)
+
+    with np.load(shards[0]) as npzfile:
+        X = npzfile["X"] if model=="multi" else npzfile["X"][None]
+        seq_length = (npzfile["seq"] if model=="multi" else npzfile["seq"][None]).shape[1] if "seq" in npzfile else 1
+        context_shape = npzfile["context"].shape[-2:] if "context" in npzfile else None
+    channels, length = X.shape[1], X.shape[2]
+
+    os.makedirs(out_dir, exist_ok=True)
+    shapes = {"dna":(DNA_CHANNELS,length),"histone":(channels-DNA_CHANNELS,length),"seq":(seq_length,),"y":(),"position":()}
+    dtypes = {"dna":X.dtype,"histone":X.dtype,"seq":np.int64,"y":np.single,"position":np.int64}
+    if encoding!="dense":
+        shapes["dna"] = (length,)
+        dtypes["dna"] = np.uint8
+        dtypes["histone"] = np.uint8 if encoding=="uint8" else np.float16
+        dtypes["seq"] = np.int16
+    if context_shape is not None:
+        shapes["context"] = context_shape
+        dtypes["context"] = dtypes["histone"]
+    out = {i: np.lib.format.open_memmap(os.path.join(out_dir, i+".tmp.npy"), mode="w+", dtype=dtypes[i], shape=(int(offsets[-1]),)+shapes[i]) for i in shapes}
+
+    for n, url in enumerate(shards):
+        with np.load(url) as npzfile:
+            sample = {i: npzfile[i] for i in npzfile.files}
+        if model=="single":
+            sample = {i: np.asarray(sample[i])[None] for i in sample}
+        block = slice(offsets[n], offsets[n+1])
+        if encoding=="dense":
+            out["dna"][block] = sample["X"][:,-DNA_CHANNELS:]
+            out["histone"][block] = sample["X"][:,:-DNA_CHANNELS]
+        else:
+            out["dna"][block] = encode_dna(sample["X"][:,-DNA_CHANNELS:])
+            out["histone"][block] = encode_histone(sample["X"][:,:-DNA_CHANNELS], encoding)
+        out["seq"][block] = sample["seq"] if "seq" in sample else 0
+        out["y"][block] = sample["Y"]
+        out["position"][block] = sample["position"]
+        if "context" in out:
+            out["context"][block] = sample["context"] if encoding=="dense" else encode_histone(sample["context"], encoding)
+
+    write_container(out_dir, out, offsets, {"model":model,"encoding":encoding,"layout":"window","context":"context" in out,"zero_keep":zero_keep,
+                                            "shards":[os.path.relpath(i, split_dir) for i in shards]})
+    print("converted {} samples, {} sites to {}".format(len(shards), offsets[-1], out_dir))
+
+
+class Ragged_site_dataset(Dataset):
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        with open(os.path.join(data_dir, "meta.json")) as f:
+            meta = json.load(f)
+        self.model = meta["model"]
+        self.encoding = meta.get("encoding", "dense")
+        self.layout = meta.get("layout", "window")
+        self.window = meta.get("window")
+        self.names = arrays+["context"] if meta.get("context") else arrays
+        self.offsets = np.load(os.path.join(data_dir, "offsets.npy"))
+        if self.layout=="span":
+            self.span_offsets = np.load(os.path.join(data_dir, "span_offsets.npy"))
+        self.arrays = None
+        # set by Ragged_site_module when training with Label_aware_sampler
+        self.weights = None
+
+    def __len__(self):
+        return self.offsets.shape[0]-1
+
+    def open(self):
+        # memmaps are opened in the process that reads them, after the DataLoader workers forked
+        if self.arrays is None:
+            names = self.names+["window_start"] if self.layout=="span" else self.names
+            self.arrays = {i: np.load(os.path.join(self.data_dir, i+".npy"), mmap_mode="r") for i in names}
+        return self.arrays
+
+    def get_sites(self, idx):
+        block = slice(self.offsets[idx], self.offsets[idx+1])
+        if self.layout=="window":
+            return {i: self.open()[i][block] for i in self.names}
+        sample = {i: self.open()[i][block] for i in self.names if i not in ("dna","histone")}
+        # (bases, ...) span -> (sites, ..., window), only the pages under the windows are read
+        span = slice(self.span_offsets[idx], self.span_offsets[idx+1])
+        starts = self.arrays["window_start"][block]
+        for i in ["dna","histone"]:
+            sample[i] = np.lib.stride_tricks.sliding_window_view(self.arrays[i][span], self.window, axis=0)[starts]
+        if self.encoding=="dense":
+            # (sites, window) codes -> (sites, 4, window) one-hot, what dense window containers hold
+            sample["dna"] = np.eye(DNA_CHANNELS+1, dtype=np.single)[sample["dna"]][...,1:].transpose(0,2,1)
+        return sample
+
+    def __getitem__(self, idx):
+        sample = self.get_sites(idx)
+        position = np.absolute(sample["position"]-sample["position"][0]).astype(np.single)
+        if self.encoding=="dense":
+            DNA_seq, histone_mark = sample["dna"].astype(np.single), sample["histone"].astype(np.single)
+        else:
+            # kept compact, expand_collate or the model's forward expands them
+            DNA_seq, histone_mark = np.array(sample["dna"]), np.array(sample["histone"])
+        x = {"DNA_seq":torch.from_numpy(DNA_seq),
+             "histone_mark":torch.from_numpy(histone_mark),
+             "raw_seq":torch.from_numpy(np.array(sample["seq"])),
+             "position":torch.from_numpy(position)}
+        if "context" in sample:
+            context = sample["context"].astype(np.single) if self.encoding=="dense" else np.array(sample["context"])
+            x["histone_context"] = torch.from_numpy(context)
+        y = torch.from_numpy(sample["y"].astype(np.single))
+        if self.model=="single":
+            x = {i: x[i][0] for i in x}
+            y = y[0]
+        if self.weights is not None:
+            return {"x":x,"y":y,"weight":torch.tensor(self.weights[idx])}
+        return {"x":x,"y":y}
+
+
+class Ragged_concat_dataset(ConcatDataset):
+    # the same split of several containers, one per --data_path, indexed one after the other
+    def __init__(self, datasets):
+        super().__init__(datasets)
+        models = set(i.model for i in datasets)
+        if len(models)>1:
+            raise ValueError("containers of different models: "+", ".join(i.data_dir for i in datasets))
+        self.model = datasets[0].model
+
+
+class Label_aware_sampler(Sampler):
+    # each epoch: samples without a valid label are dropped, samples whose valid labels are all 0 are kept
+    # with probability 1/weight (their stored importance weight), the rest always, all in a seeded shuffle.
+    # data_dir is a container or a list of them in Ragged_concat_dataset order
+    def __init__(self, data_dir, seed=42, shuffle=True):
+        data_dirs = data_dir if isinstance(data_dir, list) else [data_dir]
+        indexes = [np.load(os.path.join(i, "label_index.npz")) for i in data_dirs]
+        self.valid = np.concatenate([i["valid"] for i in indexes])
+        self.weight = np.concatenate([i["weight"] for i in indexes])
+        self.seed = seed
+        self.shuffle = shuffle
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch):
+        # the epoch's indices are drawn here, so len() is the number __iter__ yields
+        self.epoch = epoch
+        rng = np.random.default_rng(self.seed+self.epoch)
+        keep = (self.valid>0) & (rng.random(self.valid.shape[0]) < 1/self.weight)
+        indices = np.flatnonzero(keep)
+        self.epoch_indices = rng.permutation(indices) if self.shuffle else indices
+
+    def indices(self):
+        return self.epoch_indices
+
+    def __iter__(self):
+        return iter(self.epoch_indices.tolist())
+
+    def __len__(self):
+        return len(self.epoch_indices)
+
+
+class Ragged_site_module(pl.LightningDataModule):
+    # drop-in for Single_site_module/Multi_site_module over containers written by convert_npz. data_dir is
+    # one directory or a list (--data_path given several times), the splits of all of them are concatenated
+    def __init__(self, data_dir, batch_size, num_workers, collate_fn=None, label_sampling=False):
+        super().__init__()
+        self.data_dirs = data_dir if isinstance(data_dir, list) else [data_dir]
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.collate_fn = collate_fn
+        self.label_sampling = label_sampling
+
+    def setup(self, stage=None):
+        self.train_dataset = self._split("train")
+        self.valid_dataset = self._split("valid")
+        self.test_dataset = self._split("test")
+
+    def _split(self, split):
+        datasets = [Ragged_site_dataset(os.path.join(i, split)) for i in self.data_dirs]
+        return datasets[0] if len(datasets)==1 else Ragged_concat_dataset(datasets)
+
+    def _dataloader(self, dataset, shuffle, sampler=None):
+        # genes of a multi-site batch are padded to the same number of sites
+        collate_fn = self.collate_fn if self.collate_fn is not None or dataset.model=="single" else pad_collate
+        return DataLoader(dataset, batch_size=self.batch_size, shuffle=shuffle, sampler=sampler, num_workers=self.num_workers,
+                          collate_fn=collate_fn, persistent_workers=self.num_workers>0)
+
+    def train_dataloader(self):
+        if self.label_sampling:
+            # the training step scales the loss of every sample by its importance weight
+            datasets = self.train_dataset.datasets if isinstance(self.train_dataset, ConcatDataset) else [self.train_dataset]
+            for dataset in datasets:
+                dataset.weights = np.load(os.path.join(dataset.data_dir, "label_index.npz"))["weight"]
+            return self._dataloader(self.train_dataset, False, Label_aware_sampler([i.data_dir for i in datasets]))
+        return self._dataloader(self.train_dataset, True)
+
+    def val_dataloader(self):
+        return self._dataloader(self.valid_dataset, False)
+
+    def test_dataloader(self):
+        return self._dataloader(self.test_dataset, False)
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="Convert per-gene npz shards to one ragged memory-mapped container per split",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--npz_dir", type=str, required=True)
+    parser.add_argument("--container_dir", type=str, required=True)
+    parser.add_argument("--model", choices=["multi","single"], required=True)
+    parser.add_argument("--encoding", choices=encodings, default="dense", help="uint8/float16: 1-byte base codes and histone marks in that dtype")
+    parser.add_argument("--zero_keep", type=float, default=ZERO_KEEP, help="keep probability of all-zero samples in the label index")
+    opt = parser.parse_args()
+    for split in ["train","valid","test"]:
+        if os.path.isdir(os.path.join(opt.npz_dir, split)):
+            convert_npz(os.path.join(opt.npz_dir, split), os.path.join(opt.container_dir, split), opt.model, opt.encoding, opt.zero_keep)
@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import tempfile
+import argparse
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+from histone_store import HistoneStore, is_histone_store, track_length, decode_track, read_values
+
+# One loader process publishes the per-process heap state every DataLoader worker and Ray Tune trial would
+# otherwise rebuild: the label index of generate_y, the genome when it comes from the FASTA dict, and
+# optionally decoded histone tracks of some chromosomes when there is no histone store. Everything lives in
+# a single shared memory segment described by {tmp}/{name}.json, attaching maps it read-only without a copy.
+# The genome store and the histone store are memmaps and already shared through the page cache.
+
+_attached = []
+
+
+def rss():
+    # MB of this process from /proc: resident, private (anon) and shared memory pages
+    fields = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS","RssAnon","RssShmem"):
+                fields[key] = int(value.split()[0])/1024
+    return {"rss":fields.get("VmRSS",0),"anon":fields.get("RssAnon",0),"shmem":fields.get("RssShmem",0)}
+
+
+def report_rss(label):
+    usage = rss()
+    print("pid {} {}: rss {:.1f} MB (anon {:.1f} MB, shmem {:.1f} MB)".format(os.getpid(), label, usage["rss"], usage["anon"], usage["shmem"]))
+
+
+def manifest_url(name):
+    return os.path.join(tempfile.gettempdir(), name+".json")
+
+
+def publish_arrays(name, arrays, meta):
+    # copies every array into one segment, 64-byte aligned, and writes the manifest next to it
+    specs = {}
+    size = 0
+    for key, array in arrays.items():
+        size = (size+63)//64*64
+        specs[key] = [size, list(array.shape), array.dtype.str]
+        size += array.nbytes
+    shm = shared_memory.SharedMemory(name=name, create=True, size=max(size, 1))
+    for key, array in arrays.items():
+        offset, shape, dtype = specs[key]
+        np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)[...] = array
+    with open(manifest_url(name)+".tmp", "w") as f:
+        json.dump({"arrays":specs,"meta":meta}, f)
+    os.replace(manifest_url(name)+".tmp", manifest_url(name))
+    return shm
+
+
+def attach_arrays(name):
+    with open(manifest_url(name)) as f:
+        manifest = json.load(f)
+    shm = shared_memory.SharedMemory(name=name)
+    # the publisher owns the segment, without this the resource tracker unlinks it when an attached process exits
+    resource_tracker.unregister(shm._name, "shared_memory")
+    _attached.append(shm)
+    arrays = {}
+    for key, (offset, shape, dtype) in manifest["arrays"].items():
+        array = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+        array.setflags(write=False)
+        arrays[key] = array
+    return arrays, manifest["meta"]
+
+
+class SharedGenome:
+    # genome[chromosome][start:end] and fetch() over the published ascii arrays
+    def __init__(self, chromosomes):
+        self.chromosomes = chromosomes
+
+    def keys(self):
+        return self.chromosomes.keys()
+
+    def __getitem__(self, chromosome):
+        return SharedChromosome(self.chromosomes[chromosome])
+
+    def fetch(self, chromosome, start, end):
+        sequence = self.chromosomes[chromosome]
+        return sequence[max(start, 0):max(min(end, sequence.shape[0]), 0)]
+
+
+class SharedChromosome:
+    def __init__(self, sequence):
+        self.sequence = sequence
+
+    def __len__(self):
+        return self.sequence.shape[0]
+
+    def __getitem__(self, key):
+        return self.sequence[key].tobytes().decode("ascii")
+
+
+class SharedHistoneStore(HistoneStore):
+    # HistoneStore over published tracks of some chromosomes. The others are read window by window, as views of
+    # the histone store on disk when there is one, or from the bigWig files of the registry in generate_x, so an
+    # unpublished chromosome is never decoded whole into the heap of a worker
+    def __init__(self, marks, tracks, cell_type):
+        import generate_x
+        from load_raw_data import HISTONE_STORE_PATH
+
+        self.marks = marks
+        self.chroms = {i: tracks[i].shape[1] for i in tracks}
+        self.tracks = dict(tracks)
+        self.cell_type = cell_type
+        self.disk_store = HistoneStore(HISTONE_STORE_PATH, cell_type) if is_histone_store(HISTONE_STORE_PATH, cell_type) else None
+        self.bws = generate_x.bigwig_registry.tracks(cell_type)
+
+    def fetch(self, chromosome, start, end, marks):
+        if chromosome in self.tracks:
+            return HistoneStore.fetch(self, chromosome, start, end, marks)
+        if self.disk_store is not None and chromosome in self.disk_store.chroms:
+            return self.disk_store.fetch(chromosome, start, end, marks)
+        if chromosome not in self.chroms:
+            self.chroms[chromosome] = track_length(self.bws, self.marks, chromosome) or 0
+        # the window a decoded track would give, cut at the end of the chromosome
+        end = max(min(end, self.chroms[chromosome]), start)
+        window = np.empty((len(marks), end - start), dtype=np.float16)
+        for row, mark in enumerate(marks):
+            window[row] = read_values(self.bws[mark], chromosome, start, end)
+        return window
+
+
+def _str_array(values):
+    # object arrays of str cannot live in a buffer, fixed-width unicode can
+    return np.asarray(values).astype(str)
+
+
+def publish(name, cell_type, track_chromosomes=()):
+    import generate_x
+    import generate_y
+    from genome_store import GenomeStore
+
+    arrays = {}
+    meta = {"cell_type":cell_type,"sse":[],"fpkm":[],"genome":[],"marks":[],"tracks":[]}
+
+    gene_index = generate_y.get_gene_index(cell_type)
+    for i in ["gene_ids","chromosomes","strands"]:
+        arrays["gene."+i] = _str_array(getattr(gene_index, i))
+    for i in ["offsets","sites","y","rows"]:
+        arrays["gene."+i] = np.asarray(getattr(gene_index, i))
+    for table in ["sse","fpkm"]:
+        for (chromosome, strand), (sites, y) in getattr(generate_y.tempData, table+"_sorted").items():
+            arrays["{}.{}.{}.sites".format(table, chromosome, strand)] = sites
+            arrays["{}.{}.{}.y".format(table, chromosome, strand)] = y
+            meta[table].append([chromosome, strand])
+
+    genome = generate_x.get_genome()
+    if not isinstance(genome, GenomeStore):
+        for chromosome in genome:
+            arrays["genome."+chromosome] = np.frombuffer(genome[chromosome].encode("ascii"), dtype=np.uint8)
+            meta["genome"].append(chromosome)
+
+    if len(track_chromosomes) > 0:
+        # the float16 (marks, length) arrays build_histone_store writes, decoded into memory
+        from load_raw_data import load_histone_modification, histone_type_dct
+        bws = load_histone_modification(cell_type)
+        meta["marks"] = [i for i in histone_type_dct["all"] if i in bws]
+        for chromosome in track_chromosomes:
+            length = track_length(bws, meta["marks"], chromosome)
+            if length is None:
+                continue
+            track = np.empty((len(meta["marks"]), length), dtype=np.float16)
+            decode_track(bws, meta["marks"], chromosome, track)
+            arrays["track."+chromosome] = track
+            meta["tracks"].append(chromosome)
+
+    shm = publish_arrays(name, arrays, meta)
+    print("published {:.1f} MB as {}".format(shm.size/2**20, name))
+    return shm
+
+
+def attach(name):
+    # installs the published state into generate_x and generate_y of this process
+    import generate_x
+    import generate_y
+
+    report_rss("before attaching "+name)
+    arrays, meta = attach_arrays(name)
+    cell_type = meta["cell_type"]
+
+    gene_index = generate_y.GeneIndex.from_arrays({i: arrays["gene."+i] for i in ["gene_ids","chromosomes","strands","offsets","sites","y","rows"]})
+    sorted_index = {}
+    for table in ["sse","fpkm"]:
+        sorted_index[table] = {(chromosome, strand): (arrays["{}.{}.{}.sites".format(table, chromosome, strand)],
+                                                      arrays["{}.{}.{}.y".format(table, chromosome, strand)])
+                               for chromosome, strand in meta[table]}
+    generate_y.tempData.attach(cell_type, gene_index, sorted_index["sse"], sorted_index["fpkm"])
+
+    if len(meta["genome"]) > 0:
+        generate_x._genome = SharedGenome({i: arrays["genome."+i] for i in meta["genome"]})
+    if len(meta["tracks"]) > 0:
+        generate_x.tempData.histone_stores[cell_type] = SharedHistoneStore(meta["marks"], {i: arrays["track."+i] for i in meta["tracks"]}, cell_type)
+        generate_x.tempData.cell_type = None
+    report_rss("after attaching "+name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Publish the label index, the genome and histone tracks in shared memory until interrupted",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--name", type=str, default="lstm_splicing")
+    parser.add_argument("--cell_type", type=str, default="GM12878")
+    parser.add_argument("--track_chromosomes", nargs="*", default=[], help="decode the bigWig tracks of these chromosomes too")
+    opt, unknown = parser.parse_known_args()
+
+    report_rss("before publishing")
+    shm = publish(opt.name, opt.cell_type, opt.track_chromosomes)
+    report_rss("after publishing")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.remove(manifest_url(opt.name))
+        shm.close()
+        shm.unlink()
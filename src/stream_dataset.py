@@ -0,0 +1,230 @@
+import queue
+import threading
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, DataLoader, get_worker_info
+import pytorch_lightning as pl
+from train_val_partition import Train_Chromes, Valid_Chromes, Test_Chromes
+from ragged_dataset import pad_collate
+import generate_x
+import generate_y
+from args import get_args
+
+# Samples are built from the genome, the histone tracks and the SpliSER index while training, without the
+# npz pre-generation step. They have the layout of Single_site_module/Multi_site_module:
+#   {"x": {"DNA_seq", "histone_mark", "raw_seq", "position"[, "histone_context"]}, "y"}
+
+
+class _Raised:
+    def __init__(self, error):
+        self.error = error
+
+
+def prefetch(iterator, size):
+    # runs the iterator in a background thread at most `size` items ahead of the consumer,
+    # so feature extraction overlaps with collation and the training step. When the consumer stops early
+    # (break, close or garbage collection) the thread sees `stop` and ends instead of blocking on a full queue
+    if size <= 0:
+        yield from iterator
+        return
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterator:
+                if not put(item):
+                    return
+        except BaseException as error:
+            put(_Raised(error))
+            return
+        put(done)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            if isinstance(item, _Raised):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+
+
+def get_rank():
+    # (rank, world size) of DDP, (0, 1) without it
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+def get_shard():
+    # (shard id, number of shards) over DDP ranks and DataLoader workers
+    rank, world_size = get_rank()
+    info = get_worker_info()
+    if info is None:
+        return rank, world_size
+    return rank*info.num_workers+info.id, world_size*info.num_workers
+
+
+def get_epoch_seed():
+    # the DataLoader draws a base seed from the torch generator and hands it to all workers as info.seed-info.id,
+    # so every worker agrees on the order and pl.seed_everything makes it reproducible
+    info = get_worker_info()
+    if info is None:
+        return int(torch.empty((), dtype=torch.int64).random_().item())
+    return info.seed-info.id
+
+
+class Stream_site_dataset(IterableDataset):
+    def __init__(self, cell_type, chromosomes, model, genome_distance=256, shuffle=False, max_sites=512, prefetch_size=16):
+        self.cell_type = cell_type
+        self.chromosomes = chromosomes
+        self.model = model
+        self.genome_distance = genome_distance
+        self.shuffle = shuffle
+        self.max_sites = max_sites
+        self.prefetch_size = prefetch_size
+        self.epoch = 0
+        # DataLoader workers that split the genes, set by Stream_site_module, used by __len__
+        self.num_workers = 0
+
+    def gene_list(self):
+        # (chromosome, gene id, sites) of every gene of the dataset in chromosome order
+        gene_index = generate_y.get_gene_index(self.cell_type)
+        genes = []
+        for chromosome in self.chromosomes:
+            for gene_id in gene_index.genes(chromosomes=[chromosome]):
+                block = gene_index.block(gene_id)
+                if self.model=="multi" and block.stop-block.start>self.max_sites:
+                    continue
+                genes.append((chromosome, gene_id, block.stop-block.start))
+        return genes
+
+    def __len__(self):
+        # samples an epoch yields on this rank: genes (multi) or sites (single) of its workers' shards. Lightning
+        # needs it for a fractional val_check_interval. Without DDP it is exact, with it the single-site count is
+        # that of the unshuffled split, a shuffled epoch gives the rank other genes with about as many sites
+        sizes = [1 if self.model=="multi" else site_num for chromosome, gene_id, site_num in self.gene_list()]
+        rank, world_size = get_rank()
+        workers = max(self.num_workers, 1)
+        bounds = np.linspace(0, len(sizes), world_size*workers+1).astype(np.int64)
+        return int(sum(sizes[bounds[rank*workers]:bounds[(rank+1)*workers]]))
+
+    def get_genes(self, seed):
+        # genes in chromosome order cut into one contiguous run per shard, so all shards get the same number of
+        # genes. When training, the genes of all chromosomes are shuffled before the split and every worker gets
+        # a new sample of them each epoch. With the feature cache the runs are cut before shuffling instead, a
+        # worker keeps its genes (what its cache holds) from epoch to epoch and only their order changes
+        rng = np.random.default_rng(seed)
+        genes = [(chromosome, gene_id) for chromosome, gene_id, site_num in self.gene_list()]
+        stable = generate_x.feature_cache is not None
+        if self.shuffle and not stable:
+            genes = [genes[i] for i in rng.permutation(len(genes))]
+        shard, num_shards = get_shard()
+        bounds = np.linspace(0, len(genes), num_shards+1).astype(np.int64)
+        genes = genes[bounds[shard]:bounds[shard+1]]
+        if not (self.shuffle and stable):
+            return [gene_id for chromosome, gene_id in genes]
+        # chromosome by chromosome, so a worker still reads one chromosome at a time
+        by_chromosome = {}
+        for chromosome, gene_id in genes:
+            by_chromosome.setdefault(chromosome, []).append(gene_id)
+        return [gene_id for chromosome in rng.permutation(list(by_chromosome)) for gene_id in rng.permutation(by_chromosome[chromosome])]
+
+    def get_samples(self, gene_id):
+        gene = generate_y.get_gene_index(self.cell_type).get(gene_id)
+        chromosome, sites, strand = gene["chromosome"], gene["sites"], gene["strand"]
+        histone_mark, DNA_seq = generate_x.get_x_batch(self.cell_type,chromosome,sites,self.genome_distance,strand,np.uint8)
+        x = {"DNA_seq":torch.from_numpy(DNA_seq.astype(np.single)),
+             "histone_mark":torch.from_numpy(histone_mark.astype(np.single))}
+        if get_args().single_site_type=="SpliceBERT":
+            x["raw_seq"] = torch.from_numpy(generate_x.get_seq_batch(chromosome,sites,self.genome_distance,strand))
+        else:
+            x["raw_seq"] = torch.zeros((len(sites),1), dtype=torch.int64)
+        x["position"] = torch.from_numpy(gene["position"])
+        if get_args().histone_context:
+            x["histone_context"] = torch.from_numpy(generate_x.get_x_context(self.cell_type,chromosome,sites,strand,get_args().CL,get_args().patch_num))
+        y = torch.from_numpy(generate_y.get_y_batch(self.cell_type,chromosome,sites,strand,get_args().task).astype(np.single))
+
+        if self.model=="multi":
+            yield {"x":x,"y":y}
+            return
+        for i in range(len(sites)):
+            site_x = {k: v[i] for k, v in x.items()}
+            site_x["position"] = torch.zeros((), dtype=torch.float32)
+            yield {"x":site_x,"y":y[i]}
+
+    def generate(self, genes):
+        for gene_id in genes:
+            yield from self.get_samples(gene_id)
+
+    def __iter__(self):
+        # persistent workers keep their base seed, the epoch count gives them a new order every epoch
+        genes = self.get_genes(get_epoch_seed()+self.epoch)
+        self.epoch += 1
+        return prefetch(self.generate(genes), self.prefetch_size)
+
+
+class Stream_site_module(pl.LightningDataModule):
+    # drop-in for Single_site_module/Multi_site_module without pre-generated data
+    def __init__(self, cell_type, model, batch_size, num_workers, genome_distance=256, max_sites=512, prefetch_size=16):
+        super().__init__()
+        self.cell_type = cell_type
+        self.model = model
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.genome_distance = genome_distance
+        self.max_sites = max_sites
+        self.prefetch_size = prefetch_size
+
+    def setup(self, stage=None):
+        # the label index is built (or attached) here, before the workers fork, and shared with them. It only
+        # holds the chromosomes of the stage: fit reads train and valid labels, validate valid, test test
+        chromosomes = {"fit":Train_Chromes+Valid_Chromes,"validate":Valid_Chromes,"test":Test_Chromes}.get(stage)
+        if get_args().shared_store is not None:
+            import shared_store
+            shared_store.attach(get_args().shared_store)
+        else:
+            generate_y.restrict_chromosomes(chromosomes)
+        generate_y.get_gene_index(self.cell_type)
+        # with --feature_cache_mb every worker caches the gene spans of its shard, the workers are persistent
+        # and keep their shard, so the spans of one epoch are reused in the next ones
+        generate_x.enable_feature_cache_from_args()
+        self.train_dataset = self._dataset(Train_Chromes, True)
+        self.valid_dataset = self._dataset(Valid_Chromes, False)
+        self.test_dataset = self._dataset(Test_Chromes, False)
+
+    def _dataset(self, chromosomes, shuffle):
+        return Stream_site_dataset(self.cell_type, chromosomes, self.model, genome_distance=self.genome_distance,
+                                   shuffle=shuffle, max_sites=self.max_sites, prefetch_size=self.prefetch_size)
+
+    def _dataloader(self, dataset):
+        dataset.num_workers = self.num_workers
+        return DataLoader(dataset, batch_size=self.batch_size, num_workers=self.num_workers,
+                          collate_fn=pad_collate if self.model=="multi" else None,
+                          multiprocessing_context="fork" if self.num_workers>0 else None,
+                          persistent_workers=self.num_workers>0)
+
+    def train_dataloader(self):
+        return self._dataloader(self.train_dataset)
+
+    def val_dataloader(self):
+        return self._dataloader(self.valid_dataset)
+
+    def test_dataloader(self):
+        return self._dataloader(self.test_dataset)
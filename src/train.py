@@ -4,6 +4,8 @@ import os
 import torch
 import pytorch_lightning as pl
 from dataset import Single_site_module, Multi_site_module
+from ragged_dataset import Ragged_site_module
+from stream_dataset import Stream_site_module
 from args import args
 from pytorch_lightning.loggers import TensorBoardLogger
 from ray import air, tune
@@ -13,11 +15,22 @@ from ray.tune.schedulers import ASHAScheduler, PopulationBasedTraining
 from ray.tune.integration.pytorch_lightning import TuneReportCallback,TuneReportCheckpointCallback
 tune.execution.ray_trial_executor.DEFAULT_GET_TIMEOUT = 10000
 
+def get_data_module(model_type,batch_size):
+    if args.data_format=="ragged":
+        return Ragged_site_module(data_dir = args.data_path,batch_size = batch_size,num_workers = args.num_workers,label_sampling = args.label_sampling)
+    if args.data_format=="stream":
+        return Stream_site_module(args.cell_type,model_type,batch_size = batch_size,num_workers = args.num_workers,prefetch_size = args.prefetch)
+    if model_type=="single":
+        return Single_site_module(data_dir = args.data_path,batch_size = batch_size,num_workers = args.num_workers)
+    # the npz multi-site module stacks genes without padding, only the ragged and stream modules pad them
+    assert batch_size==1, "--batch_size above 1 for multi-site models needs --data_format ragged or stream"
+    return Multi_site_module(data_dir = args.data_path,batch_size = batch_size,num_workers = args.num_workers)
+
 def train_ray_tune(config):
 
     pl.seed_everything(42)
     logger=TensorBoardLogger(save_dir=os.getcwd(), name="raytune", version="v1"),
-    data_module = Single_site_module(data_dir = args.data_path,batch_size = args.batch_size,num_workers = args.num_workers)
+    data_module = get_data_module("single",args.batch_size)
     model = Single_site_model(512,args.input_channel,config["hidden_size"],config["num_layers"] ,dropout=config["dropout"],model_type= config["model_type"],prune_ratio = config["prune_ratio"])
 
     transformer = Lightning_module(model,args.task,args.model,config["learning_rate"],config["loss_func"])
@@ -34,9 +47,11 @@ def train_ray_tune_multi(config):
         dropout=config["dropout"],outer_hidden_size = config["outer_hidden_size"],
         do_attention = config["do_attention"],do_norm = config["do_norm"],
         relative_position = config["relative_position"],absolute_position = config["absolute_position"],
-        do_outer = config["do_outer"]
+        do_outer = config["do_outer"],site_chunk = args.site_chunk,
+        attention_window = args.attention_window,attention_neighbors = args.attention_neighbors,
+        sparse_attention2 = args.sparse_attention2,num_heads = args.num_head
         )
-    data_module = Multi_site_module(data_dir = args.data_path,batch_size = 1,num_workers = args.num_workers)
+    data_module = get_data_module("multi",args.batch_size)
     transformer = Lightning_module(model,args.task,args.model,config["learning_rate"])
     trainer = pl.Trainer(accelerator=args.device,val_check_interval= 0.5,default_root_dir=args.checkpoint_dir,logger=logger,max_epochs=args.max_epochs,callbacks=[TQDMProgressBar(refresh_rate=200),TuneReportCallback({"loss": "val_loss","F1":"val_F1","AUROC":"val_AUROC","AUPRC":"val_AUPRC","spearman":"val_spearman","pearson":"val_pearson"},on="validation_end")])
     trainer.fit(model=transformer,datamodule=data_module)
@@ -189,7 +204,7 @@ def main():
 
         # model = CNN_module2(in_channels[0], W = W, AR = AR,in_channels = in_channels,out_channels = out_channels, dropout=None)
         model = Single_site_model(512,args.input_channel,args.hidden_size,num_layers=3 ,dropout=args.dropout)
-        data_module = Single_site_module(data_dir = args.data_path,batch_size = args.batch_size,num_workers = args.num_workers)
+        data_module = get_data_module("single",args.batch_size)
         
     if args.model=="multi":
         config = {
@@ -211,9 +226,11 @@ def main():
         dropout=config["dropout"],outer_hidden_size = config["outer_hidden_size"],
         do_attention = config["do_attention"],do_norm = config["do_norm"],
         relative_position = config["relative_position"],absolute_position = config["absolute_position"],
-        do_outer = config["do_outer"]
+        do_outer = config["do_outer"],site_chunk = args.site_chunk,
+        attention_window = args.attention_window,attention_neighbors = args.attention_neighbors,
+        sparse_attention2 = args.sparse_attention2,num_heads = args.num_head
         )
-        data_module = Multi_site_module(data_dir = args.data_path,batch_size = 1,num_workers = args.num_workers)
+        data_module = get_data_module("multi",args.batch_size)
 
         # model = Multi_site_model(512,args.input_channel,args.hidden_size,num_layers=3 ,dropout=args.dropout)
         # data_module = Multi_site_module(data_dir = args.data_path,batch_size = 1,num_workers = args.num_workers)
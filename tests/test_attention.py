@@ -0,0 +1,65 @@
+import pytest
+import torch
+from benchmark import relative_attention_reference
+from lstm_splicing_model import Self_attention
+
+
+def einsum_attention(attention, x, position, mask):
+    N, length = x.shape[:2]
+    V, K, Q = [linear(x).reshape(N, length, attention.num_heads, attention.head_dim)
+               for linear in [attention.V_linear, attention.K_linear, attention.Q_linear]]
+    out = attention.dense_attention(V, K, Q, position, mask)
+    return attention.fc_out(out.reshape(N, length, attention.embed_dim))
+
+
+@pytest.mark.parametrize("heads", [1, 2, 4])
+@pytest.mark.parametrize("padded", [False, True])
+def test_fused_attention_matches_dense(heads, padded):
+    torch.manual_seed(42)
+    attention = Self_attention(32, heads, False, False)
+    x = torch.randn(4, 23, 32, requires_grad=True)
+    position = torch.sort(torch.rand(4, 23)*10000, dim=1)[0]
+    mask = torch.arange(23)<torch.tensor([23, 12, 5, 1])[:,None] if padded else None
+    real = mask if padded else ...
+    # outputs of padded sites are not used, only the real ones enter the sum
+    fused, fused_gradients = outputs_and_gradients(attention, lambda: attention(x, x, x, position, mask)[0][real], x)
+    dense, dense_gradients = outputs_and_gradients(attention, lambda: einsum_attention(attention, x, position, mask)[real], x)
+    torch.testing.assert_close(fused, dense, atol=1e-5, rtol=1e-4)
+    for a, b in zip(fused_gradients, dense_gradients):
+        torch.testing.assert_close(a, b, atol=1e-4, rtol=1e-3)
+
+
+def outputs_and_gradients(attention, fn, x):
+    # fn's output and the gradients of its sum with respect to x and to every parameter
+    attention.zero_grad()
+    x.grad = None
+    output = fn()
+    output.sum().backward()
+    return output.detach(), [x.grad.clone()]+[i.grad.clone() for i in attention.parameters() if i.grad is not None]
+
+
+def test_relative_attention_matches_5d_reference():
+    torch.manual_seed(42)
+    attention = Self_attention(32, 4, False, True)
+    x = torch.randn(19, 32, requires_grad=True)
+    position = torch.sort(torch.randint(0, 20*19, (1, 19)).float(), dim=1)[0]
+    output, gradients = outputs_and_gradients(attention, lambda: attention(x, x, x, position)[0], x)
+    reference, reference_gradients = outputs_and_gradients(attention, lambda: relative_attention_reference(attention, x, position), x)
+    torch.testing.assert_close(output, reference, atol=1e-5, rtol=1e-4)
+    for a, b in zip(gradients, reference_gradients):
+        torch.testing.assert_close(a, b, atol=1e-4, rtol=1e-3)
+
+
+@pytest.mark.parametrize("window, neighbors", [(100000, 0), (0, 64)])
+def test_sparse_attention_over_all_sites_matches_dense(window, neighbors):
+    # a distance window wider than the gene, or at least as many nearest sites as the gene has, is dense
+    torch.manual_seed(42)
+    attention = Self_attention(32, 4, False, True)
+    x = torch.randn(37, 32, requires_grad=True)
+    position = torch.cumsum(torch.empty(1, 37).exponential_(1/200), dim=1)
+    dense, dense_gradients = outputs_and_gradients(attention, lambda: attention(x, x, x, position)[0], x)
+    attention.attention_window, attention.attention_neighbors = window, neighbors
+    sparse, sparse_gradients = outputs_and_gradients(attention, lambda: attention(x, x, x, position)[0], x)
+    torch.testing.assert_close(sparse, dense, atol=1e-5, rtol=1e-4)
+    for a, b in zip(sparse_gradients, dense_gradients):
+        torch.testing.assert_close(a, b, atol=1e-4, rtol=1e-3)
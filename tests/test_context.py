@@ -0,0 +1,36 @@
+import json
+import numpy as np
+import pytest
+import generate_x
+from benchmark import FakeBigWig
+from histone_store import HistoneStore, _clip
+
+CELL_TYPE, LENGTH, CL, PATCH_NUM = "synthetic", 5000, 1024, 32
+
+
+@pytest.mark.parametrize("high", [3.99, None])
+def test_store_and_bigwig_contexts_agree(tmp_path, monkeypatch, high):
+    # per-base clip then mean on both backends, with gaps, a shorter mark, sites off either chromosome end
+    # and, without the cap, values above 4
+    rng = np.random.default_rng(0)
+    marks = generate_x.get_histone_type_lst()
+    tracks = {}
+    for row, mark in enumerate(marks):
+        values = rng.gamma(1.0, 2.0, LENGTH-row*50)
+        values[rng.random(len(values))<0.1] = np.nan
+        tracks[mark] = values if high is None else np.minimum(values, high)
+    store = np.full((len(marks), LENGTH), 4, dtype=np.float16)
+    for row, mark in enumerate(marks):
+        store[row,:len(tracks[mark])] = _clip(tracks[mark])
+    (tmp_path/CELL_TYPE).mkdir()
+    np.save(tmp_path/CELL_TYPE/"chr1.npy", store)
+    (tmp_path/CELL_TYPE/"index.json").write_text(json.dumps({"marks":marks,"chroms":{"chr1":LENGTH}}))
+    sites = np.concatenate([[0, CL//4, LENGTH-CL//4, LENGTH-1], rng.integers(0, LENGTH, 16)])
+
+    monkeypatch.setattr(generate_x, "tempData", generate_x.TempData())
+    contexts = []
+    for histone_store, histone_modification in [(HistoneStore(str(tmp_path), CELL_TYPE), None), (None, {i: FakeBigWig("chr1", tracks[i]) for i in marks})]:
+        generate_x.tempData.cell_type = CELL_TYPE
+        generate_x.tempData.histone_store, generate_x.tempData.histone_modification = histone_store, histone_modification
+        contexts.append(np.concatenate([generate_x.get_x_context(CELL_TYPE, "chr1", sites, strand, CL, PATCH_NUM) for strand in "+-"]))
+    np.testing.assert_allclose(contexts[0], contexts[1], atol=4e-3)
@@ -0,0 +1,48 @@
+import numpy as np
+import torch
+from lstm_splicing_model import Multi_site_model, Lightning_module
+from ragged_dataset import pad_collate
+
+WINDOW, INPUT_CHANNEL = 16, 7
+
+
+def gene(rng, sites):
+    x = {"DNA_seq":torch.from_numpy(rng.integers(0, 5, (sites, WINDOW)).astype(np.uint8)),
+         "histone_mark":torch.from_numpy(rng.random((sites, INPUT_CHANNEL-4, WINDOW), dtype=np.float32)),
+         "raw_seq":torch.zeros((sites, 1), dtype=torch.int64),
+         "position":torch.from_numpy(np.sort(rng.integers(0, 50*sites, sites)).astype(np.float32))}
+    return {"x":x,"y":torch.from_numpy(rng.random(sites, dtype=np.float32))}
+
+
+def model(**kwargs):
+    torch.manual_seed(42)
+    return Multi_site_model(WINDOW, INPUT_CHANNEL, 4, dropout=0, outer_hidden_size=16, do_attention=True, do_norm=True, **kwargs).eval()
+
+
+def test_padded_batch_matches_genes_alone():
+    # genes of 1 to 9 sites padded into one batch predict what each of them predicts on its own
+    rng = np.random.default_rng(42)
+    genes = [gene(rng, sites) for sites in [3, 9, 1, 6]]
+    multi_site_model = model(relative_position=True)
+    with torch.no_grad():
+        batch = pad_collate(genes)
+        batched = Lightning_module.real_sites(None, batch["x"], multi_site_model(batch["x"]))
+        alone = torch.cat([multi_site_model(pad_collate([i])["x"]).reshape(-1, 1) for i in genes])
+    assert batched.shape==(19, 1)
+    torch.testing.assert_close(batched, alone, atol=1e-5, rtol=1e-4)
+
+
+def test_site_chunks_match_full_backward():
+    # the single-site module run in checkpointed chunks, one of them partial, gives the gradients of one pass
+    sample = pad_collate([gene(np.random.default_rng(42), 11)])
+    multi_site_model = model()
+    gradients = []
+    for site_chunk in [0, 4]:
+        multi_site_model.site_chunk = site_chunk
+        multi_site_model.zero_grad()
+        multi_site_model(sample["x"]).sum().backward()
+        gradients.append([i.grad.clone() for i in multi_site_model.parameters() if i.grad is not None])
+    assert len(gradients[0])==len(gradients[1])>0
+    for a, b in zip(*gradients):
+        # the same sums over sites in another order, float32 round-off relative to each gradient's scale
+        assert (a-b).abs().max()<=1e-5*b.abs().max()+1e-7
@@ -0,0 +1,70 @@
+import os
+import numpy as np
+import pytest
+import torch
+from ragged_dataset import DNA_CHANNELS, HISTONE_SCALE, convert_npz, encode_dna, encode_histone, expand_features, Ragged_site_dataset
+
+MARKS, WINDOW = 3, 16
+
+
+def one_hot(codes):
+    # int_dct codes -> (..., 4, L) one-hot, code 0 (padding/N) is all zero
+    return np.eye(DNA_CHANNELS+1, dtype=np.single)[codes][...,1:].swapaxes(-1, -2)
+
+
+def write_shards(split_dir, model, layout, rng):
+    # per-gene npz shards as build_dataset.py writes them, histone marks are clipped to 4 like get_x_balance
+    for gene in range(6):
+        os.makedirs(os.path.join(split_dir, "chr1"), exist_ok=True)
+        sites = 1 if model=="single" else int(rng.integers(1, 6))
+        seq = rng.integers(0, 10, (sites, WINDOW+2))
+        position = np.sort(rng.integers(0, 10000, sites))
+        y = rng.random(sites)
+        if layout=="span":
+            window_start = np.sort(rng.integers(0, 3*WINDOW, sites))
+            length = int(window_start.max())+WINDOW
+            np.savez(os.path.join(split_dir, "chr1", "g{}.npz".format(gene)), span_dna=rng.integers(0, 5, length).astype(np.uint8),
+                     span_histone=np.minimum(rng.gamma(1.0, 2.0, (MARKS, length)), 4).astype(np.float16), window_start=window_start, seq=seq, Y=y, position=position)
+            continue
+        X = np.concatenate([np.minimum(rng.gamma(1.0, 2.0, (sites, MARKS, WINDOW)), 4), one_hot(rng.integers(0, 5, (sites, WINDOW)))], axis=1).astype(np.single)
+        if model=="single":
+            X, seq, y, position = X[0], seq[0], y[0], position[0]
+        np.savez(os.path.join(split_dir, "chr1", "g{}.npz".format(gene)), X=X, seq=seq, Y=y, position=position)
+
+
+def test_encode_dna_round_trip():
+    DNA_seq = one_hot(np.random.default_rng(42).integers(0, 5, (7, 33)))
+    codes = encode_dna(DNA_seq)
+    assert codes.dtype==np.uint8
+    x = expand_features({"DNA_seq":torch.from_numpy(codes),"raw_seq":torch.zeros(7, 1, dtype=torch.int16)})
+    assert torch.equal(x["DNA_seq"], torch.from_numpy(DNA_seq))
+    assert x["raw_seq"].dtype==torch.int64
+
+
+@pytest.mark.parametrize("encoding, tolerance", [("uint8", HISTONE_SCALE/2), ("float16", 4*2**-11)])
+def test_encode_histone_within_quantization(encoding, tolerance):
+    # the marks are clipped to 4 when they are extracted, so only that range has to survive the encoding
+    histone_mark = np.minimum(np.random.default_rng(42).gamma(1.0, 2.0, (5, MARKS, 40)), 4).astype(np.single)
+    expanded = expand_features({"DNA_seq":torch.zeros(1),"histone_mark":torch.from_numpy(encode_histone(histone_mark, encoding)),
+                                "raw_seq":torch.zeros(1, dtype=torch.int64)})["histone_mark"]
+    assert expanded.dtype==torch.float32
+    assert (expanded-torch.from_numpy(histone_mark)).abs().max().item()<=tolerance+1e-6
+
+
+@pytest.mark.parametrize("encoding", ["uint8", "float16"])
+@pytest.mark.parametrize("model, layout", [("single","window"), ("multi","window"), ("multi","span")])
+def test_compact_container_matches_dense(tmp_path, encoding, model, layout):
+    write_shards(str(tmp_path/"npz"), model, layout, np.random.default_rng(42))
+    convert_npz(str(tmp_path/"npz"), str(tmp_path/"dense"), model)
+    convert_npz(str(tmp_path/"npz"), str(tmp_path/encoding), model, encoding)
+    dense, compact = Ragged_site_dataset(str(tmp_path/"dense")), Ragged_site_dataset(str(tmp_path/encoding))
+    assert len(dense)==len(compact)==6
+    tolerance = HISTONE_SCALE/2 if encoding=="uint8" else 4*2**-11
+    for i in range(len(dense)):
+        a, b = dense[i], compact[i]
+        x = expand_features(b["x"])
+        assert torch.equal(a["x"]["DNA_seq"], x["DNA_seq"])
+        assert torch.equal(a["x"]["raw_seq"], x["raw_seq"])
+        assert torch.equal(a["x"]["position"], x["position"])
+        assert torch.equal(a["y"], b["y"])
+        assert (a["x"]["histone_mark"]-x["histone_mark"]).abs().max().item()<=tolerance+1e-6
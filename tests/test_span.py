@@ -0,0 +1,39 @@
+import json
+import numpy as np
+import pytest
+import generate_x
+from benchmark import FakeBigWig
+from histone_store import HistoneStore, _clip
+
+CELL_TYPE, LENGTH, GENOME_DISTANCE = "synthetic", 20000, 100
+
+
+@pytest.fixture
+def synthetic_tracks(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    marks = generate_x.get_histone_type_lst()
+    tracks = rng.gamma(1.0, 2.0, (len(marks), LENGTH))
+    (tmp_path/CELL_TYPE).mkdir()
+    np.save(tmp_path/CELL_TYPE/"chr1.npy", _clip(tracks).astype(np.float16))
+    (tmp_path/CELL_TYPE/"index.json").write_text(json.dumps({"marks":marks,"chroms":{"chr1":LENGTH}}))
+    monkeypatch.setattr(generate_x, "_genome", {"chr1": "".join(rng.choice(list("ACGTN"), LENGTH))})
+    monkeypatch.setattr(generate_x, "tempData", generate_x.TempData())
+    return {"store":(HistoneStore(str(tmp_path), CELL_TYPE), None),
+            "bigwig":(None, {mark: FakeBigWig("chr1", tracks[row]) for row, mark in enumerate(marks)})}
+
+
+@pytest.mark.parametrize("backend", ["store", "bigwig"])
+@pytest.mark.parametrize("strand", ["+", "-"])
+def test_span_holds_merged_windows(synthetic_tracks, backend, strand):
+    # two overlapping sites, one touching the previous window, and two far apart across a long intron
+    sites = np.array([1000, 1050, 1250, 9000, 15000])
+    generate_x.tempData.cell_type = CELL_TYPE
+    generate_x.tempData.histone_store, generate_x.tempData.histone_modification = synthetic_tracks[backend]
+    codes, histone_mark, starts = generate_x.get_span(CELL_TYPE, "chr1", sites, GENOME_DISTANCE, strand)
+    assert codes.shape[0]==histone_mark.shape[1]==(1250-1000+2*GENOME_DISTANCE)+2*2*GENOME_DISTANCE
+
+    histone_batch, DNA_batch = generate_x.get_x_batch(CELL_TYPE, "chr1", sites, GENOME_DISTANCE, strand)
+    for n, site in enumerate(sites):
+        histone_window, DNA_window = generate_x.get_x_balance(CELL_TYPE, "chr1", int(site), GENOME_DISTANCE, strand, None)
+        np.testing.assert_array_equal(DNA_batch[n], DNA_window)
+        np.testing.assert_allclose(histone_batch[n], histone_window)
@@ -0,0 +1,74 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+import pytorch_lightning as pl
+import torch
+import generate_x
+import generate_y
+from histone_store import _clip
+from label_store import _write_table, sse_columns
+from stream_dataset import Stream_site_module
+
+CELL_TYPE, LENGTH = "synthetic", 20000
+
+
+@pytest.fixture
+def synthetic_data(tmp_path, monkeypatch):
+    # genome, dense histone store and label store of one training (chr2) and one validation (chr11) chromosome
+    rng = np.random.default_rng(42)
+    chromosomes = ["chr2","chr11"]
+    marks = generate_x.get_histone_type_lst()
+    (tmp_path/"histone"/CELL_TYPE).mkdir(parents=True)
+    for chromosome in chromosomes:
+        np.save(tmp_path/"histone"/CELL_TYPE/(chromosome+".npy"), _clip(rng.gamma(1.0, 2.0, (len(marks), LENGTH))).astype(np.float16))
+    (tmp_path/"histone"/CELL_TYPE/"index.json").write_text(json.dumps({"marks":marks,"chroms":{i: LENGTH for i in chromosomes}}))
+    genes = 12
+    sse = pd.DataFrame({"Region":np.repeat(chromosomes, genes*3),"Strand":np.tile(np.repeat(["+","-"], 3), genes),
+                        "Site":np.sort(rng.choice(np.arange(100, LENGTH-100), genes*6, replace=False)),"SSE":rng.random(genes*6),
+                        "read_count":30,"Gene":np.repeat(["g{}".format(i) for i in range(genes*2)], 3)})
+    _write_table(sse, str(tmp_path/"labels"/CELL_TYPE/"sse"), "Region", "Strand", sse_columns)
+
+    monkeypatch.setattr(generate_x, "_genome", {i: "".join(rng.choice(list("ACGTN"), LENGTH)) for i in chromosomes})
+    monkeypatch.setattr(generate_x, "HISTONE_STORE_PATH", str(tmp_path/"histone"))
+    monkeypatch.setattr(generate_x, "tempData", generate_x.TempData())
+    monkeypatch.setattr(generate_y, "LABEL_STORE_PATH", str(tmp_path/"labels"))
+    monkeypatch.setattr(generate_y, "tempData", generate_y.TempData())
+
+
+class Mean_mark_model(pl.LightningModule):
+    # the smallest model over a batch of stream samples: mean of each mark through one linear layer
+    def __init__(self, marks):
+        super().__init__()
+        self.linear = torch.nn.Linear(marks, 1)
+
+    def forward(self, x):
+        return torch.sigmoid(self.linear(x["histone_mark"].mean(dim=-1)))
+
+    def step(self, batch):
+        y_hat = self(batch["x"])
+        y = batch["y"].reshape(y_hat.shape)
+        mask = ~torch.isnan(y)
+        return torch.nn.functional.binary_cross_entropy(y_hat[mask], y[mask])
+
+    def training_step(self, batch, batch_idx):
+        return self.step(batch)
+
+    def validation_step(self, batch, batch_idx):
+        self.log("val_loss", self.step(batch))
+
+    def configure_optimizers(self):
+        return torch.optim.SGD(self.parameters(), lr=0.1)
+
+
+@pytest.mark.parametrize("model", ["single","multi"])
+def test_stream_module_fits_with_fractional_val_check_interval(synthetic_data, model):
+    data_module = Stream_site_module(CELL_TYPE, model, batch_size=4, num_workers=0, genome_distance=16, prefetch_size=2)
+    data_module.setup("fit")
+    # 12 training genes of 3 sites each
+    assert len(data_module.train_dataset)==(12 if model=="multi" else 36)
+    # train.py builds every Trainer with val_check_interval=0.5
+    trainer = pl.Trainer(accelerator="cpu", max_epochs=1, val_check_interval=0.5, logger=False, enable_checkpointing=False,
+                         enable_progress_bar=False, enable_model_summary=False)
+    trainer.fit(Mean_mark_model(len(generate_x.get_histone_type_lst())), datamodule=data_module)
+    assert trainer.global_step==trainer.num_training_batches
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+from transformers import BertTokenizer
+import generate_x
+
+# the SpliceBERT vocabulary, one token per base
+VOCAB = ["[PAD]","[UNK]","[CLS]","[SEP]","[MASK]","N","A","C","G","T"]
+
+
+@pytest.fixture
+def synthetic_genome(tmp_path, monkeypatch):
+    # a random chromosome with lower case, U, N and other IUPAC codes, and a tokenizer of the SpliceBERT vocabulary
+    vocab_file = tmp_path/"vocab.txt"
+    vocab_file.write_text("\n".join(VOCAB)+"\n")
+    rng = np.random.default_rng(42)
+    chromosome = "".join(rng.choice(list("ACGTACGTACGTacgtNnUuRYKM"), 5000))
+    monkeypatch.setattr(generate_x, "_genome", {"chr1":chromosome})
+    monkeypatch.setattr(generate_x, "_tokenizer", BertTokenizer(str(vocab_file), do_lower_case=False))
+    monkeypatch.setattr(generate_x, "token_lut", None)
+    return rng
+
+
+@pytest.mark.parametrize("strand", ["+","-"])
+def test_token_lut_matches_huggingface(synthetic_genome, strand):
+    sites = np.sort(synthetic_genome.integers(100, 4900, 50))
+    batch = generate_x.get_seq_batch("chr1", sites, 100, strand)
+    for i, site in enumerate(sites):
+        assert batch[i].tolist()==generate_x.get_seq_hf("chr1", int(site), 100, strand)
+        assert generate_x.get_seq("chr1", int(site), 100, strand)==batch[i].tolist()